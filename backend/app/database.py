@@ -1,29 +1,78 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.orm import declarative_base, Session
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy import event
 from app.config import settings
+from app.utils.logger import log_info, log_warning, log_success
+from app.services.metrics import DB_SESSION_SECONDS, DB_SESSIONS_ACTIVE
+import asyncio
 import os
 
 # 判断数据库类型
 is_sqlite = settings.database_url.startswith("sqlite")
 is_postgres = "postgresql" in settings.database_url or "postgres" in settings.database_url
 
+# SQLite 连接模式：pooled = 读连接池 + 单写连接；null = 每个会话新建连接（旧行为）
+sqlite_pooled = is_sqlite and settings.sqlite_engine_mode == "pooled"
+
 # SQLite 需要创建数据目录
 if is_sqlite:
     os.makedirs("data", exist_ok=True)
 
+_sqlite_connect_args = {
+    "timeout": 60,
+    "check_same_thread": False
+}
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新建的 SQLite 连接都设置 PRAGMA（连接级参数不会跨连接生效）"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=60000")
+    cursor.execute(f"PRAGMA cache_size=-{settings.sqlite_cache_size_kb}")
+    cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size_mb * 1024 * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
 # 根据数据库类型配置引擎
-if is_sqlite:
-    # SQLite 配置
+if sqlite_pooled:
+    # SQLite 写连接：全局唯一，所有写事务在连接池的等待队列中排队串行执行，
+    # 避免多个连接同时抢写锁导致 "database is locked"
+    engine = create_async_engine(
+        settings.database_url,
+        echo=False,
+        connect_args=_sqlite_connect_args,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=60,
+    )
+    # SQLite 读连接池：WAL 模式下读操作不阻塞写，复用连接省去每次建连和开线程的开销
+    reader_engine = create_async_engine(
+        settings.database_url,
+        echo=False,
+        connect_args=_sqlite_connect_args,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=settings.sqlite_read_pool_size,
+        max_overflow=0,
+        pool_timeout=60,
+    )
+    event.listen(engine.sync_engine, "connect", _apply_sqlite_pragmas)
+    event.listen(reader_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+elif is_sqlite:
+    # SQLite 配置（每个会话独立连接）
     engine = create_async_engine(
         settings.database_url, 
         echo=False,
-        connect_args={
-            "timeout": 60,
-            "check_same_thread": False
-        },
+        connect_args=_sqlite_connect_args,
         poolclass=NullPool,
     )
+    reader_engine = engine
+    event.listen(engine.sync_engine, "connect", _apply_sqlite_pragmas)
 else:
     # PostgreSQL 配置
     engine = create_async_engine(
@@ -33,24 +82,227 @@ else:
         max_overflow=20,
         pool_pre_ping=True,
     )
+    reader_engine = engine
+
+
+_WRITER_BOUND = "sqlite_writer_bound"
+
+
+class SQLiteRoutingSession(Session):
+    """
+    SQLite 读写路由会话
+
+    flush 和 INSERT/UPDATE/DELETE 语句走唯一的写连接，其余查询走读连接池。
+    会话一旦在当前事务中写过数据，后续查询也固定走写连接，保证能读到自己未提交的修改。
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or self.info.get(_WRITER_BOUND) or isinstance(clause, UpdateBase):
+            self.info[_WRITER_BOUND] = True
+            return engine.sync_engine
+        return reader_engine.sync_engine
+
+
+@event.listens_for(SQLiteRoutingSession, "after_transaction_end")
+def _release_writer_binding(session, transaction):
+    # 只在最外层事务结束（commit / rollback）时解除写连接绑定
+    if transaction.parent is None:
+        session.info.pop(_WRITER_BOUND, None)
+
+
+if sqlite_pooled:
+    async_session = async_sessionmaker(
+        class_=AsyncSession, sync_session_class=SQLiteRoutingSession, expire_on_commit=False
+    )
+else:
+    async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# 只读副本（可选）
+replica_engine = None
+replica_session = None
+if settings.database_read_url:
+    if settings.database_read_url.startswith("sqlite"):
+        # SQLite 快照可作为副本替身（用于本地测试）
+        replica_engine = create_async_engine(
+            settings.database_read_url,
+            echo=False,
+            connect_args=_sqlite_connect_args,
+            poolclass=NullPool,
+        )
+    else:
+        replica_engine = create_async_engine(
+            settings.database_read_url,
+            echo=False,
+            pool_size=settings.read_replica_pool_size,
+            max_overflow=settings.read_replica_max_overflow,
+            pool_pre_ping=True,
+        )
+    replica_session = async_sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+class ReplicaHealth:
+    """只读副本健康状态（由后台任务定期刷新）"""
+
+    def __init__(self):
+        self.healthy = False  # 首次检查通过前不使用副本
+        self.lag_seconds: float = None
+        self.last_error: str = None
+        self.last_check: float = None
+        self.fallback_count = 0  # 因副本不可用而回退到主库的次数
 
-async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    def to_dict(self) -> dict:
+        return {
+            "configured": replica_engine is not None,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag_seconds,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "fallback_count": self.fallback_count,
+        }
+
+
+replica_health = ReplicaHealth()
 
 Base = declarative_base()
 
 async def get_db():
+    DB_SESSIONS_ACTIVE.inc()
+    try:
+        with DB_SESSION_SECONDS.time():
+            async with async_session() as session:
+                yield session
+    finally:
+        DB_SESSIONS_ACTIVE.dec()
+
+
+async def get_read_db():
+    """
+    只读会话（管理后台统计、日志查询等）
+
+    配置了只读副本且副本健康时使用副本，否则回退到主库。
+    通过此依赖获取的会话不应执行写操作。
+    """
+    if replica_session is not None:
+        if replica_health.healthy:
+            async with replica_session() as session:
+                yield session
+            return
+        replica_health.fallback_count += 1
     async with async_session() as session:
         yield session
 
+
+async def check_replica_health():
+    """检查只读副本的可用性和复制延迟"""
+    from sqlalchemy import text
+    import time
+
+    try:
+        async with replica_engine.connect() as conn:
+            if replica_engine.dialect.name == "postgresql":
+                # 副本已回放完所有收到的 WAL 时视为无延迟（空闲副本的回放时间戳不会更新）
+                result = await conn.execute(text(
+                    "SELECT CASE "
+                    "WHEN NOT pg_is_in_recovery() THEN 0 "
+                    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                ))
+                lag = float(result.scalar() or 0)
+            else:
+                await conn.execute(text("SELECT 1"))
+                lag = 0.0
+        replica_health.lag_seconds = lag
+        replica_health.last_error = None
+        healthy = lag <= settings.read_replica_max_lag_seconds
+        if not healthy:
+            replica_health.last_error = f"复制延迟 {lag:.1f}s 超过阈值"
+    except Exception as e:
+        healthy = False
+        replica_health.last_error = str(e)[:200]
+
+    if healthy != replica_health.healthy:
+        if healthy:
+            log_info("DB", "只读副本已恢复，统计查询切换到副本")
+        else:
+            log_warning("DB", f"只读副本不可用，回退到主库: {replica_health.last_error}")
+    replica_health.healthy = healthy
+    replica_health.last_check = time.time()
+
+
+async def replica_monitor_loop():
+    """定期检查只读副本健康状态"""
+    while True:
+        try:
+            await check_replica_health()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_warning("DB", f"副本健康检查异常: {e}")
+        await asyncio.sleep(settings.read_replica_check_interval)
+
+
+def _pool_stats(target_engine) -> dict:
+    """读取单个连接池的使用情况"""
+    pool = target_engine.pool
+    stats = {"pool_class": type(pool).__name__}
+    if hasattr(pool, "checkedout"):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    return stats
+
+
+def get_pool_stats() -> dict:
+    """所有数据库连接池的使用情况（主库 / SQLite 读池 / 只读副本）"""
+    stats = {"primary": _pool_stats(engine)}
+    if reader_engine is not engine:
+        stats["sqlite_reader"] = _pool_stats(reader_engine)
+    if replica_engine is not None:
+        stats["replica"] = _pool_stats(replica_engine)
+    return stats
+
+
+async def sqlite_checkpoint_loop():
+    """定期执行 WAL checkpoint，防止 -wal 文件无限增长拖慢读取"""
+    interval = settings.sqlite_checkpoint_interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with engine.connect() as conn:
+                result = await conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+                busy, log_frames, checkpointed = result.first()
+            log_info("DB", f"WAL checkpoint: {checkpointed}/{log_frames} 页, busy={busy}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_warning("DB", f"WAL checkpoint 失败: {e}")
+
+
+def start_db_maintenance() -> list:
+    """启动数据库后台维护任务，返回任务列表（供关闭时取消）"""
+    tasks = []
+    if is_sqlite and settings.sqlite_checkpoint_interval > 0:
+        tasks.append(asyncio.create_task(sqlite_checkpoint_loop()))
+    if replica_engine is not None:
+        tasks.append(asyncio.create_task(replica_monitor_loop()))
+    return tasks
+
+
+async def dispose_engines():
+    """关闭所有数据库连接池"""
+    if replica_engine is not None:
+        await replica_engine.dispose()
+    if reader_engine is not engine:
+        await reader_engine.dispose()
+    await engine.dispose()
+
 async def init_db():
     async with engine.begin() as conn:
-        # SQLite 特有优化
-        if is_sqlite:
-            from sqlalchemy import text
-            await conn.execute(text("PRAGMA journal_mode=WAL"))
-            await conn.execute(text("PRAGMA synchronous=NORMAL"))
-            await conn.execute(text("PRAGMA busy_timeout=60000"))
-        
+        # SQLite 的 PRAGMA 已在每个连接建立时设置（见 _apply_sqlite_pragmas）
         await conn.run_sync(Base.metadata.create_all)
         
         # 数据库迁移：添加新列（如果不存在）
@@ -77,6 +329,17 @@ async def init_db():
                 "ALTER TABLE usage_logs ADD COLUMN credential_email VARCHAR(100)",
                 # 用户审核字段（新增）
                 "ALTER TABLE users ADD COLUMN is_approved BOOLEAN DEFAULT 0",
+                # OpenAI 端点负载均衡字段
+                "ALTER TABLE openai_endpoints ADD COLUMN weight INTEGER DEFAULT 1",
+                "ALTER TABLE openai_endpoints ADD COLUMN max_concurrency INTEGER DEFAULT 0",
+                # 用量统计字段
+                "ALTER TABLE usage_logs ADD COLUMN prompt_tokens INTEGER",
+                "ALTER TABLE usage_logs ADD COLUMN completion_tokens INTEGER",
+                "ALTER TABLE usage_logs ADD COLUMN response_bytes INTEGER",
+                # 响应缓存命中标记
+                "ALTER TABLE usage_logs ADD COLUMN cache_hit BOOLEAN DEFAULT 0",
+                # token 配额计入量
+                "ALTER TABLE usage_logs ADD COLUMN quota_cost FLOAT",
             ]
         else:
             # PostgreSQL 迁移（使用 IF NOT EXISTS 语法）
@@ -99,12 +362,23 @@ async def init_db():
                 "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS credential_email VARCHAR(100)",
                 # 用户审核字段（新增）
                 "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_approved BOOLEAN DEFAULT FALSE",
+                # OpenAI 端点负载均衡字段
+                "ALTER TABLE openai_endpoints ADD COLUMN IF NOT EXISTS weight INTEGER DEFAULT 1",
+                "ALTER TABLE openai_endpoints ADD COLUMN IF NOT EXISTS max_concurrency INTEGER DEFAULT 0",
+                # 用量统计字段
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER",
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS completion_tokens INTEGER",
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS response_bytes INTEGER",
+                # 响应缓存命中标记
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN DEFAULT FALSE",
+                # token 配额计入量
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS quota_cost FLOAT",
             ]
         
         for sql in migrations:
             try:
                 await conn.execute(text(sql))
-                print(f"[DB Migration] ✅ {sql[:50]}...")
+                log_success("DB Migration", "%s...", sql[:50])
             except Exception as e:
                 if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
                     pass  # 列已存在，忽略
@@ -122,11 +396,30 @@ async def init_db():
             # 错误分类索引（新增）
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_error_type ON usage_logs(error_type)",
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_date_error ON usage_logs(created_at, error_type)",
+            # 日志游标分页索引（created_at, id）
+            "CREATE INDEX IF NOT EXISTS idx_usage_logs_created_id ON usage_logs(created_at, id)",
         ]
-        
+
         for sql in indexes:
             try:
                 await conn.execute(text(sql))
-                print(f"[DB Index] ✅ {sql[30:70]}...")
+                log_success("DB Index", "%s...", sql[30:70])
             except Exception as e:
                 pass  # 索引已存在，忽略
+
+        # PostgreSQL: 为用户名/模型的模糊搜索建立 pg_trgm 索引，使 ILIKE '%...%' 可走索引
+        if is_postgres:
+            trgm_statements = [
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                "CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops)",
+                "CREATE INDEX IF NOT EXISTS idx_usage_logs_model_trgm ON usage_logs USING gin (model gin_trgm_ops)",
+            ]
+            for sql in trgm_statements:
+                try:
+                    # 使用 SAVEPOINT，避免扩展权限不足时中止整个初始化事务
+                    async with conn.begin_nested():
+                        await conn.execute(text(sql))
+                    log_success("DB Index", "%s...", sql[:60])
+                except Exception as e:
+                    log_warning("DB Index", "跳过 pg_trgm 索引: %s", str(e)[:80])
+                    break
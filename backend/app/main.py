@@ -1,19 +1,33 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 import os
 
-from app.database import init_db, async_session
+from app.database import init_db, async_session, start_db_maintenance, dispose_engines
 from app.models.user import User
 from app.services.auth import get_password_hash
+from app.services.live_stats import live_stats
+from app.services.pubsub import bus, start_bus
+from app.services.model_catalog import model_catalog
+from app.services.endpoint_registry import endpoint_registry
+from app.services.upstream_clients import upstream_clients
+from app.services.rate_limiter import rate_limiter, RateLimitReleaseMiddleware
+from app.services.request_capture import capture_store
+from app.services.usage_accounting import usage_accounting
+from app.services.response_cache import response_cache
+from app.services.shutdown import shutdown_coordinator, DrainMiddleware
 from app.config import settings, load_config_from_db
-from app.routers import auth, proxy, admin, oauth, ws, manage
+from app.routers import auth, proxy, admin, oauth, ws, manage, metrics
 from app.routers.test import router as test_router
 from app.middleware.url_normalize import URLNormalizeMiddleware
+from app.utils.logger import configure_logging, flush_logs, log_success, log_warning
 from sqlalchemy import select
 
+configure_logging()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -23,9 +37,12 @@ async def lifespan(app: FastAPI):
     # 从数据库加载持久化配置
     try:
         await load_config_from_db()
-        print("✅ 已加载持久化配置")
+        log_success("Startup", "已加载持久化配置")
     except Exception as e:
-        print(f"⚠️ 加载配置失败: {e}")
+        log_warning("Startup", "加载配置失败: %s", e)
+
+    if not settings.metrics_token and settings.metrics_public:
+        log_warning("Startup", "未配置 METRICS_TOKEN 且开启了 METRICS_PUBLIC，/metrics 可匿名访问")
     
     # 创建或更新管理员账号，确保只有配置的用户名是管理员
     async with async_session() as db:
@@ -35,7 +52,7 @@ async def lifespan(app: FastAPI):
         )
         for other in other_admins.scalars().all():
             other.is_admin = False
-            print(f"⚠️ 降级旧管理员: {other.username}")
+            log_warning("Startup", "降级旧管理员: %s", other.username)
         
         # 创建或更新配置的管理员
         result = await db.execute(select(User).where(User.username == settings.admin_username))
@@ -49,17 +66,60 @@ async def lifespan(app: FastAPI):
                 daily_quota=999999
             )
             db.add(admin_user)
-            print(f"✅ 创建管理员账号: {settings.admin_username}")
+            log_success("Startup", "创建管理员账号: %s", settings.admin_username)
         else:
             # 更新管理员密码（确保 .env 修改后生效）
             admin_user.hashed_password = get_password_hash(settings.admin_password)
             admin_user.is_admin = True
             admin_user.is_approved = True  # 管理员默认已审核
-            print(f"✅ 已同步管理员账号: {settings.admin_username}")
+            log_success("Startup", "已同步管理员账号: %s", settings.admin_username)
         
         await db.commit()
     
+    # 实时统计基线（之后由 UsageLog 提交事件增量更新）
+    try:
+        async with async_session() as db:
+            await live_stats.load(db)
+    except Exception as e:
+        log_warning("Startup", "加载实时统计失败: %s", e)
+    
+    # 数据库后台维护（SQLite WAL checkpoint 等）
+    maintenance_tasks = start_db_maintenance()
+    
+    # 跨 worker 推送总线
+    await start_bus()
+    
+    # 速率限制：定期刷新贡献者名单
+    maintenance_tasks.append(asyncio.create_task(rate_limiter.run()))
+    
+    # OpenAI 端点注册表：定期批量写入端点统计
+    maintenance_tasks.append(asyncio.create_task(endpoint_registry.run()))
+    
+    # 用量统计：定期批量写入日汇总和流式请求的用量
+    maintenance_tasks.append(asyncio.create_task(usage_accounting.run()))
+    
+    # 请求采样：定期清理过期和孤儿记录
+    maintenance_tasks.append(asyncio.create_task(capture_store.run()))
+    
+    # 预热模型目录（后台并发获取各 OpenAI 端点的模型列表）
+    model_catalog.refresh_in_background()
+    
+    # 优雅关闭：SIGTERM 时先排空进行中的请求，再交给 uvicorn 停止监听
+    shutdown_coordinator.install_signal_handler()
+    
     yield
+    
+    # 关闭时清理（SIGTERM 时已排空；其他方式关闭时在这里排空）
+    await shutdown_coordinator.drain()
+    await bus.stop()
+    for task in maintenance_tasks:
+        task.cancel()
+    await endpoint_registry.flush()
+    await usage_accounting.flush()
+    await response_cache.persist()
+    await upstream_clients.aclose()
+    await dispose_engines()
+    await asyncio.to_thread(flush_logs)
 
 
 app = FastAPI(
@@ -82,6 +142,9 @@ app.add_middleware(
 # 注意：ASGI 中间件的执行顺序是后添加先执行，所以这个中间件会在 CORS 之后执行
 app.add_middleware(URLNormalizeMiddleware)
 
+# 速率限制：响应结束后释放并发流名额
+app.add_middleware(RateLimitReleaseMiddleware)
+
 @app.middleware("http")
 async def add_csp_header(request, call_next):
     response = await call_next(request)
@@ -90,6 +153,10 @@ async def add_csp_header(request, call_next):
     response.headers["Content-Security-Policy"] = "script-src 'self' 'unsafe-inline' 'unsafe-eval' blob:; worker-src 'self' blob:;"
     return response
 
+# 优雅关闭：记录进行中的请求，排空期间拒绝新请求
+# 放在最外层，记录的是 uvicorn 的请求任务（超时中断时取消该任务）
+app.add_middleware(DrainMiddleware)
+
 # 注册路由
 app.include_router(auth.router)
 app.include_router(proxy.router)
@@ -97,6 +164,7 @@ app.include_router(admin.router)
 app.include_router(oauth.router)
 app.include_router(ws.router)
 app.include_router(manage.router)
+app.include_router(metrics.router)
 app.include_router(test_router)  # 测试接口（用于模拟报错场景）
 
 
@@ -105,6 +173,14 @@ async def health():
     return {"status": "ok", "service": "Catiecli"}
 
 
+@app.get("/api/ready")
+async def ready():
+    """就绪探针：关闭排空期间返回 503，负载均衡据此摘除实例"""
+    if not shutdown_coordinator.ready:
+        return JSONResponse(status_code=503, content={"status": "draining", "active": shutdown_coordinator.active()})
+    return {"status": "ready", "active": shutdown_coordinator.active()}
+
+
 @app.get("/api/public/stats")
 async def public_stats():
     """公共统计信息（无需登录）"""
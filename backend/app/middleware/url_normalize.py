@@ -12,6 +12,7 @@ URL 规范化中间件
 from starlette.types import ASGIApp, Receive, Scope, Send
 
 from app.utils.path_normalize import normalize_and_extract_path, SKIP_PREFIXES
+from app.utils.logger import log_info
 
 
 class URLNormalizeMiddleware:
@@ -55,7 +56,7 @@ class URLNormalizeMiddleware:
             
             # 如果路径发生了变化，记录日志并修改 scope
             if normalized_path != original_path:
-                print(f"[URLNormalize] 🔀 路径重写: {original_path} -> {normalized_path}", flush=True)
+                log_info("URLNormalize", "🔀 路径重写: %s -> %s", original_path, normalized_path)
                 
                 # 修改 scope 中的路径
                 scope["path"] = normalized_path
@@ -84,10 +85,10 @@ class URLNormalizeMiddlewareDebug(URLNormalizeMiddleware):
             
             # 始终记录请求信息（调试模式）
             if normalized_path != original_path:
-                print(f"[URLNormalize] 🔀 {method} 路径重写: {original_path} -> {normalized_path}", flush=True)
+                log_info("URLNormalize", "🔀 %s 路径重写: %s -> %s", method, original_path, normalized_path)
             else:
                 # 仅在调试模式下输出未修改的请求
-                # print(f"[URLNormalize] ✓ {method} {original_path}", flush=True)
+                # log_debug("URLNormalize", "✓ %s %s", method, original_path)
                 pass
             
             # 修改 scope 中的路径
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import secrets
@@ -69,10 +69,44 @@ class UsageLog(Base):
     error_type = Column(String(50), nullable=True, index=True)  # 错误类型：AUTH_ERROR, RATE_LIMIT, QUOTA_EXHAUSTED 等
     error_code = Column(String(100), nullable=True)  # 错误码：PERMISSION_DENIED, RESOURCE_EXHAUSTED 等
     credential_email = Column(String(100), nullable=True)  # 使用的凭证邮箱（方便排查）
+    # 用量（来自上游响应的 usage / usageMetadata）
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    response_bytes = Column(Integer, nullable=True)  # 返回给客户端的响应体字节数
+    cache_hit = Column(Boolean, default=False)  # 由响应缓存直接返回（未请求上游）
+    quota_cost = Column(Float, nullable=True)  # token 配额模式下本次计入的加权 token
     
     # 关系
     user = relationship("User", back_populates="usage_logs")
     credential = relationship("Credential")
+    # 采样的请求/错误详情（只随日志一起写入，读取时按 log_id 单独查询）
+    capture = relationship("RequestCapture", uselist=False, lazy="noload", cascade="save-update", passive_deletes=True)
+
+
+class UsageDaily(Base):
+    """按 (日期, 用户, 模型) 汇总的请求数和用量"""
+    __tablename__ = "usage_daily"
+    __table_args__ = (UniqueConstraint("day", "user_id", "model", name="uq_usage_daily"),)
+
+    id = Column(Integer, primary_key=True)
+    day = Column(String(10), nullable=False, index=True)  # UTC 日期 YYYY-MM-DD
+    user_id = Column(Integer, nullable=False, index=True)
+    model = Column(String(100), nullable=False, default="")
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    response_bytes = Column(Integer, nullable=False, default=0)
+
+
+class RequestCapture(Base):
+    """采样保存的请求内容和完整错误信息（压缩存储，不占用 usage_logs 行宽）"""
+    __tablename__ = "request_captures"
+
+    id = Column(Integer, primary_key=True)
+    log_id = Column(Integer, ForeignKey("usage_logs.id", ondelete="CASCADE"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    request_blob = Column(LargeBinary, nullable=True)  # zlib 压缩的请求体
+    error_blob = Column(LargeBinary, nullable=True)  # zlib 压缩的完整错误信息
 
 
 class Credential(Base):
@@ -127,6 +161,8 @@ class OpenAIEndpoint(Base):
     base_url = Column(String(500), nullable=False)  # API Base URL
     is_active = Column(Boolean, default=True)  # 是否启用
     priority = Column(Integer, default=0)  # 优先级（数字越大优先级越高）
+    weight = Column(Integer, default=1)  # 同优先级内的负载均衡权重
+    max_concurrency = Column(Integer, default=0)  # 并发上限（0 表示不限）
     total_requests = Column(Integer, default=0)  # 总请求数
     failed_requests = Column(Integer, default=0)  # 失败请求数
     last_used_at = Column(DateTime, nullable=True)  # 最后使用时间
@@ -5,12 +5,21 @@ from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime, date, timedelta
 
-from app.database import get_db
+from app.database import get_db, get_read_db, get_pool_stats, replica_health
 from app.models.user import User, APIKey, UsageLog, Credential
 from app.services.auth import get_current_admin, get_password_hash
 from app.services.websocket import notify_user_update, notify_credential_update
+from app.services.live_stats import live_stats
+from app.services.pubsub import bus
+from app.services.model_catalog import model_catalog
+from app.services.model_router import model_router
+from app.services.request_capture import capture_store
+from app.services.usage_accounting import usage_accounting
+from app.services.response_cache import response_cache
+from app.services.admission import admission
 from app.services.error_classifier import ErrorType, ERROR_TYPE_NAMES, get_error_type_name
 from app.utils.logger import log_warning, log_error
+from app.utils.pagination import apply_keyset, estimate_count, next_cursor_for
 
 router = APIRouter(prefix="/api/admin", tags=["管理后台"])
 
@@ -772,7 +781,7 @@ async def delete_duplicate_credentials(
 @router.get("/stats")
 async def get_stats(
     admin: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取系统统计"""
     # 用户数
@@ -812,6 +821,82 @@ async def get_stats(
     }
 
 
+
+@router.get("/stats/live")
+async def get_live_stats(admin: User = Depends(get_current_admin)):
+    """实时统计快照（内存计数，不查询数据库）"""
+    return live_stats.snapshot()
+
+
+@router.get("/pubsub")
+async def get_pubsub_status(admin: User = Depends(get_current_admin)):
+    """跨 worker 推送总线状态"""
+    return bus.status()
+
+
+@router.get("/model-catalog")
+async def get_model_catalog_status(admin: User = Depends(get_current_admin)):
+    """模型目录及路由表状态（各 OpenAI 端点的模型数、最近一次刷新错误）"""
+    return {**model_catalog.status(), "router": model_router.status()}
+
+
+@router.get("/usage/daily")
+async def get_usage_daily(
+    days: int = 7,
+    user_id: Optional[int] = None,
+    admin: User = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """按 (日期, 用户, 模型) 汇总的请求数、token 数和响应字节数（最近 days 天，UTC）"""
+    end_day = datetime.utcnow().date()
+    start_day = end_day - timedelta(days=max(days, 1) - 1)
+    rows = await usage_accounting.daily(db, start_day.isoformat(), end_day.isoformat(), user_id)
+    return {
+        "days": [
+            {
+                "day": row.day,
+                "user_id": row.user_id,
+                "model": row.model,
+                "requests": row.requests,
+                "prompt_tokens": row.prompt_tokens,
+                "completion_tokens": row.completion_tokens,
+                "response_bytes": row.response_bytes,
+            }
+            for row in rows
+        ],
+        "pending": usage_accounting.pending(),
+    }
+
+
+@router.get("/response-cache")
+async def get_response_cache_stats(admin: User = Depends(get_current_admin)):
+    """响应缓存占用情况"""
+    from app.config import settings
+    return {"enabled": settings.response_cache_enabled, **response_cache.stats()}
+
+
+@router.delete("/response-cache")
+async def clear_response_cache(admin: User = Depends(get_current_admin)):
+    """清空响应缓存（内存和磁盘层）"""
+    await response_cache.clear()
+    return {"message": "响应缓存已清空"}
+
+
+@router.get("/admission")
+async def get_admission_stats(admin: User = Depends(get_current_admin)):
+    """上游准入调度：各上游的在途数、上限和排队情况"""
+    from app.config import settings
+    return {"enabled": settings.admission_enabled, "pools": admission.stats()}
+
+
+@router.get("/db-pools")
+async def get_db_pools(admin: User = Depends(get_current_admin)):
+    """数据库连接池使用情况及只读副本健康状态"""
+    return {
+        "pools": get_pool_stats(),
+        "replica": replica_health.to_dict()
+    }
+
 def get_api_source(log: UsageLog):
     """根据日志信息判断 API 调用来源"""
     model = log.model or ""
@@ -833,6 +918,7 @@ def get_api_source(log: UsageLog):
 async def get_logs(
     limit: int = 100,
     page: int = 1,
+    cursor: str = None,      # 游标分页：传入上一页返回的 next_cursor
     start_date: str = None,  # YYYY-MM-DD
     end_date: str = None,    # YYYY-MM-DD
     username: str = None,
@@ -840,59 +926,66 @@ async def get_logs(
     status: str = None,      # success, error, all
     error_type: str = None,  # 按错误类型筛选
     admin: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """获取使用日志（支持分页和筛选）"""
+    """获取使用日志（支持游标分页和筛选）"""
     from datetime import datetime
     
-    query = select(UsageLog, User.username).join(User, UsageLog.user_id == User.id)
-    count_query = select(func.count(UsageLog.id)).select_from(UsageLog).join(User, UsageLog.user_id == User.id)
+    limit = max(1, min(limit, 500))
+    conditions = []
     
     # 时间范围筛选
     if start_date:
         try:
             start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.where(UsageLog.created_at >= start_dt)
-            count_query = count_query.where(UsageLog.created_at >= start_dt)
+            conditions.append(UsageLog.created_at >= start_dt)
         except: pass
     
     if end_date:
         try:
             end_dt = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
-            query = query.where(UsageLog.created_at < end_dt)
-            count_query = count_query.where(UsageLog.created_at < end_dt)
+            conditions.append(UsageLog.created_at < end_dt)
         except: pass
     
-    # 用户名筛选
+    # 用户名筛选：先在用户表中匹配出 user_id，再走 (user_id, created_at) 索引
     if username:
-        query = query.where(User.username.ilike(f"%{username}%"))
-        count_query = count_query.where(User.username.ilike(f"%{username}%"))
+        user_ids_result = await db.execute(
+            select(User.id).where(User.username.ilike(f"%{username}%"))
+        )
+        user_ids = [row[0] for row in user_ids_result.fetchall()]
+        if not user_ids:
+            return {"logs": [], "total": 0, "pages": 0, "page": page, "next_cursor": None, "total_is_estimate": False}
+        conditions.append(UsageLog.user_id.in_(user_ids))
     
-    # 模型筛选
+    # 模型筛选（PostgreSQL 下由 pg_trgm 索引加速）
     if model:
-        query = query.where(UsageLog.model.ilike(f"%{model}%"))
-        count_query = count_query.where(UsageLog.model.ilike(f"%{model}%"))
+        conditions.append(UsageLog.model.ilike(f"%{model}%"))
     
     # 状态筛选
     if status == "success":
-        query = query.where(UsageLog.status_code == 200)
-        count_query = count_query.where(UsageLog.status_code == 200)
+        conditions.append(UsageLog.status_code == 200)
     elif status == "error":
-        query = query.where(UsageLog.status_code != 200)
-        count_query = count_query.where(UsageLog.status_code != 200)
+        conditions.append(UsageLog.status_code != 200)
     
     # 错误类型筛选
     if error_type:
-        query = query.where(UsageLog.error_type == error_type)
-        count_query = count_query.where(UsageLog.error_type == error_type)
+        conditions.append(UsageLog.error_type == error_type)
     
-    # 获取总数
-    total_result = await db.execute(count_query)
-    total = total_result.scalar() or 0
+    # 获取总数（估算值，避免大表全量 COUNT）
+    total, total_is_estimate = await estimate_count(
+        db, select(UsageLog.id).where(*conditions), "usage_logs", filtered=bool(conditions)
+    )
     
-    # 分页
-    offset = (page - 1) * limit
-    query = query.order_by(UsageLog.created_at.desc()).offset(offset).limit(limit)
+    query = select(UsageLog, User.username).join(User, UsageLog.user_id == User.id).where(*conditions)
+    try:
+        query = apply_keyset(query, UsageLog, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # 兼容旧的页码分页（无游标时）
+    if not cursor and page > 1:
+        query = query.offset((page - 1) * limit)
+    query = query.limit(limit)
     
     result = await db.execute(query)
     logs = result.all()
@@ -918,8 +1011,10 @@ async def get_logs(
             for log in logs
         ],
         "total": total,
+        "total_is_estimate": total_is_estimate,
         "pages": (total + limit - 1) // limit,
-        "page": page
+        "page": page,
+        "next_cursor": next_cursor_for(logs, limit)
     }
 
 
@@ -927,7 +1022,7 @@ async def get_logs(
 async def get_log_detail(
     log_id: int,
     admin: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取单条日志详情（包含完整错误信息）"""
     result = await db.execute(
@@ -943,6 +1038,7 @@ async def get_log_detail(
     log = row.UsageLog
     username = row.username
     cred_email = row.cred_email
+    capture = await capture_store.load(db, log.id) or {}
     
     return {
         "id": log.id,
@@ -957,8 +1053,13 @@ async def get_log_detail(
         "error_type": log.error_type,
         "error_type_name": get_error_type_name(log.error_type) if log.error_type else None,
         "error_code": log.error_code,
-        "error_message": log.error_message,  # 完整错误信息
-        "request_body": log.request_body,
+        "error_message": capture.get("error_message") or log.error_message,  # 完整错误信息（采样保存）
+        "request_body": capture.get("request_body") or log.request_body,
+        "captured": bool(capture),
+        "cache_hit": bool(log.cache_hit),
+        "prompt_tokens": log.prompt_tokens,
+        "completion_tokens": log.completion_tokens,
+        "response_bytes": log.response_bytes,
         "client_ip": log.client_ip,
         "user_agent": log.user_agent,
         "latency_ms": log.latency_ms / 1000 if log.latency_ms else 0,
@@ -971,7 +1072,7 @@ async def get_log_detail(
 async def get_error_stats(
     days: int = 7,
     admin: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """报错统计分析"""
     start_date = date.today() - timedelta(days=days-1)
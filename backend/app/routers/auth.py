@@ -11,6 +11,7 @@ from app.services.auth import (
     get_password_hash, authenticate_user, create_access_token,
     get_current_user, get_current_admin
 )
+from app.services.token_quota import token_quota
 from app.config import settings
 from app.utils.logger import log_info, log_warning, log_error, log_success, log_db_operation
 
@@ -188,7 +189,9 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
         "has_public_credentials": public_credential_count > 0,
         "created_at": user.created_at,
         "cred_25_count": cred_25_count,
-        "cred_30_count": cred_30_count
+        "cred_30_count": cred_30_count,
+        "quota_mode": settings.quota_mode,
+        "token_usage": token_quota.usage(user) if token_quota.enabled else None,
     }
 
 
@@ -12,13 +12,17 @@ import json
 import io
 import zipfile
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.models.user import User, Credential, UsageLog, OpenAIEndpoint
 from app.services.auth import get_current_user, get_current_admin
 from app.services.crypto import encrypt_credential, decrypt_credential
 from app.services.websocket import notify_stats_update
+from app.services.request_capture import capture_store
+from app.services.model_catalog import invalidate_model_catalog
+from app.services.endpoint_registry import endpoint_registry, invalidate_endpoint_registry
 from app.config import settings
 from app.utils.logger import log_info, log_warning, log_error, log_success
+from app.utils.pagination import apply_keyset, estimate_count, next_cursor_for
 
 
 router = APIRouter(prefix="/api/manage", tags=["管理功能"])
@@ -445,6 +449,19 @@ async def get_task_status(
     return _background_tasks[task_id]
 
 
+@router.post("/stats/errors/reclassify")
+async def reclassify_errors(user: User = Depends(get_current_admin)):
+    """重新分类历史报错（补齐缺失的 error_type / error_code，后台任务，立即返回）"""
+    from app.services.error_reclassify import error_reclassifier
+
+    if error_reclassifier.running:
+        return {"message": "任务已在运行", "task_id": error_reclassifier.task_id}
+    task_id = f"reclassify_{datetime.utcnow().timestamp()}"
+    _background_tasks[task_id] = {"status": "running"}
+    error_reclassifier.start(task_id, _background_tasks[task_id])
+    return {"message": "后台任务已启动", "task_id": task_id}
+
+
 @router.post("/credentials/verify-all")
 async def verify_all_credentials(
     user: User = Depends(get_current_admin),
@@ -717,7 +734,7 @@ async def get_credential_quota(
 @router.get("/stats/overview")
 async def get_stats_overview(
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取统计概览"""
     now = datetime.utcnow()
@@ -789,7 +806,7 @@ async def get_stats_overview(
 async def get_stats_by_model(
     days: int = 7,
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """按模型统计使用量"""
     since = datetime.utcnow() - timedelta(days=days)
@@ -811,7 +828,7 @@ async def get_stats_by_model(
 async def get_stats_by_user(
     days: int = 7,
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """按用户统计使用量"""
     since = datetime.utcnow() - timedelta(days=days)
@@ -835,7 +852,7 @@ async def get_stats_by_user(
 async def get_daily_stats(
     days: int = 30,
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取每日统计数据（用于图表）"""
     since = datetime.utcnow() - timedelta(days=days)
@@ -957,7 +974,7 @@ async def update_config(
 @router.get("/stats/global")
 async def get_global_stats(
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取全站统计 - 带缓存"""
     # 尝试从缓存获取（缓存5秒）
@@ -1139,7 +1156,7 @@ async def get_global_stats(
 async def get_log_detail(
     log_id: int,
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取日志详情（包含错误信息、请求内容等）"""
     result = await db.execute(
@@ -1154,6 +1171,7 @@ async def get_log_detail(
         raise HTTPException(status_code=404, detail="日志不存在")
     
     log = row.UsageLog
+    capture = await capture_store.load(db, log.id) or {}
     return {
         "id": log.id,
         "username": row.username,
@@ -1163,8 +1181,10 @@ async def get_log_detail(
         "status_code": log.status_code,
         "latency_ms": log.latency_ms,
         "cd_seconds": log.cd_seconds,
-        "error_message": log.error_message,
-        "request_body": log.request_body,
+        "error_message": capture.get("error_message") or log.error_message,
+        "request_body": capture.get("request_body") or log.request_body,
+        "captured": bool(capture),
+        "cache_hit": bool(log.cache_hit),
         "client_ip": log.client_ip,
         "user_agent": log.user_agent,
         "created_at": log.created_at.isoformat() + "Z" if log.created_at else None
@@ -1176,8 +1196,9 @@ async def get_error_stats(
     page: int = 1,
     page_size: int = 50,
     status_code: Optional[int] = None,
+    cursor: Optional[str] = None,  # 游标分页：传入上一页返回的 next_cursor
     user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """获取详细的报错统计"""
     start_of_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
@@ -1220,27 +1241,30 @@ async def get_error_stats(
             "details": details
         })
     
-    # 报错记录分页查询
+    # 报错记录分页查询（游标分页，按 created_at, id 倒序）
+    conditions = [UsageLog.status_code != 200]
+    if status_code:
+        conditions.append(UsageLog.status_code == status_code)
+    
     query = (
         select(UsageLog, User.username, Credential.email.label("credential_email"))
         .join(User, UsageLog.user_id == User.id)
         .outerjoin(Credential, UsageLog.credential_id == Credential.id)
-        .where(UsageLog.status_code != 200)
+        .where(*conditions)
     )
     
-    if status_code:
-        query = query.where(UsageLog.status_code == status_code)
-    
-    # 总数
-    count_query = select(func.count(UsageLog.id)).where(UsageLog.status_code != 200)
-    if status_code:
-        count_query = count_query.where(UsageLog.status_code == status_code)
-    total_result = await db.execute(count_query)
-    total = total_result.scalar() or 0
+    # 总数（估算值）
+    total, total_is_estimate = await estimate_count(db, select(UsageLog.id).where(*conditions), "usage_logs")
     
     # 分页
-    query = query.order_by(UsageLog.created_at.desc()).offset((page - 1) * page_size).limit(page_size)
-    result = await db.execute(query)
+    try:
+        query = apply_keyset(query, UsageLog, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not cursor and page > 1:
+        query = query.offset((page - 1) * page_size)
+    result = await db.execute(query.limit(page_size))
+    rows = result.all()
     
     errors = [
         {
@@ -1255,16 +1279,18 @@ async def get_error_stats(
             "client_ip": row.UsageLog.client_ip,
             "created_at": row.UsageLog.created_at.isoformat() + "Z" if row.UsageLog.created_at else None
         }
-        for row in result.all()
+        for row in rows
     ]
     
     return {
         "error_by_code": error_by_code,
         "errors": errors,
         "total": total,
+        "total_is_estimate": total_is_estimate,
         "page": page,
         "page_size": page_size,
-        "total_pages": (total + page_size - 1) // page_size
+        "total_pages": (total + page_size - 1) // page_size,
+        "next_cursor": next_cursor_for(rows, page_size)
     }
 
 
@@ -1281,19 +1307,27 @@ async def get_openai_endpoints(
     )
     endpoints = result.scalars().all()
 
-    return [{
-        "id": ep.id,
-        "name": ep.name,
-        "api_key": ep.api_key,
-        "base_url": ep.base_url,
-        "is_active": ep.is_active,
-        "priority": ep.priority,
-        "total_requests": ep.total_requests,
-        "failed_requests": ep.failed_requests,
-        "last_used_at": ep.last_used_at.isoformat() if ep.last_used_at else None,
-        "last_error": ep.last_error,
-        "created_at": ep.created_at.isoformat(),
-    } for ep in endpoints]
+    endpoint_list = []
+    for ep in endpoints:
+        # 叠加本 worker 内存中尚未写入数据库的统计
+        pending = endpoint_registry.pending_stats(ep.id)
+        last_used_at = pending.last_used_at or ep.last_used_at
+        endpoint_list.append({
+            "id": ep.id,
+            "name": ep.name,
+            "api_key": ep.api_key,
+            "base_url": ep.base_url,
+            "is_active": ep.is_active,
+            "priority": ep.priority,
+            "weight": ep.weight if ep.weight is not None else 1,
+            "max_concurrency": ep.max_concurrency or 0,
+            "total_requests": (ep.total_requests or 0) + pending.total,
+            "failed_requests": (ep.failed_requests or 0) + pending.failed,
+            "last_used_at": last_used_at.isoformat() if last_used_at else None,
+            "last_error": pending.last_error or ep.last_error,
+            "created_at": ep.created_at.isoformat(),
+        })
+    return endpoint_list
 
 
 @router.post("/openai-endpoints")
@@ -1303,6 +1337,8 @@ async def create_openai_endpoint(
     base_url: str = Form(...),
     is_active: bool = Form(True),
     priority: int = Form(0),
+    weight: int = Form(1),
+    max_concurrency: int = Form(0),
     user: User = Depends(get_current_admin),
     db: AsyncSession = Depends(get_db)
 ):
@@ -1312,11 +1348,15 @@ async def create_openai_endpoint(
         api_key=api_key,
         base_url=base_url.rstrip('/'),  # 移除末尾斜杠
         is_active=is_active,
-        priority=priority
+        priority=priority,
+        weight=max(weight, 1),
+        max_concurrency=max(max_concurrency, 0)
     )
     db.add(endpoint)
     await db.commit()
     await db.refresh(endpoint)
+    invalidate_endpoint_registry()
+    invalidate_model_catalog()
 
     return {
         "message": "OpenAI 端点创建成功",
@@ -1332,6 +1372,8 @@ async def update_openai_endpoint(
     base_url: Optional[str] = Form(None),
     is_active: Optional[bool] = Form(None),
     priority: Optional[int] = Form(None),
+    weight: Optional[int] = Form(None),
+    max_concurrency: Optional[int] = Form(None),
     user: User = Depends(get_current_admin),
     db: AsyncSession = Depends(get_db)
 ):
@@ -1354,8 +1396,14 @@ async def update_openai_endpoint(
         endpoint.is_active = is_active
     if priority is not None:
         endpoint.priority = priority
+    if weight is not None:
+        endpoint.weight = max(weight, 1)
+    if max_concurrency is not None:
+        endpoint.max_concurrency = max(max_concurrency, 0)
 
     await db.commit()
+    invalidate_endpoint_registry()
+    invalidate_model_catalog()
 
     return {"message": "端点更新成功"}
 
@@ -1377,6 +1425,8 @@ async def delete_openai_endpoint(
 
     await db.delete(endpoint)
     await db.commit()
+    invalidate_endpoint_registry()
+    invalidate_model_catalog()
 
     return {"message": "端点删除成功"}
 
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+import hmac
+
+from app.config import settings
+from app.services.metrics import registry
+
+router = APIRouter(tags=["监控指标"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request):
+    """Prometheus 格式的运行指标（需携带 METRICS_TOKEN；未配置时只有开启 METRICS_PUBLIC 才可匿名访问）"""
+    if settings.metrics_token:
+        auth_header = request.headers.get("Authorization", "")
+        token = auth_header[7:] if auth_header.startswith("Bearer ") else ""
+        if not hmac.compare_digest(token, settings.metrics_token):
+            raise HTTPException(status_code=401, detail="无效的监控 Token")
+    elif not settings.metrics_public:
+        raise HTTPException(status_code=403, detail="未配置 METRICS_TOKEN，/metrics 已禁用")
+
+    return PlainTextResponse(
+        registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,30 +1,43 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, or_, and_
-from datetime import date, datetime, timedelta
-from typing import Optional
+from sqlalchemy import select, func
+from datetime import datetime
+from typing import Callable, List, Optional
 import json
 import time
 
 from app.database import get_db, async_session
-from app.models.user import User, UsageLog, OpenAIEndpoint
+from app.models.user import User, UsageLog
 from app.services.auth import get_user_by_api_key
 from app.services.websocket import notify_log_update, notify_stats_update
-from app.services.error_classifier import classify_error_simple, ErrorType
+from app.services.error_classifier import classify_error_simple
+from app.services.model_catalog import model_catalog
+from app.services.model_router import model_router
+from app.services.endpoint_registry import endpoint_registry
+from app.services.upstream_clients import upstream_clients
+from app.services.rate_limiter import rate_limiter, STREAM_SLOT_STATE
+from app.services.metrics import (
+    AUTH_SECONDS, QUOTA_CHECK_SECONDS, BODY_PARSE_SECONDS, UPSTREAM_TTFB_SECONDS,
+    STREAM_DURATION_SECONDS, LOG_WRITE_SECONDS, FALLBACKS_TOTAL, ENDPOINT_ERRORS_TOTAL,
+    ACTIVE_STREAMS, UpstreamTrace
+)
 from app.config import settings
-from app.utils.logger import log_info, log_warning, log_error, log_credential_usage
+from app.utils.logger import log_info, log_warning, log_error
+from app.services.request_capture import capture_store
+from app.services.usage_accounting import SSEUsageTracker, apply_usage, usage_accounting
+from app.services.token_quota import token_quota, quota_window_start, QUOTA_RESERVATION_STATE, current_reservation
+from app.services.response_cache import response_cache, StreamRecorder, iter_stream_chunks, replay_stream
+from app.services.single_flight import single_flight, StreamFanOut
+from app.services.prefix_affinity import prefix_fingerprint
+from app.services.admission import admission, ADMISSION_STATE
+from app.services.shutdown import shutdown_coordinator
+from app.utils.streaming import ClosingStreamingResponse
 import re
 import httpx
 
 router = APIRouter(tags=["API代理"])
 
-# 模型列表缓存（5分钟过期）
-_models_cache = {}
-_models_cache_time = {}
-MODELS_CACHE_TTL = 300  # 5分钟
-
-
 def extract_status_code(error_str: str, default: int = 500) -> int:
     """从错误信息中提取HTTP状态码"""
     # 匹配 "API Error 403" 或 "code": 403 或 status_code=403 等模式
@@ -69,7 +82,8 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
         log_warning("Auth", "未提供API Key")
         raise HTTPException(status_code=401, detail="未提供API Key")
 
-    user = await get_user_by_api_key(db, api_key)
+    with AUTH_SECONDS.time():
+        user = await get_user_by_api_key(db, api_key)
     if not user:
         log_warning("Auth", f"无效的API Key: {api_key[:10]}...")
         raise HTTPException(status_code=401, detail="无效的API Key")
@@ -84,29 +98,45 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
 
     # 检查配额
     # 配额在北京时间 15:00 (UTC 07:00) 重置
-    now = datetime.utcnow()
-    reset_time_utc = now.replace(hour=7, minute=0, second=0, microsecond=0)
-    if now < reset_time_utc:
-        start_of_day = reset_time_utc - timedelta(days=1)
-    else:
-        start_of_day = reset_time_utc
+    start_of_day = quota_window_start()
 
     # 获取请求的模型
+    parse_start = time.perf_counter()
     body = await request.json()
     model = body.get("model", "gemini-2.5-flash")
+    BODY_PARSE_SECONDS.observe(time.perf_counter() - parse_start, model=model)
+
+    log_info("Auth", "User: %s, Model: %s, Quota: %s", user.username, model, user.daily_quota)
 
-    log_info("Auth", f"User: {user.username}, Model: {model}, Quota: {user.daily_quota}")
+    # 速率限制（内存 GCRA + 并发流），超限直接 429 + Retry-After
+    is_stream = body.get("stream") is True or request.url.path.endswith(":streamGenerateContent")
+    stream_user = rate_limiter.check(user, api_key, is_stream)
+    if stream_user is not None:
+        # 响应（含流式传输）结束后由 RateLimitReleaseMiddleware 释放
+        setattr(request.state, STREAM_SLOT_STATE, stream_user)
 
     # 所有用户都可以使用所有模型，不再检查凭证等级限制
-    # 只通过次数配额来限制使用
+    # token 模式：按估算的加权 token 预留，响应结束后由 RateLimitReleaseMiddleware 核对
+    if token_quota.enabled:
+        with QUOTA_CHECK_SECONDS.time(model=model):
+            reservation = await token_quota.reserve(db, user, model, body, start_of_day)
+        setattr(request.state, QUOTA_RESERVATION_STATE, reservation)
+        log_info("Auth", "验证通过: %s, 预计 token: %s", user.username, int(reservation.estimate))
+        return user
+
+    # 次数模式：只通过次数配额来限制使用
 
     # 检查今日总使用次数(只统计成功的请求,status_code=200)
-    total_usage_result = await db.execute(
+    query = (
         select(func.count(UsageLog.id))
         .where(UsageLog.user_id == user.id)
         .where(UsageLog.created_at >= start_of_day)
         .where(UsageLog.status_code == 200)
     )
+    if settings.response_cache_hit_quota == "free":
+        query = query.where(UsageLog.cache_hit.isnot(True))
+    with QUOTA_CHECK_SECONDS.time(model=model):
+        total_usage_result = await db.execute(query)
     current_usage = total_usage_result.scalar() or 0
 
     # 检查是否超过配额
@@ -117,10 +147,190 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
             detail=f"已达到每日配额限制 ({current_usage}/{user.daily_quota})"
         )
 
-    log_info("Auth", f"验证通过: {user.username}, 已用: {current_usage}/{user.daily_quota}")
+    log_info("Auth", "验证通过: %s, 已用: %s/%s", user.username, current_usage, user.daily_quota)
     return user
 
 
+# ===== OpenAI 端点并发名额 =====
+
+def _release_once(endpoint) -> Callable[[], None]:
+    """流式响应的名额释放：生成器 finally 和响应发送结束时都会调用，只释放一次"""
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            endpoint_registry.release(endpoint)
+
+    return release
+
+
+# ===== 响应缓存 =====
+
+async def serve_cached_response(request: Request, user: User, db: AsyncSession, model: str,
+                                endpoint: str, content: bytes, start_time: float,
+                                stream: bool = False) -> Response:
+    """
+    返回缓存的响应并记录 cache_hit 日志（是否计入配额见 response_cache_hit_quota）
+
+    stream=True 时 content 为记录的 SSE 流，按原分块重放
+    """
+    tracker = None
+    if stream:
+        tracker = SSEUsageTracker()
+        for _, chunk in iter_stream_chunks(content):
+            tracker.feed(chunk)
+    log = UsageLog(
+        user_id=user.id,
+        model=model,
+        endpoint=f"{endpoint} (cache)",
+        status_code=200,
+        latency_ms=round((time.time() - start_time) * 1000, 1),
+        client_ip=request.client.host if request.client else "unknown",
+        user_agent=request.headers.get("User-Agent", "")[:500],
+        cache_hit=True,
+        response_bytes=tracker.response_bytes if tracker is not None else len(content),
+    )
+    if settings.response_cache_hit_quota == "count":
+        if tracker is not None:
+            tracker.apply(log)
+        else:
+            try:
+                apply_usage(log, json.loads(content))
+            except ValueError:
+                pass
+    else:
+        log.quota_cost = token_quota.settle(current_reservation.get(), 0, 0)
+    db.add(log)
+    await db.commit()
+    log_info("Cache", "响应缓存命中: 用户=%s, 模型=%s, 流式=%s", user.username, model, stream)
+    if stream:
+        return StreamingResponse(replay_stream(content), media_type="text/event-stream", headers={"X-Cache": "HIT"})
+    return Response(content=content, media_type="application/json", headers={"X-Cache": "HIT"})
+
+
+# ===== 相同请求合并 =====
+
+async def _follow_stream(iterator, tracker: SSEUsageTracker):
+    try:
+        async for chunk in iterator:
+            tracker.feed(chunk)
+            yield chunk
+    except BaseException:
+        # 客户端断开或关闭时中断：日志状态码改为 499
+        usage_accounting.finish_stream(tracker, interrupted=True)
+        raise
+    finally:
+        usage_accounting.finish_stream(tracker)
+
+
+async def coalesce_request(request: Request, user: User, db: AsyncSession, model: str, endpoint: str,
+                           key: str, forward, start_time: float) -> Response:
+    """
+    合并进行中的相同请求：第一个请求调用 forward 转发，其余请求共享其结果
+
+    共享结果的请求单独记录使用日志（endpoint 带 "(coalesced)"），按各自的调用计入配额
+    """
+    leader, future = single_flight.claim(key)
+    if leader:
+        return await single_flight.lead(key, future, forward)
+    shared = await single_flight.follow(future)
+    if shared is None:
+        return await forward()
+
+    log_info("SingleFlight", "合并相同请求: 用户=%s, 模型=%s", user.username, model)
+    log = UsageLog(
+        user_id=user.id,
+        model=model,
+        endpoint=f"{endpoint} (coalesced)",
+        status_code=200,
+        latency_ms=round((time.time() - start_time) * 1000, 1),
+        client_ip=request.client.host if request.client else "unknown",
+        user_agent=request.headers.get("User-Agent", "")[:500],
+    )
+    if isinstance(shared, StreamFanOut):
+        tracker = SSEUsageTracker()
+        db.add(log)
+        await db.commit()
+        usage_accounting.bind(tracker, log)
+        subscription = shared.subscribe()
+
+        def close():
+            subscription.close()
+            # 正常结束时 _follow_stream 已记录，这里只处理从未被迭代的响应
+            usage_accounting.finish_stream(tracker, interrupted=True)
+
+        return ClosingStreamingResponse(
+            _follow_stream(subscription, tracker), close,
+            status_code=shared.status_code, headers={**shared.headers, "X-Coalesced": "1"},
+        )
+
+    try:
+        apply_usage(log, json.loads(shared), len(shared))
+    except ValueError:
+        log.response_bytes = len(shared)
+    db.add(log)
+    await db.commit()
+    return Response(content=shared, media_type="application/json", headers={"X-Coalesced": "1"})
+
+
+# ===== 中断的流式响应 =====
+
+async def record_interrupted_stream(user: User, model: str, start_time: float, client_ip: str,
+                                    user_agent: str, body: dict, tracker: SSEUsageTracker):
+    """
+    OpenAI 端点的流式响应在结束前被中断（客户端断开、关闭时排空超时）时，
+    按已转发的部分记录状态码 499 的日志（成功日志只在流正常结束后写入）
+    """
+    try:
+        async with async_session() as log_db:
+            log = UsageLog(
+                user_id=user.id,
+                model=model,
+                endpoint="/v1/chat/completions",
+                status_code=499,
+                latency_ms=round((time.time() - start_time) * 1000, 1),
+                error_message="流式响应被中断",
+                client_ip=client_ip,
+                user_agent=user_agent
+            )
+            tracker.apply(log)
+            capture_store.attach(log, body)
+            log_db.add(log)
+            await log_db.commit()
+    except Exception as e:
+        log_error("OpenAI Stream", f"中断日志记录失败: {e}")
+
+
+# ===== 上游准入 =====
+
+async def admit_upstream(request: Request, user: User, db: AsyncSession, pool: str):
+    """
+    转发前获取上游的在途名额（名额用完时公平排队，超时 503）
+
+    名额在响应（含流式传输）结束后由 RateLimitReleaseMiddleware 释放
+    """
+    if not admission.enabled:
+        return
+    # 排队期间不占用数据库连接：结束鉴权查询开启的事务
+    if db.in_transaction():
+        await db.commit()
+    if await admission.acquire(pool, user):
+        setattr(request.state, ADMISSION_STATE, pool)
+
+
+def endpoint_plan(model: str) -> List[str]:
+    """顺序轮询要尝试的端点：端点优先级（从配置读取）中跳过模型路由表里不支持该模型的端点"""
+    endpoint_priority = getattr(settings, 'endpoint_priority', ['gcli2api', 'antigravity', 'openai'])
+    return model_router.plan(model, endpoint_priority)
+
+
+def admission_pool(plan: List[str]) -> str:
+    """顺序轮询时请求首先发往的端点"""
+    return plan[0] if plan else "gcli2api"
+
+
 # ===== 三端点顺序轮询逻辑 =====
 
 async def sequential_request_fallback(
@@ -129,7 +339,9 @@ async def sequential_request_fallback(
     db: AsyncSession,
     client_ip: str,
     user_agent: str,
-    start_time: float
+    start_time: float,
+    stream_recorder: Optional[StreamRecorder] = None,
+    plan: Optional[List[str]] = None
 ):
     """
     顺序轮询三个端点，失败后尝试下一个
@@ -141,6 +353,8 @@ async def sequential_request_fallback(
         client_ip: 客户端 IP
         user_agent: User Agent
         start_time: 请求开始时间
+        stream_recorder: 响应缓存的流记录（仅 gcli2api 流式转发）
+        plan: 已计算的 endpoint_plan(model)，未传入时在此计算
 
     Returns:
         响应对象（JSONResponse 或 StreamingResponse）
@@ -150,25 +364,29 @@ async def sequential_request_fallback(
     model = body.get("model", "gemini-2.5-flash")
     stream = body.get("stream", False)
 
-    # 定义端点优先级（从配置读取）
-    endpoint_priority = getattr(settings, 'endpoint_priority', ['gcli2api', 'antigravity', 'openai'])
+    endpoint_priority = endpoint_plan(model) if plan is None else plan
+    if not endpoint_priority:
+        raise HTTPException(status_code=404, detail=f"没有可用端点支持模型: {model}")
 
     last_error = None
     last_status_code = 500
 
     for endpoint_name in endpoint_priority:
         try:
-            log_info("Sequential", f"尝试端点: {endpoint_name}, 模型: {model}")
+            log_info("Sequential", "尝试端点: %s, 模型: %s", endpoint_name, model)
 
             # ========== 端点 1: GeminiCLI (gcli2api) ==========
             if endpoint_name == "gcli2api" and settings.enable_gcli2api_bridge:
                 bridge_path = "/v1/chat/completions"
                 bridge_endpoint_name = "/v1/chat/completions (gcli2api)"
 
+                tracker = SSEUsageTracker() if stream else None
                 if stream:
                     response = await gcli2api_bridge.forward_stream(
                         path=bridge_path,
-                        json_data=body
+                        json_data=body,
+                        usage_tracker=tracker,
+                        stream_recorder=stream_recorder
                     )
                 else:
                     result = await gcli2api_bridge.forward_request(
@@ -188,8 +406,14 @@ async def sequential_request_fallback(
                     client_ip=client_ip,
                     user_agent=user_agent
                 )
-                db.add(log)
-                await db.commit()
+                if not stream:
+                    apply_usage(log, result, len(response.body))
+                with LOG_WRITE_SECONDS.time(endpoint_name=endpoint_name, model=model):
+                    capture_store.attach(log, body)
+                    db.add(log)
+                    await db.commit()
+                if stream:
+                    usage_accounting.bind(tracker, log)
 
                 if not stream:
                     await notify_log_update({
@@ -202,7 +426,7 @@ async def sequential_request_fallback(
                     })
                     await notify_stats_update()
 
-                log_info("Sequential", f"端点 {endpoint_name} 成功")
+                log_info("Sequential", "端点 %s 成功", endpoint_name)
                 return response
 
             # ========== 端点 2: Antigravity (gcli2api) ==========
@@ -210,10 +434,13 @@ async def sequential_request_fallback(
                 bridge_path = "/antigravity/v1/chat/completions"
                 bridge_endpoint_name = "/antigravity/v1/chat/completions (gcli2api)"
 
+                tracker = SSEUsageTracker() if stream else None
                 if stream:
                     response = await gcli2api_bridge.forward_stream(
                         path=bridge_path,
-                        json_data=body
+                        json_data=body,
+                        usage_tracker=tracker,
+                        stream_recorder=stream_recorder
                     )
                 else:
                     result = await gcli2api_bridge.forward_request(
@@ -233,8 +460,14 @@ async def sequential_request_fallback(
                     client_ip=client_ip,
                     user_agent=user_agent
                 )
-                db.add(log)
-                await db.commit()
+                if not stream:
+                    apply_usage(log, result, len(response.body))
+                with LOG_WRITE_SECONDS.time(endpoint_name=endpoint_name, model=model):
+                    capture_store.attach(log, body)
+                    db.add(log)
+                    await db.commit()
+                if stream:
+                    usage_accounting.bind(tracker, log)
 
                 if not stream:
                     await notify_log_update({
@@ -247,21 +480,17 @@ async def sequential_request_fallback(
                     })
                     await notify_stats_update()
 
-                log_info("Sequential", f"端点 {endpoint_name} 成功")
+                log_info("Sequential", "端点 %s 成功", endpoint_name)
                 return response
 
             # ========== 端点 3: OpenAI 端点 ==========
             elif endpoint_name == "openai":
-                # 获取可用的 OpenAI 端点
-                result = await db.execute(
-                    select(OpenAIEndpoint)
-                    .where(OpenAIEndpoint.is_active == True)
-                    .order_by(OpenAIEndpoint.priority.desc(), OpenAIEndpoint.id)
-                )
-                endpoints = result.scalars().all()
+                # 获取可用的 OpenAI 端点（内存注册表）
+                endpoints = await endpoint_registry.get_active()
 
                 if not endpoints:
                     log_warning("Sequential", "没有可用的 OpenAI 端点")
+                    FALLBACKS_TOTAL.inc(endpoint_name=endpoint_name, model=model)
                     continue
 
                 # 尝试 OpenAI 端点（内部也会轮询）
@@ -279,6 +508,8 @@ async def sequential_request_fallback(
             last_error = e.detail
             last_status_code = e.status_code
             log_warning("Sequential", f"端点 {endpoint_name} 失败: {last_error}")
+            ENDPOINT_ERRORS_TOTAL.inc(endpoint_name=endpoint_name, status_code=last_status_code)
+            FALLBACKS_TOTAL.inc(endpoint_name=endpoint_name, model=model)
 
             # 记录失败日志
             try:
@@ -288,12 +519,14 @@ async def sequential_request_fallback(
                     endpoint=f"{endpoint_name} (failed)",
                     status_code=last_status_code,
                     latency_ms=round((time.time() - start_time) * 1000, 1),
-                    error_message=str(last_error)[:2000],
+                    error_message=str(last_error),
                     client_ip=client_ip,
                     user_agent=user_agent
                 )
-                db.add(log)
-                await db.commit()
+                with LOG_WRITE_SECONDS.time(endpoint_name=endpoint_name, model=model):
+                    capture_store.attach(log, body)
+                    db.add(log)
+                    await db.commit()
             except:
                 pass
 
@@ -303,6 +536,8 @@ async def sequential_request_fallback(
             last_error = str(e)
             last_status_code = extract_status_code(last_error, 500)
             log_error("Sequential", f"端点 {endpoint_name} 异常: {last_error}")
+            ENDPOINT_ERRORS_TOTAL.inc(endpoint_name=endpoint_name, status_code=last_status_code)
+            FALLBACKS_TOTAL.inc(endpoint_name=endpoint_name, model=model)
 
             # 记录失败日志
             try:
@@ -312,12 +547,14 @@ async def sequential_request_fallback(
                     endpoint=f"{endpoint_name} (error)",
                     status_code=last_status_code,
                     latency_ms=round((time.time() - start_time) * 1000, 1),
-                    error_message=str(last_error)[:2000],
+                    error_message=str(last_error),
                     client_ip=client_ip,
                     user_agent=user_agent
                 )
-                db.add(log)
-                await db.commit()
+                with LOG_WRITE_SECONDS.time(endpoint_name=endpoint_name, model=model):
+                    capture_store.attach(log, body)
+                    db.add(log)
+                    await db.commit()
             except:
                 pass
 
@@ -341,20 +578,26 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
     model = body.get("model", "")
     stream = body.get("stream", False)
 
-    # 获取可用的 OpenAI 端点（按优先级排序，只选择启用的）
-    result = await db.execute(
-        select(OpenAIEndpoint)
-        .where(OpenAIEndpoint.is_active == True)
-        .order_by(OpenAIEndpoint.priority.desc(), OpenAIEndpoint.id)
+    # 获取可用的 OpenAI 端点（按优先级排序，只选择启用的；内存注册表，不查库）
+    # 同优先级内按负载均衡重新排序；有长前缀时改为按前缀亲和排序（命中上游上下文缓存）
+    fingerprint = prefix_fingerprint(body)
+    active = await endpoint_registry.get_active()
+    endpoints = model_router.openai_candidates(
+        model,
+        endpoint_registry.affinity(active, fingerprint) if fingerprint else endpoint_registry.balance(active)
     )
-    endpoints = result.scalars().all()
 
     if not endpoints:
         raise HTTPException(status_code=503, detail="没有可用的 OpenAI 端点，请联系管理员配置")
 
     # 尝试每个端点
     last_error = None
+    saturated = 0
     for endpoint in endpoints:
+        if not endpoint_registry.has_capacity(endpoint):
+            # 已达并发上限，交给下一个端点
+            saturated += 1
+            continue
         try:
             # 构建请求
             headers = {
@@ -363,51 +606,62 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
             }
 
             url = f"{endpoint.base_url}/chat/completions"
+            metric_labels = {"endpoint_name": f"openai:{endpoint.name}", "model": model}
 
             if stream:
+                request_body = body
+                if settings.openai_stream_include_usage:
+                    # 要求上游在最后一块返回用量
+                    request_body = {**body, "stream_options": {**(body.get("stream_options") or {}), "include_usage": True}}
+
                 # 流式响应 - 不能在 async with 中使用，需要在外部管理客户端
+                # 返回响应前占用名额，流结束（或响应从未发送）时释放
+                endpoint_registry.acquire(endpoint)
+                release_slot = _release_once(endpoint)
+
                 async def stream_generator():
-                    client = httpx.AsyncClient(timeout=60.0)
+                    client = upstream_clients.get(endpoint.base_url)
+                    tracker = SSEUsageTracker()
                     log_recorded = False  # 标记是否已记录日志，避免重复记录
                     stream_success = False  # 标记流式传输是否成功完成
+                    stream_start = time.perf_counter()
+                    first_chunk = True
+                    ACTIVE_STREAMS.inc(endpoint_name=metric_labels["endpoint_name"])
                     try:
-                        async with client.stream("POST", url, json=body, headers=headers) as response:
+                        async with client.stream(
+                            "POST", url, json=request_body, headers=headers,
+                            extensions={"trace": UpstreamTrace(**metric_labels)}
+                        ) as response:
                             response.raise_for_status()
 
-                            # 更新端点统计（使用独立会话）
-                            try:
-                                async with async_session() as stats_db:
-                                    from sqlalchemy import update
-                                    await stats_db.execute(
-                                        update(OpenAIEndpoint)
-                                        .where(OpenAIEndpoint.id == endpoint.id)
-                                        .values(
-                                            total_requests=OpenAIEndpoint.total_requests + 1,
-                                            last_used_at=datetime.utcnow()
-                                        )
-                                    )
-                                    await stats_db.commit()
-                            except:
-                                pass
+                            # 更新端点统计（内存累加，批量写入）
+                            endpoint_registry.record_success(endpoint.id)
 
                             # 流式传输数据
                             async for chunk in response.aiter_bytes():
+                                if first_chunk:
+                                    UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - stream_start, **metric_labels)
+                                    first_chunk = False
+                                tracker.feed(chunk)
                                 yield chunk
 
                             # 流式传输成功完成，记录成功日志
                             try:
-                                async with async_session() as log_db:
-                                    log = UsageLog(
-                                        user_id=user.id,
-                                        model=model,
-                                        endpoint="/v1/chat/completions",
-                                        status_code=200,
-                                        latency_ms=round((time.time() - start_time) * 1000, 1),
-                                        client_ip=client_ip,
-                                        user_agent=user_agent
-                                    )
-                                    log_db.add(log)
-                                    await log_db.commit()
+                                with LOG_WRITE_SECONDS.time(**metric_labels):
+                                    async with async_session() as log_db:
+                                        log = UsageLog(
+                                            user_id=user.id,
+                                            model=model,
+                                            endpoint="/v1/chat/completions",
+                                            status_code=200,
+                                            latency_ms=round((time.time() - start_time) * 1000, 1),
+                                            client_ip=client_ip,
+                                            user_agent=user_agent
+                                        )
+                                        tracker.apply(log)
+                                        capture_store.attach(log, body)
+                                        log_db.add(log)
+                                        await log_db.commit()
                                 log_recorded = True
                                 stream_success = True
                             except Exception as log_err:
@@ -422,44 +676,47 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
                         else:
                             # 从错误信息中提取状态码
                             actual_status_code = extract_status_code(error_msg, 500)
+                        ENDPOINT_ERRORS_TOTAL.inc(
+                            endpoint_name=metric_labels["endpoint_name"], status_code=actual_status_code
+                        )
 
                         # 只有在未记录成功日志时才记录错误日志
                         if not log_recorded and not stream_success:
+                            endpoint_registry.record_failure(endpoint.id, error_msg)
                             try:
                                 async with async_session() as err_db:
-                                    from sqlalchemy import update
-                                    await err_db.execute(
-                                        update(OpenAIEndpoint)
-                                        .where(OpenAIEndpoint.id == endpoint.id)
-                                        .values(
-                                            failed_requests=OpenAIEndpoint.failed_requests + 1,
-                                            last_error=error_msg[:500]
-                                        )
-                                    )
                                     log = UsageLog(
                                         user_id=user.id,
                                         model=model,
                                         endpoint="/v1/chat/completions",
                                         status_code=actual_status_code,
                                         latency_ms=round((time.time() - start_time) * 1000, 1),
-                                        error_message=error_msg[:2000],
+                                        error_message=error_msg,
                                         client_ip=client_ip,
                                         user_agent=user_agent
                                     )
+                                    capture_store.attach(log, body)
                                     err_db.add(log)
                                     await err_db.commit()
                             except Exception as log_err:
                                 log_error("OpenAI Stream", f"错误日志记录失败: {log_err}")
                         # 向客户端发送错误信息
                         yield f"data: {json.dumps({'error': error_msg})}\n\n".encode()
+                    except BaseException:
+                        # 客户端断开或关闭时中断（CancelledError / GeneratorExit）：在后台记录日志，关闭前等待写入
+                        if not log_recorded:
+                            shutdown_coordinator.defer(record_interrupted_stream(
+                                user, model, start_time, client_ip, user_agent, body, tracker
+                            ))
+                        raise
                     finally:
-                        try:
-                            await client.aclose()
-                        except:
-                            pass
+                        release_slot()
+                        ACTIVE_STREAMS.dec(endpoint_name=metric_labels["endpoint_name"])
+                        STREAM_DURATION_SECONDS.observe(time.perf_counter() - stream_start, **metric_labels)
 
-                return StreamingResponse(
+                return ClosingStreamingResponse(
                     stream_generator(),
+                    release_slot,
                     media_type="text/event-stream",
                     headers={
                         "Cache-Control": "no-cache",
@@ -467,47 +724,56 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
                     }
                 )
             else:
-                # 非流式响应
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    response = await client.post(url, json=body, headers=headers)
-                    response.raise_for_status()
-
-                    # 更新端点统计
-                    endpoint.total_requests = (endpoint.total_requests or 0) + 1
-                    endpoint.last_used_at = datetime.utcnow()
-                    await db.commit()
-
-                    response_data = response.json()
-
-                    # 记录日志
-                    log = UsageLog(
-                        user_id=user.id,
-                        model=model,
-                        endpoint="/v1/chat/completions",
-                        status_code=200,
-                        latency_ms=round((time.time() - start_time) * 1000, 1),
-                        client_ip=client_ip,
-                        user_agent=user_agent
+                # 非流式响应（复用该端点的长连接客户端）
+                client = upstream_clients.get(endpoint.base_url)
+                request_start = time.perf_counter()
+                endpoint_registry.acquire(endpoint)
+                try:
+                    response = await client.post(
+                        url, json=body, headers=headers,
+                        extensions={"trace": UpstreamTrace(**metric_labels)}
                     )
+                finally:
+                    endpoint_registry.release(endpoint)
+                UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - request_start, **metric_labels)
+                response.raise_for_status()
+
+                # 更新端点统计
+                endpoint_registry.record_success(endpoint.id)
+
+                response_data = response.json()
+
+                # 记录日志
+                log = UsageLog(
+                    user_id=user.id,
+                    model=model,
+                    endpoint="/v1/chat/completions",
+                    status_code=200,
+                    latency_ms=round((time.time() - start_time) * 1000, 1),
+                    client_ip=client_ip,
+                    user_agent=user_agent
+                )
+                apply_usage(log, response_data, len(response.content))
+                with LOG_WRITE_SECONDS.time(**metric_labels):
+                    capture_store.attach(log, body)
                     db.add(log)
                     await db.commit()
 
-                    await notify_log_update({
-                        "username": user.username,
-                        "model": model,
-                        "status_code": 200,
-                        "latency_ms": round((time.time() - start_time) * 1000, 1),
-                        "created_at": datetime.utcnow().isoformat()
-                    })
-                    await notify_stats_update()
+                await notify_log_update({
+                    "username": user.username,
+                    "model": model,
+                    "status_code": 200,
+                    "latency_ms": round((time.time() - start_time) * 1000, 1),
+                    "created_at": datetime.utcnow().isoformat()
+                })
+                await notify_stats_update()
 
-                    return JSONResponse(content=response_data)
+                return JSONResponse(content=response_data)
 
         except httpx.HTTPStatusError as e:
             last_error = f"{endpoint.name}: HTTP {e.response.status_code} - {e.response.text}"
-            endpoint.failed_requests = (endpoint.failed_requests or 0) + 1
-            endpoint.last_error = last_error[:500]
-            await db.commit()
+            ENDPOINT_ERRORS_TOTAL.inc(endpoint_name=f"openai:{endpoint.name}", status_code=e.response.status_code)
+            endpoint_registry.record_failure(endpoint.id, last_error)
 
             # 记录错误日志
             log = UsageLog(
@@ -516,10 +782,11 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
                 endpoint="/v1/chat/completions",
                 status_code=e.response.status_code,
                 latency_ms=round((time.time() - start_time) * 1000, 1),
-                error_message=last_error[:2000],
+                error_message=last_error,
                 client_ip=client_ip,
                 user_agent=user_agent
             )
+            capture_store.attach(log, body)
             db.add(log)
             await db.commit()
 
@@ -530,10 +797,9 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
             last_error = f"{endpoint.name}: {str(e)}"
             # 尝试从异常中提取状态码
             actual_status_code = extract_status_code(str(e), 500)
+            ENDPOINT_ERRORS_TOTAL.inc(endpoint_name=f"openai:{endpoint.name}", status_code=actual_status_code)
 
-            endpoint.failed_requests = (endpoint.failed_requests or 0) + 1
-            endpoint.last_error = last_error[:500]
-            await db.commit()
+            endpoint_registry.record_failure(endpoint.id, last_error)
 
             # 记录错误日志
             log = UsageLog(
@@ -542,10 +808,11 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
                 endpoint="/v1/chat/completions",
                 status_code=actual_status_code,
                 latency_ms=round((time.time() - start_time) * 1000, 1),
-                error_message=last_error[:2000],
+                error_message=last_error,
                 client_ip=client_ip,
                 user_agent=user_agent
             )
+            capture_store.attach(log, body)
             db.add(log)
             await db.commit()
 
@@ -553,6 +820,8 @@ async def handle_openai_endpoint(request: Request, user: User, db: AsyncSession,
             continue
 
     # 所有端点都失败了
+    if saturated == len(endpoints):
+        raise HTTPException(status_code=503, detail="所有 OpenAI 端点都已达到并发上限，请稍后重试")
     raise HTTPException(status_code=503, detail=f"所有 OpenAI 端点都失败了。最后错误: {last_error}")
 
 
@@ -568,115 +837,13 @@ async def options_handler():
 
 
 @router.get("/v1/models")
-async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """列出可用模型 (OpenAI兼容) - 统一端点，自动轮询三个端点"""
-
-    # ========== Gemini 模型（无前缀，自动轮询）==========
-    # 基础模型 (包含 2.5 和 3.0)
-    base_models = [
-        "gemini-2.5-pro",
-        "gemini-2.5-flash",
-        "gemini-3-pro-preview",
-        "gemini-3-flash-preview",
-    ]
-
-    # Thinking 后缀
-    thinking_suffixes = ["-maxthinking", "-nothinking"]
-    # Search 后缀
-    search_suffix = "-search"
-
-    models = []
-    for base in base_models:
-        # 基础模型
-        models.append({"id": base, "object": "model", "owned_by": "google"})
-
-        # thinking 变体
-        for suffix in thinking_suffixes:
-            models.append({"id": f"{base}{suffix}", "object": "model", "owned_by": "google"})
-
-        # search 变体
-        models.append({"id": f"{base}{search_suffix}", "object": "model", "owned_by": "google"})
-
-        # thinking + search 组合
-        for suffix in thinking_suffixes:
-            combined = f"{suffix}{search_suffix}"
-            models.append({"id": f"{base}{combined}", "object": "model", "owned_by": "google"})
-
-    # Image 模型
-    models.append({"id": "gemini-2.5-flash-image", "object": "model", "owned_by": "google"})
-
-    # Antigravity 特有模型（无前缀）
-    antigravity_models = [
-        "gemini-3-pro-low",
-        "gemini-3-pro-high",
-        "gemini-3-pro-image",
-        "gemini-2.5-flash-lite",
-    ]
-    for model_id in antigravity_models:
-        models.append({"id": model_id, "object": "model", "owned_by": "google"})
-
-    # ========== Claude 模型（无前缀，自动轮询）==========
-    claude_models = [
-        "claude-sonnet-4-5",
-        "claude-sonnet-4-5-thinking",
-        "claude-opus-4-5-thinking",
-    ]
-    for model_id in claude_models:
-        models.append({"id": model_id, "object": "model", "owned_by": "anthropic"})
-
-    # ========== OpenAI 兼容端点的模型 ==========
-    # 获取所有启用的 OpenAI 端点
-    openai_endpoints_result = await db.execute(
-        select(OpenAIEndpoint)
-        .where(OpenAIEndpoint.is_active == True)
-        .order_by(OpenAIEndpoint.priority.desc())
-    )
-    openai_endpoints = openai_endpoints_result.scalars().all()
-
-    # 从每个端点获取模型列表（带缓存）
-    current_time = time.time()
-    for endpoint in openai_endpoints:
-        cache_key = f"endpoint_{endpoint.id}"
-
-        # 检查缓存
-        if cache_key in _models_cache and cache_key in _models_cache_time:
-            if current_time - _models_cache_time[cache_key] < MODELS_CACHE_TTL:
-                # 使用缓存
-                models.extend(_models_cache[cache_key])
-                continue
-
-        # 缓存过期或不存在，重新获取
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{endpoint.base_url}/v1/models",
-                    headers={"Authorization": f"Bearer {endpoint.api_key}"}
-                )
-                if response.status_code == 200:
-                    upstream_data = response.json()
-                    endpoint_models = []
-                    # 添加上游模型到列表
-                    if "data" in upstream_data:
-                        for model in upstream_data["data"]:
-                            model_id = model.get("id", "")
-                            if model_id:
-                                model_entry = {
-                                    "id": model_id,
-                                    "object": "model",
-                                    "owned_by": model.get("owned_by", endpoint.name)
-                                }
-                                endpoint_models.append(model_entry)
-
-                    # 更新缓存
-                    _models_cache[cache_key] = endpoint_models
-                    _models_cache_time[cache_key] = current_time
-                    models.extend(endpoint_models)
-        except Exception as e:
-            # 静默失败，不影响其他模型的返回
-            log_warning("Models", f"从 {endpoint.name} 获取模型失败: {str(e)}")
-            continue
-
-    return {"object": "list", "data": models}
+async def list_models(request: Request, user: User = Depends(get_user_from_api_key)):
+    """列出可用模型 (OpenAI兼容) - 内置模型 + 各 OpenAI 端点模型，由模型目录预构建"""
+    body, etag = await model_catalog.get()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.post("/v1/chat/completions")
@@ -701,26 +868,47 @@ async def chat_completions(
         log_error("Proxy", f"请求体读取失败: {e}")
         raise HTTPException(status_code=500, detail="请求处理失败")
 
-    # 保存请求内容摘要（截断到2000字符）
-    request_body_str = json.dumps(body, ensure_ascii=False)[:2000] if body else None
-
     model = body.get("model", "gemini-2.5-flash")
     messages = body.get("messages", [])
 
     if not messages:
         raise HTTPException(status_code=400, detail="messages不能为空")
 
-    log_info("Proxy", f"收到请求: 用户={user.username}, 模型={model}, 流式={body.get('stream', False)}")
+    log_info("Proxy", "收到请求: 用户=%s, 模型=%s, 流式=%s", user.username, model, body.get('stream', False))
+
+    # ========== 响应缓存（确定性请求） ==========
+    stream = body.get("stream") is True
+    cache_key = response_cache.key_for(request, user, "chat", model, body, stream=stream)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return await serve_cached_response(
+                request, user, db, model, "/v1/chat/completions", cached, start_time, stream=stream
+            )
 
     # ========== 使用三端点顺序轮询模式 ==========
-    return await sequential_request_fallback(
-        body=body,
-        user=user,
-        db=db,
-        client_ip=client_ip,
-        user_agent=user_agent,
-        start_time=start_time
-    )
+    async def forward() -> Response:
+        plan = endpoint_plan(model)
+        await admit_upstream(request, user, db, admission_pool(plan))
+        response = await sequential_request_fallback(
+            body=body,
+            user=user,
+            db=db,
+            client_ip=client_ip,
+            user_agent=user_agent,
+            start_time=start_time,
+            stream_recorder=StreamRecorder(cache_key) if stream and cache_key is not None else None,
+            plan=plan
+        )
+        if not stream and cache_key is not None and isinstance(response, JSONResponse) and response.status_code == 200:
+            await response_cache.put(cache_key, response.body)
+        return response
+
+    # ========== 合并进行中的相同请求 ==========
+    flight_key = single_flight.key_for("chat", model, body, stream)
+    if flight_key is not None:
+        return await coalesce_request(request, user, db, model, "/v1/chat/completions", flight_key, forward, start_time)
+    return await forward()
 
 
 # ===== Gemini 原生接口支持 =====
@@ -791,28 +979,50 @@ async def gemini_generate_content(
     if settings.enable_gcli2api_bridge:
         from app.services.gcli2api_bridge import gcli2api_bridge
 
-        log_info("Bridge", f"[gcli2api] Gemini generateContent: {model}")
+        cache_key = response_cache.key_for(request, user, "gemini", model, body)
+        if cache_key is not None:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                return await serve_cached_response(
+                    request, user, db, model, "/v1beta/models:generateContent", cached, start_time
+                )
 
-        result = await gcli2api_bridge.forward_request(
-            path=f"/v1beta/models/{model}:generateContent",
-            method="POST",
-            json_data=body
-        )
+        async def forward() -> Response:
+            await admit_upstream(request, user, db, "gcli2api")
+            log_info("Bridge", "[gcli2api] Gemini generateContent: %s", model)
 
-        # 记录使用日志
-        log = UsageLog(
-            user_id=user.id,
-            model=model,
-            endpoint="/v1beta/models:generateContent (gcli2api)",
-            status_code=200,
-            latency_ms=round((time.time() - start_time) * 1000, 1),
-            client_ip=request.client.host if request.client else "unknown",
-            user_agent=request.headers.get("User-Agent", "")[:500]
-        )
-        db.add(log)
-        await db.commit()
+            result = await gcli2api_bridge.forward_request(
+                path=f"/v1beta/models/{model}:generateContent",
+                method="POST",
+                json_data=body
+            )
 
-        return JSONResponse(content=result)
+            # 记录使用日志
+            log = UsageLog(
+                user_id=user.id,
+                model=model,
+                endpoint="/v1beta/models:generateContent (gcli2api)",
+                status_code=200,
+                latency_ms=round((time.time() - start_time) * 1000, 1),
+                client_ip=request.client.host if request.client else "unknown",
+                user_agent=request.headers.get("User-Agent", "")[:500]
+            )
+            response = JSONResponse(content=result)
+            apply_usage(log, result, len(response.body))
+            capture_store.attach(log, body)
+            db.add(log)
+            await db.commit()
+
+            if cache_key is not None:
+                await response_cache.put(cache_key, response.body)
+            return response
+
+        flight_key = single_flight.key_for("gemini", model, body, False)
+        if flight_key is not None:
+            return await coalesce_request(
+                request, user, db, model, "/v1beta/models:generateContent", flight_key, forward, start_time
+            )
+        return await forward()
     # ========== gcli2api 桥接模式结束 ==========
     # 未启用 gcli2api 桥接
     raise HTTPException(
@@ -851,30 +1061,52 @@ async def gemini_stream_generate_content(
     if settings.enable_gcli2api_bridge:
         from app.services.gcli2api_bridge import gcli2api_bridge
 
-        log_info("Bridge", f"[gcli2api] Gemini streamGenerateContent: {model}")
+        cache_key = response_cache.key_for(request, user, "gemini", model, body, stream=True)
+        if cache_key is not None:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                return await serve_cached_response(
+                    request, user, db, model, "/v1beta/models:streamGenerateContent", cached, start_time, stream=True
+                )
 
-        response = await gcli2api_bridge.forward_stream(
-            path=f"/v1beta/models/{model}:streamGenerateContent",
-            json_data=body
-        )
+        async def forward() -> Response:
+            await admit_upstream(request, user, db, "gcli2api")
+            log_info("Bridge", "[gcli2api] Gemini streamGenerateContent: %s", model)
 
-        # 记录使用日志（异步，不阻塞响应）
-        try:
-            log = UsageLog(
-                user_id=user.id,
-                model=model,
-                endpoint="/v1beta/models:streamGenerateContent (gcli2api)",
-                status_code=200,
-                latency_ms=round((time.time() - start_time) * 1000, 1),
-                client_ip=request.client.host if request.client else "unknown",
-                user_agent=request.headers.get("User-Agent", "")[:500]
+            tracker = SSEUsageTracker()
+            response = await gcli2api_bridge.forward_stream(
+                path=f"/v1beta/models/{model}:streamGenerateContent",
+                json_data=body,
+                usage_tracker=tracker,
+                stream_recorder=StreamRecorder(cache_key) if cache_key is not None else None
             )
-            db.add(log)
-            await db.commit()
-        except Exception as log_err:
-            log_error("Bridge", f"日志记录失败: {log_err}")
 
-        return response
+            # 记录使用日志（异步，不阻塞响应）
+            try:
+                log = UsageLog(
+                    user_id=user.id,
+                    model=model,
+                    endpoint="/v1beta/models:streamGenerateContent (gcli2api)",
+                    status_code=200,
+                    latency_ms=round((time.time() - start_time) * 1000, 1),
+                    client_ip=request.client.host if request.client else "unknown",
+                    user_agent=request.headers.get("User-Agent", "")[:500]
+                )
+                capture_store.attach(log, body)
+                db.add(log)
+                await db.commit()
+                usage_accounting.bind(tracker, log)
+            except Exception as log_err:
+                log_error("Bridge", f"日志记录失败: {log_err}")
+
+            return response
+
+        flight_key = single_flight.key_for("gemini", model, body, True)
+        if flight_key is not None:
+            return await coalesce_request(
+                request, user, db, model, "/v1beta/models:streamGenerateContent", flight_key, forward, start_time
+            )
+        return await forward()
     # ========== gcli2api 桥接模式结束 ==========
     # 未启用 gcli2api 桥接
     raise HTTPException(
@@ -899,20 +1131,7 @@ async def openai_proxy(
     
     start_time = time.time()
     
-    # 检查速率限制 - 管理员豁免
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-    if not user.is_admin:
-        one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
-        rpm_result = await db.execute(
-            select(func.count(UsageLog.id))
-            .where(UsageLog.user_id == user.id)
-            .where(UsageLog.created_at >= one_minute_ago)
-        )
-        current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
-        
-        if current_rpm >= max_rpm:
-            raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
+    # 速率限制已在 get_user_from_api_key 中完成（内存限流器，管理员豁免）
     
     # 构建目标 URL
     target_url = f"{settings.openai_api_base}/{path}"
@@ -948,10 +1167,11 @@ async def openai_proxy(
             endpoint=f"/openai/{path}",
             status_code=status_code,
             latency_ms=latency,
-            error_message=error_msg[:2000] if error_msg else None,
+            error_message=error_msg or None,
             error_type=error_type,
             error_code=error_code
         )
+        capture_store.attach(log, body)
         db.add(log)
         await db.commit()
         await notify_log_update({
@@ -974,7 +1194,7 @@ async def openai_proxy(
             log_warning("OpenAI Proxy", f"流式判断失败: {e}")
             is_stream = False
 
-    log_info("OpenAI Proxy", f"{request.method} {target_url}, stream={is_stream}")
+    log_info("OpenAI Proxy", "%s %s, stream=%s", request.method, target_url, is_stream)
     
     try:
         if is_stream:
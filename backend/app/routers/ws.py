@@ -6,6 +6,7 @@ import asyncio
 from app.database import get_db, async_session
 from app.config import settings
 from app.services.websocket import manager
+from app.services.live_stats import live_stats
 from app.services.auth import get_user_by_username
 
 router = APIRouter(tags=["WebSocket"])
@@ -14,7 +15,8 @@ router = APIRouter(tags=["WebSocket"])
 @router.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
-    token: str = Query(...)
+    token: str = Query(...),
+    subscribe: str = Query("")
 ):
     """WebSocket 连接端点"""
     # 验证 token
@@ -43,12 +45,16 @@ async def websocket_endpoint(
     
     try:
         # 发送连接成功消息
-        await websocket.send_json({
+        await manager.send_to_socket(websocket, {
             "type": "connected",
             "message": "WebSocket 连接成功",
             "user_id": user_id,
             "is_admin": is_admin
         })
+
+        # 连接时即订阅（?subscribe=stats），立即下发统计快照
+        if "stats" in subscribe.split(","):
+            await live_stats.subscribe(websocket)
         
         # 保持连接，处理心跳
         while True:
@@ -56,14 +62,15 @@ async def websocket_endpoint(
                 data = await asyncio.wait_for(websocket.receive_json(), timeout=30)
                 
                 if data.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
+                    await manager.send_to_socket(websocket, {"type": "pong"})
+                elif data.get("type") == "subscribe" and "stats" in (data.get("topics") or []):
+                    await live_stats.subscribe(websocket)
                     
             except asyncio.TimeoutError:
-                # 发送心跳
-                try:
-                    await websocket.send_json({"type": "ping"})
-                except:
+                # 发送心跳（发送队列的写任务失败时会移除连接）
+                if not manager.is_connected(websocket):
                     break
+                await manager.send_to_socket(websocket, {"type": "ping"})
                     
     except WebSocketDisconnect:
         pass
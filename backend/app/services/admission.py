@@ -0,0 +1,235 @@
+"""
+上游准入调度（默认关闭，admission_enabled）
+
+每个请求过去都会立即转发到上游，单个用户开 200 个并发流就能占满 gcli2api，其他用户只能等超时。
+准入调度在转发前为每个上游（gcli2api / antigravity / openai）维护一个在途名额池：
+
+- 名额：每个上游最多 admission_max_in_flight 个在途请求（admission_pool_limits 可按上游覆盖），
+  流式请求在流结束后才释放（由 RateLimitReleaseMiddleware 释放）
+- 排队：名额用完时请求进入按用户划分的队列，按差额轮询（DRR）在用户之间公平分配，
+  每个用户每轮的份额为其权重（普通用户 1，贡献者 admission_contributor_weight）；
+  管理员的请求优先于所有用户队列
+- 超时：排队超过 admission_max_wait 秒或队列总长超过 admission_max_queue 时返回 503 + Retry-After
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.config import settings
+from app.services.metrics import registry
+from app.services.token_quota import parse_model_weights
+from app.utils.logger import log_warning
+
+# request.state 上记录占用名额的上游
+ADMISSION_STATE = "admission_pool"
+
+ADMISSION_WAIT_SECONDS = registry.histogram(
+    "admission_wait_seconds", "请求在准入队列中的等待时间（含无需排队的请求）", ("pool",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+ADMISSION_REJECTED_TOTAL = registry.counter(
+    "admission_rejected_total", "准入被拒绝的请求数：timeout 排队超时 / queue_full 队列已满", ("pool", "reason"))
+
+
+class _Pool:
+    """单个上游的名额和排队状态"""
+
+    __slots__ = ("name", "in_flight", "admin", "queues", "deficit", "active", "waiting")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = 0
+        self.admin: Deque[asyncio.Future] = deque()
+        # {用户 id: 等待中的请求}，active 为有排队请求的用户的轮询顺序
+        self.queues: Dict[int, Deque[asyncio.Future]] = {}
+        self.deficit: Dict[int, float] = {}
+        self.active: Deque[int] = deque()
+        self.waiting = 0
+
+
+class AdmissionScheduler:
+    """按上游的在途名额 + 按用户的 DRR 公平排队"""
+
+    def __init__(self):
+        self._pools: Dict[str, _Pool] = {}
+        self._limits_spec: Optional[str] = None
+        self._limits: Dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return settings.admission_enabled
+
+    def limit(self, pool: str) -> int:
+        if self._limits_spec != settings.admission_pool_limits:
+            self._limits_spec = settings.admission_pool_limits
+            self._limits = dict(parse_model_weights(self._limits_spec))
+        limit = self._limits.get(pool.lower())
+        return int(limit) if limit is not None else settings.admission_max_in_flight
+
+    @staticmethod
+    def weight(user_id: int) -> float:
+        from app.services.rate_limiter import rate_limiter
+
+        if rate_limiter.is_contributor(user_id):
+            return max(settings.admission_contributor_weight, 0.1)
+        return 1.0
+
+    def _pool(self, name: str) -> _Pool:
+        pool = self._pools.get(name)
+        if pool is None:
+            pool = self._pools[name] = _Pool(name)
+        return pool
+
+    # ===== 获取 / 释放 =====
+
+    async def acquire(self, pool_name: str, user) -> bool:
+        """获取 pool_name 的一个在途名额，排队超时抛出 503；未启用时返回 False"""
+        if not self.enabled or self.limit(pool_name) <= 0:
+            return False
+        pool = self._pool(pool_name)
+        start = time.monotonic()
+        if pool.in_flight < self.limit(pool_name) and not pool.waiting:
+            pool.in_flight += 1
+            ADMISSION_WAIT_SECONDS.observe(0.0, pool=pool_name)
+            return True
+
+        if pool.waiting >= settings.admission_max_queue:
+            ADMISSION_REJECTED_TOTAL.inc(pool=pool_name, reason="queue_full")
+            self._reject(pool_name, "准入队列已满")
+
+        waiter = asyncio.get_running_loop().create_future()
+        if user.is_admin:
+            pool.admin.append(waiter)
+        else:
+            queue = pool.queues.get(user.id)
+            if queue is None:
+                queue = pool.queues[user.id] = deque()
+                pool.deficit[user.id] = 0.0
+                pool.active.append(user.id)
+            queue.append(waiter)
+        pool.waiting += 1
+        # 排队期间可能有名额释放（例如上游限制被调大）
+        self._dispatch(pool)
+
+        granted = False
+        try:
+            await asyncio.wait_for(waiter, timeout=settings.admission_max_wait)
+            granted = True
+        except asyncio.TimeoutError:
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start, pool=pool_name)
+            ADMISSION_REJECTED_TOTAL.inc(pool=pool_name, reason="timeout")
+            log_warning("Admission", "排队超时: %s, 用户 %s", pool_name, user.username)
+            self._reject(pool_name, "上游繁忙，排队超时")
+        finally:
+            if granted:
+                pass
+            elif waiter.done() and not waiter.cancelled():
+                # 名额已分配但请求随即被取消（客户端断开）
+                self.release(pool_name)
+            else:
+                # 超时或客户端断开：移出排队（_next 会跳过已取消的等待者）
+                waiter.cancel()
+                pool.waiting -= 1
+                self._dispatch(pool)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start, pool=pool_name)
+        return True
+
+    def release(self, pool_name: str):
+        pool = self._pools.get(pool_name)
+        if pool is None:
+            return
+        pool.in_flight = max(pool.in_flight - 1, 0)
+        self._dispatch(pool)
+
+    @staticmethod
+    def _reject(pool_name: str, detail: str):
+        raise HTTPException(
+            status_code=503,
+            detail=f"{detail}: {pool_name}",
+            headers={"Retry-After": str(max(math.ceil(settings.admission_max_wait), 1))},
+        )
+
+    # ===== 调度 =====
+
+    def _dispatch(self, pool: _Pool):
+        """把空闲名额分配给排队的请求"""
+        limit = self.limit(pool.name)
+        while pool.in_flight < limit:
+            waiter = self._next(pool)
+            if waiter is None:
+                return
+            pool.in_flight += 1
+            pool.waiting -= 1
+            waiter.set_result(True)
+
+    def _next(self, pool: _Pool) -> Optional[asyncio.Future]:
+        """管理员优先，其余按 DRR 选出下一个等待者（跳过已取消的）"""
+        while pool.admin:
+            waiter = pool.admin.popleft()
+            if not waiter.done():
+                return waiter
+
+        while pool.active:
+            user_id = pool.active[0]
+            queue = pool.queues[user_id]
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                self._drop_user(pool, user_id)
+                continue
+            if pool.deficit[user_id] >= 1:
+                pool.deficit[user_id] -= 1
+                waiter = queue.popleft()
+                if not queue:
+                    self._drop_user(pool, user_id)
+                return waiter
+            # 本用户本轮份额用完，轮到下一个用户并发放其份额
+            pool.active.rotate(-1)
+            next_user = pool.active[0]
+            pool.deficit[next_user] += self.weight(next_user)
+        return None
+
+    @staticmethod
+    def _drop_user(pool: _Pool, user_id: int):
+        """用户队列已空：移出轮询，份额清零（DRR 不为空闲用户累积份额）"""
+        pool.active.remove(user_id)
+        del pool.queues[user_id]
+        del pool.deficit[user_id]
+
+    # ===== 统计 =====
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {
+                "in_flight": pool.in_flight,
+                "limit": self.limit(name),
+                "queued": pool.waiting,
+                "queued_users": len(pool.active),
+            }
+            for name, pool in self._pools.items()
+        }
+
+    def queue_depths(self) -> Tuple[Tuple[str, int, int], ...]:
+        """(上游, 排队数, 在途数)"""
+        return tuple((name, pool.waiting, pool.in_flight) for name, pool in self._pools.items())
+
+
+def _collect_admission():
+    samples = []
+    for name, waiting, in_flight in admission.queue_depths():
+        samples.append(({"pool": name, "state": "queued"}, waiting))
+        samples.append(({"pool": name, "state": "in_flight"}, in_flight))
+    return samples
+
+
+ADMISSION_QUEUE = registry.gauge(
+    "admission_queue", "准入调度状态：queued 排队中 / in_flight 已获得名额", ("pool", "state"),
+    collector=_collect_admission)
+
+
+# 全局实例
+admission = AdmissionScheduler()
@@ -8,6 +8,7 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from app.config import settings
+from app.utils.logger import log_warning
 from app.database import get_db
 from app.models.user import User, APIKey
 
@@ -72,7 +73,7 @@ async def get_current_user(
 ) -> User:
     """获取当前用户 (JWT认证)"""
     if not credentials:
-        print("JWT认证失败: 未提供认证信息", flush=True)
+        log_warning("Auth", "JWT认证失败: 未提供认证信息")
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     token = credentials.credentials
@@ -0,0 +1,252 @@
+"""
+OpenAI 端点注册表
+
+在内存中保存按优先级排序的启用端点，请求时不再查询数据库：
+- 管理员增删改端点后经总线通知所有 worker 标记失效，下次使用时重新加载
+- 每隔 endpoint_registry_reload_interval 秒重新加载一次作为兜底（如直接改库）
+
+同优先级的端点之间做负载均衡（加权最少在途请求，在途数相同时按平滑加权轮询），
+并限制每个端点的并发数；不同优先级之间仍是高优先级失败后才尝试低优先级。
+启用前缀亲和（prefix_affinity_enabled）时，有长前缀的请求在同优先级内改为按前缀指纹的
+rendezvous 哈希选择端点（有界负载：超过 (平均在途数 + 1) × prefix_affinity_load_factor、并发已满
+或最近失败仍在冷却中的端点让给下一个）。
+
+端点统计（total_requests / failed_requests / last_used_at / last_error）先在内存中累加，
+每隔 endpoint_stats_flush_interval 秒合并为每个端点一条 UPDATE 批量写入，关闭时再写一次。
+多 worker 各自累加增量，写入时使用 col = col + n，互不覆盖。
+"""
+import asyncio
+import itertools
+import math
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.services.metrics import PREFIX_AFFINITY_TOTAL
+from app.services.prefix_affinity import rendezvous_rank
+from app.services.pubsub import bus
+from app.utils.logger import log_info, log_warning
+
+
+@dataclass(frozen=True)
+class EndpointSnapshot:
+    """端点的只读快照（脱离数据库会话使用）"""
+    id: int
+    name: str
+    base_url: str
+    api_key: str
+    priority: int
+    weight: int = 1  # 同优先级内的负载权重
+    max_concurrency: int = 0  # 并发上限，0 表示不限
+
+
+@dataclass
+class _PendingStats:
+    total: int = 0
+    failed: int = 0
+    last_used_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+
+
+class EndpointRegistry:
+    """启用的 OpenAI 端点及其待写入统计"""
+
+    def __init__(self):
+        self._endpoints: List[EndpointSnapshot] = []
+        self._loaded_at = 0.0
+        self._stale = True
+        self._lock: Optional[asyncio.Lock] = None
+        self._pending: Dict[int, _PendingStats] = {}
+        # 负载均衡状态：在途请求数、平滑加权轮询的当前权重
+        self._in_flight: Dict[int, int] = {}
+        self._current_weight: Dict[int, int] = {}
+        # 最近失败的端点：{端点 id: 冷却结束时间 (monotonic)}
+        self._cooldown_until: Dict[int, float] = {}
+
+    # ===== 端点列表 =====
+
+    async def get_active(self) -> List[EndpointSnapshot]:
+        """按优先级排序的启用端点"""
+        if self._stale or time.time() - self._loaded_at > settings.endpoint_registry_reload_interval:
+            await self.reload()
+        return self._endpoints
+
+    async def reload(self):
+        from app.database import async_session
+        from app.models.user import OpenAIEndpoint
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        loaded_at = time.time()
+        async with self._lock:
+            # 等锁期间其他请求已经加载过
+            if not self._stale and self._loaded_at >= loaded_at:
+                return
+            self._stale = False
+            try:
+                async with async_session() as db:
+                    result = await db.execute(
+                        select(OpenAIEndpoint)
+                        .where(OpenAIEndpoint.is_active == True)
+                        .order_by(OpenAIEndpoint.priority.desc(), OpenAIEndpoint.id)
+                    )
+                    self._endpoints = [
+                        EndpointSnapshot(
+                            ep.id, ep.name, ep.base_url, ep.api_key, ep.priority or 0,
+                            max(ep.weight or 1, 1), max(ep.max_concurrency or 0, 0),
+                        )
+                        for ep in result.scalars().all()
+                    ]
+            except Exception as e:
+                # 加载失败时沿用旧列表
+                log_warning("Endpoints", f"加载 OpenAI 端点失败: {e}")
+            self._loaded_at = time.time()
+
+    def invalidate(self):
+        self._stale = True
+
+    # ===== 负载均衡 =====
+
+    def balance(self, endpoints: List[EndpointSnapshot]) -> List[EndpointSnapshot]:
+        """
+        对（已按优先级排序的）端点重新排序：优先级分组不变，组内按 在途数/权重 升序，
+        在途数相同时按平滑加权轮询（与 nginx 相同），空闲时也能按权重分摊请求
+        """
+        ordered = []
+        for _, group in itertools.groupby(endpoints, key=lambda ep: ep.priority):
+            group = list(group)
+            if len(group) > 1:
+                total_weight = sum(ep.weight for ep in group)
+                for ep in group:
+                    self._current_weight[ep.id] = self._current_weight.get(ep.id, 0) + ep.weight
+                group.sort(key=lambda ep: (self._in_flight.get(ep.id, 0) / ep.weight,
+                                           -self._current_weight[ep.id]))
+                self._current_weight[group[0].id] -= total_weight
+            ordered.extend(group)
+        return ordered
+
+    def affinity(self, endpoints: List[EndpointSnapshot], fingerprint: str) -> List[EndpointSnapshot]:
+        """
+        按前缀指纹对（已按优先级排序的）端点重新排序：优先级分组不变，组内按 rendezvous 哈希
+        排名选第一个未过载、有并发名额且不在冷却中的端点，其余按排名作为后备
+        """
+        now = time.monotonic()
+        ordered = []
+        for _, group in itertools.groupby(endpoints, key=lambda ep: ep.priority):
+            group = list(group)
+            if len(group) == 1:
+                ordered.extend(group)
+                continue
+            ranked = rendezvous_rank(fingerprint, group, key=lambda ep: ep.id)
+            # 有界负载：在途数不超过 (组内平均在途数 + 1) × 系数（+1 避免低负载时频繁让出）
+            total = sum(self._in_flight.get(ep.id, 0) for ep in group)
+            bound = math.ceil(settings.prefix_affinity_load_factor * (total / len(group) + 1))
+            cooling = [ep for ep in ranked if self._cooldown_until.get(ep.id, 0) > now]
+            ready = [ep for ep in ranked if ep not in cooling]
+            chosen = next(
+                (ep for ep in ready if self.has_capacity(ep) and self._in_flight.get(ep.id, 0) < bound),
+                None,
+            )
+            if chosen is not None:
+                PREFIX_AFFINITY_TOTAL.inc(result="home" if chosen is ranked[0] else "spill")
+                ready.remove(chosen)
+                ordered.append(chosen)
+            else:
+                PREFIX_AFFINITY_TOTAL.inc(result="overloaded")
+            ordered.extend(ready)
+            ordered.extend(cooling)
+        return ordered
+
+    def has_capacity(self, endpoint: EndpointSnapshot) -> bool:
+        """是否还有并发名额"""
+        return not endpoint.max_concurrency or self._in_flight.get(endpoint.id, 0) < endpoint.max_concurrency
+
+    def acquire(self, endpoint: EndpointSnapshot):
+        """占用一个并发名额（调用前用 has_capacity 判断）"""
+        self._in_flight[endpoint.id] = self._in_flight.get(endpoint.id, 0) + 1
+
+    def release(self, endpoint: EndpointSnapshot):
+        in_flight = self._in_flight.get(endpoint.id, 0) - 1
+        if in_flight > 0:
+            self._in_flight[endpoint.id] = in_flight
+        else:
+            self._in_flight.pop(endpoint.id, None)
+
+    def in_flight(self) -> Dict[str, int]:
+        names = {ep.id: ep.name for ep in self._endpoints}
+        return {names.get(endpoint_id, str(endpoint_id)): count for endpoint_id, count in self._in_flight.items()}
+
+    # ===== 统计 =====
+
+    def record_success(self, endpoint_id: int):
+        stats = self._pending.setdefault(endpoint_id, _PendingStats())
+        stats.total += 1
+        stats.last_used_at = datetime.utcnow()
+        self._cooldown_until.pop(endpoint_id, None)
+
+    def record_failure(self, endpoint_id: int, error: str):
+        stats = self._pending.setdefault(endpoint_id, _PendingStats())
+        stats.failed += 1
+        stats.last_error = error[:500]
+        if settings.prefix_affinity_cooldown:
+            self._cooldown_until[endpoint_id] = time.monotonic() + settings.prefix_affinity_cooldown
+
+    def pending_stats(self, endpoint_id: int) -> _PendingStats:
+        """尚未写入数据库的统计（管理页面展示时叠加）"""
+        return self._pending.get(endpoint_id) or _PendingStats()
+
+    async def flush(self):
+        """把累加的统计批量写入数据库"""
+        from app.database import async_session
+        from app.models.user import OpenAIEndpoint
+
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            async with async_session() as db:
+                for endpoint_id, stats in pending.items():
+                    values = {
+                        "total_requests": OpenAIEndpoint.total_requests + stats.total,
+                        "failed_requests": OpenAIEndpoint.failed_requests + stats.failed,
+                    }
+                    if stats.last_used_at:
+                        values["last_used_at"] = stats.last_used_at
+                    if stats.last_error:
+                        values["last_error"] = stats.last_error
+                    await db.execute(
+                        update(OpenAIEndpoint).where(OpenAIEndpoint.id == endpoint_id).values(**values)
+                    )
+                await db.commit()
+        except Exception as e:
+            log_warning("Endpoints", f"端点统计写入失败，下次重试: {e}")
+            for endpoint_id, stats in pending.items():
+                merged = self._pending.setdefault(endpoint_id, _PendingStats())
+                merged.total += stats.total
+                merged.failed += stats.failed
+                merged.last_used_at = merged.last_used_at or stats.last_used_at
+                merged.last_error = merged.last_error or stats.last_error
+
+    async def run(self):
+        """后台任务：定期写入统计、定期重新加载端点（关闭时由调用方再 flush 一次）"""
+        log_info("Endpoints", "OpenAI 端点注册表后台任务已启动")
+        while True:
+            await asyncio.sleep(settings.endpoint_stats_flush_interval)
+            await self.flush()
+            if time.time() - self._loaded_at > settings.endpoint_registry_reload_interval:
+                await self.reload()
+
+
+# 全局实例
+endpoint_registry = EndpointRegistry()
+
+bus.subscribe("endpoint_registry_invalidate", lambda _: endpoint_registry.invalidate())
+
+
+def invalidate_endpoint_registry():
+    """通知所有 worker 重新加载端点列表"""
+    bus.publish("endpoint_registry_invalidate")
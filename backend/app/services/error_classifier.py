@@ -3,10 +3,15 @@
 
 将错误信息分类为标准类型，便于统计分析和问题排查
 """
+import json
 import re
-from typing import Tuple, Optional
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Tuple
 from dataclasses import dataclass
 
+from app.services.metrics import CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL
+from app.utils.logger import log_info, log_warning
+
 
 # 错误类型枚举
 class ErrorType:
@@ -40,7 +45,7 @@ ERROR_TYPE_NAMES = {
 }
 
 
-@dataclass
+@dataclass(frozen=True)
 class ErrorClassification:
     """错误分类结果"""
     error_type: str
@@ -50,205 +55,192 @@ class ErrorClassification:
     should_disable_credential: bool  # 是否应该禁用凭证
 
 
-def classify_error(status_code: int, error_text: str) -> ErrorClassification:
+@dataclass(frozen=True)
+class ClassificationRule:
     """
-    智能分类错误
-    
-    Args:
-        status_code: HTTP 状态码
-        error_text: 错误信息文本
-    
-    Returns:
-        ErrorClassification 包含错误类型、错误码和其他元信息
+    分类规则：状态码匹配且每组关键词都至少命中一个时生效
+
+    status 为 None 表示任意状态码；min_status 用于 5xx 这类范围；
+    error_code 中的 {status} 会替换为实际状态码。
     """
-    error_text_lower = (error_text or "").lower()
-    
-    # === 1. 按状态码初步分类 ===
-    
+    error_type: str
+    error_code: str
+    description: str
+    is_retryable: bool
+    should_disable_credential: bool
+    status: Optional[FrozenSet[int]] = None
+    min_status: Optional[int] = None
+    keywords: Tuple[Tuple[str, ...], ...] = ()
+
+    def matches_status(self, status_code: int) -> bool:
+        if self.status is not None and status_code not in self.status:
+            return False
+        if self.min_status is not None and status_code < self.min_status:
+            return False
+        return True
+
+
+def _rule(error_type, error_code, description, retryable, disable, status=None, min_status=None, keywords=()):
+    return ClassificationRule(
+        error_type=error_type,
+        error_code=error_code,
+        description=description,
+        is_retryable=retryable,
+        should_disable_credential=disable,
+        status=frozenset(status) if status is not None else None,
+        min_status=min_status,
+        keywords=tuple(tuple(group) for group in keywords),
+    )
+
+
+# 内置规则（按顺序匹配，先命中先返回）
+DEFAULT_RULES: List[ClassificationRule] = [
+    # === 1. 按状态码分类 ===
     # 401 未授权
-    if status_code == 401:
-        return ErrorClassification(
-            error_type=ErrorType.AUTH_ERROR,
-            error_code="UNAUTHENTICATED",
-            description="Token 无效或已过期",
-            is_retryable=False,
-            should_disable_credential=True
-        )
-    
+    _rule(ErrorType.AUTH_ERROR, "UNAUTHENTICATED", "Token 无效或已过期", False, True, status=[401]),
     # 403 禁止访问
-    if status_code == 403:
-        # 检查具体原因
-        if "permission_denied" in error_text_lower:
-            return ErrorClassification(
-                error_type=ErrorType.AUTH_ERROR,
-                error_code="PERMISSION_DENIED",
-                description="无权访问该资源",
-                is_retryable=False,
-                should_disable_credential=True
-            )
-        if "quota" in error_text_lower or "limit" in error_text_lower:
-            return ErrorClassification(
-                error_type=ErrorType.QUOTA_EXHAUSTED,
-                error_code="QUOTA_EXCEEDED",
-                description="API 配额已用尽",
-                is_retryable=False,
-                should_disable_credential=False
-            )
-        if "billing" in error_text_lower:
-            return ErrorClassification(
-                error_type=ErrorType.AUTH_ERROR,
-                error_code="BILLING_DISABLED",
-                description="账单已禁用",
-                is_retryable=False,
-                should_disable_credential=True
-            )
-        return ErrorClassification(
-            error_type=ErrorType.AUTH_ERROR,
-            error_code="FORBIDDEN",
-            description="访问被拒绝",
-            is_retryable=False,
-            should_disable_credential=True
-        )
-    
-    # 429 速率限制
-    if status_code == 429:
-        # 区分日配额用尽和临时速率限制
-        if "per day" in error_text_lower or "daily" in error_text_lower or "quota" in error_text_lower:
-            return ErrorClassification(
-                error_type=ErrorType.QUOTA_EXHAUSTED,
-                error_code="DAILY_QUOTA_EXCEEDED",
-                description="今日配额已用尽",
-                is_retryable=False,
-                should_disable_credential=False
-            )
-        return ErrorClassification(
-            error_type=ErrorType.RATE_LIMIT,
-            error_code="RESOURCE_EXHAUSTED",
-            description="请求过于频繁，请稍后重试",
-            is_retryable=True,
-            should_disable_credential=False
-        )
-    
+    _rule(ErrorType.AUTH_ERROR, "PERMISSION_DENIED", "无权访问该资源", False, True,
+          status=[403], keywords=[["permission_denied"]]),
+    _rule(ErrorType.QUOTA_EXHAUSTED, "QUOTA_EXCEEDED", "API 配额已用尽", False, False,
+          status=[403], keywords=[["quota", "limit"]]),
+    _rule(ErrorType.AUTH_ERROR, "BILLING_DISABLED", "账单已禁用", False, True,
+          status=[403], keywords=[["billing"]]),
+    _rule(ErrorType.AUTH_ERROR, "FORBIDDEN", "访问被拒绝", False, True, status=[403]),
+    # 429 速率限制：区分日配额用尽和临时速率限制
+    _rule(ErrorType.QUOTA_EXHAUSTED, "DAILY_QUOTA_EXCEEDED", "今日配额已用尽", False, False,
+          status=[429], keywords=[["per day", "daily", "quota"]]),
+    _rule(ErrorType.RATE_LIMIT, "RESOURCE_EXHAUSTED", "请求过于频繁，请稍后重试", True, False, status=[429]),
     # 400 请求无效
-    if status_code == 400:
-        # 内容安全过滤
-        if any(kw in error_text_lower for kw in ["safety", "blocked", "harm", "filter"]):
-            return ErrorClassification(
-                error_type=ErrorType.CONTENT_FILTER,
-                error_code="SAFETY_BLOCKED",
-                description="内容被安全过滤器阻止",
-                is_retryable=False,
-                should_disable_credential=False
-            )
-        # 模型不存在
-        if "model" in error_text_lower and ("not found" in error_text_lower or "not exist" in error_text_lower):
-            return ErrorClassification(
-                error_type=ErrorType.MODEL_ERROR,
-                error_code="MODEL_NOT_FOUND",
-                description="模型不存在或不可用",
-                is_retryable=False,
-                should_disable_credential=False
-            )
-        # 参数错误
-        if "invalid" in error_text_lower and "argument" in error_text_lower:
-            return ErrorClassification(
-                error_type=ErrorType.INVALID_REQUEST,
-                error_code="INVALID_ARGUMENT",
-                description="请求参数无效",
-                is_retryable=False,
-                should_disable_credential=False
-            )
-        return ErrorClassification(
-            error_type=ErrorType.INVALID_REQUEST,
-            error_code="BAD_REQUEST",
-            description="请求格式错误",
-            is_retryable=False,
-            should_disable_credential=False
-        )
-    
-    # 404 未找到
-    if status_code == 404:
-        return ErrorClassification(
-            error_type=ErrorType.MODEL_ERROR,
-            error_code="NOT_FOUND",
-            description="请求的资源不存在",
-            is_retryable=True,  # 可能是临时问题，可重试
-            should_disable_credential=False
-        )
-    
+    _rule(ErrorType.CONTENT_FILTER, "SAFETY_BLOCKED", "内容被安全过滤器阻止", False, False,
+          status=[400], keywords=[["safety", "blocked", "harm", "filter"]]),
+    _rule(ErrorType.MODEL_ERROR, "MODEL_NOT_FOUND", "模型不存在或不可用", False, False,
+          status=[400], keywords=[["model"], ["not found", "not exist"]]),
+    _rule(ErrorType.INVALID_REQUEST, "INVALID_ARGUMENT", "请求参数无效", False, False,
+          status=[400], keywords=[["invalid"], ["argument"]]),
+    _rule(ErrorType.INVALID_REQUEST, "BAD_REQUEST", "请求格式错误", False, False, status=[400]),
+    # 404 未找到（可能是临时问题，可重试）
+    _rule(ErrorType.MODEL_ERROR, "NOT_FOUND", "请求的资源不存在", True, False, status=[404]),
     # 5xx 服务器错误
-    if status_code >= 500:
-        error_code = f"HTTP_{status_code}"
-        descriptions = {
-            500: "服务器内部错误",
-            502: "网关错误",
-            503: "服务暂时不可用",
-            504: "网关超时",
-        }
-        return ErrorClassification(
-            error_type=ErrorType.UPSTREAM_ERROR,
-            error_code=error_code,
-            description=descriptions.get(status_code, "上游服务错误"),
-            is_retryable=True,
-            should_disable_credential=False
-        )
-    
+    _rule(ErrorType.UPSTREAM_ERROR, "HTTP_500", "服务器内部错误", True, False, status=[500]),
+    _rule(ErrorType.UPSTREAM_ERROR, "HTTP_502", "网关错误", True, False, status=[502]),
+    _rule(ErrorType.UPSTREAM_ERROR, "HTTP_503", "服务暂时不可用", True, False, status=[503]),
+    _rule(ErrorType.UPSTREAM_ERROR, "HTTP_504", "网关超时", True, False, status=[504]),
+    _rule(ErrorType.UPSTREAM_ERROR, "HTTP_{status}", "上游服务错误", True, False, min_status=500),
+
     # === 2. 按错误文本关键词分类 ===
-    
-    # 超时
-    if any(kw in error_text_lower for kw in ["timeout", "timed out", "etimedout"]):
-        return ErrorClassification(
-            error_type=ErrorType.TIMEOUT,
-            error_code="REQUEST_TIMEOUT",
-            description="请求超时",
-            is_retryable=True,
-            should_disable_credential=False
-        )
-    
-    # 网络/连接错误
-    if any(kw in error_text_lower for kw in [
-        "econnreset", "connection reset", "socket hang up", 
-        "econnrefused", "connection refused", "network error",
-        "connectionreset", "enotfound", "getaddrinfo"
-    ]):
-        return ErrorClassification(
-            error_type=ErrorType.NETWORK_ERROR,
-            error_code="CONNECTION_ERROR",
-            description="网络连接错误",
-            is_retryable=True,
-            should_disable_credential=False
-        )
-    
-    # Token 刷新失败
-    if "token" in error_text_lower and ("refresh" in error_text_lower or "expired" in error_text_lower):
-        return ErrorClassification(
-            error_type=ErrorType.TOKEN_ERROR,
-            error_code="TOKEN_REFRESH_FAILED",
-            description="Token 刷新失败",
-            is_retryable=False,
-            should_disable_credential=True
+    _rule(ErrorType.TIMEOUT, "REQUEST_TIMEOUT", "请求超时", True, False,
+          keywords=[["timeout", "timed out", "etimedout"]]),
+    _rule(ErrorType.NETWORK_ERROR, "CONNECTION_ERROR", "网络连接错误", True, False,
+          keywords=[["econnreset", "connection reset", "socket hang up",
+                     "econnrefused", "connection refused", "network error",
+                     "connectionreset", "enotfound", "getaddrinfo"]]),
+    _rule(ErrorType.TOKEN_ERROR, "TOKEN_REFRESH_FAILED", "Token 刷新失败", False, True,
+          keywords=[["token"], ["refresh", "expired"]]),
+]
+
+# === 3. Google API 响应中的错误码 ===
+GOOGLE_CODE_MAP = {
+    "RESOURCE_EXHAUSTED": (ErrorType.RATE_LIMIT, "请求过于频繁"),
+    "INVALID_ARGUMENT": (ErrorType.INVALID_REQUEST, "参数无效"),
+    "NOT_FOUND": (ErrorType.MODEL_ERROR, "资源不存在"),
+    "PERMISSION_DENIED": (ErrorType.AUTH_ERROR, "权限被拒绝"),
+    "UNAUTHENTICATED": (ErrorType.AUTH_ERROR, "未授权"),
+    "INTERNAL": (ErrorType.UPSTREAM_ERROR, "内部错误"),
+    "UNAVAILABLE": (ErrorType.UPSTREAM_ERROR, "服务不可用"),
+    "DEADLINE_EXCEEDED": (ErrorType.TIMEOUT, "请求超时"),
+    "CANCELLED": (ErrorType.UNKNOWN, "请求被取消"),
+    "FAILED_PRECONDITION": (ErrorType.INVALID_REQUEST, "前置条件失败"),
+}
+_GOOGLE_CODE_RE = re.compile(r'"code"\s*:\s*"([A-Z_]+)"')
+
+# === 4. 默认分类 ===
+_DEFAULT_CLASSIFICATION = ErrorClassification(
+    error_type=ErrorType.UNKNOWN,
+    error_code="UNKNOWN",
+    description="未知错误",
+    is_retryable=True,
+    should_disable_credential=False
+)
+
+# 指纹归一化：数字（时间戳、请求 ID、项目号、配额数值等）不影响分类
+_DIGITS_TO_ZERO = bytes.maketrans(b"123456789", b"000000000")
+
+
+class ErrorClassifier:
+    """
+    规则表驱动的错误分类器
+
+    - 按状态码预先筛选规则；第一条匹配的规则只看状态码时直接返回，不扫描文本
+    - 需要看文本时只扫描前 max_chars 个字符，每个关键词每次最多查找一次（惰性，C 层子串查找）
+    - 结果按 (状态码, 归一化文本指纹) 缓存（LRU），同一错误的不同实例共用一条
+    """
+
+    def __init__(self, rules: List[ClassificationRule], max_chars: int = 8192, cache_size: int = 4096):
+        self.rules = rules
+        self.max_chars = max_chars
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[int, int, int], ErrorClassification]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # {状态码: (适用的规则, 无需看文本时的直接结果)}
+        self._by_status: Dict[int, Tuple[List[ClassificationRule], Optional[ErrorClassification]]] = {}
+        # 自定义关键词含数字时不能按去数字的文本缓存
+        self._normalize_digits = not any(
+            ch.isdigit() for rule in rules for group in rule.keywords for kw in group for ch in kw
         )
-    
-    # === 3. 尝试从 Google API 响应中提取错误码 ===
-    
-    # 匹配 "code": "ERROR_CODE" 格式
-    code_match = re.search(r'"code"\s*:\s*"([A-Z_]+)"', error_text)
-    if code_match:
-        google_code = code_match.group(1)
-        type_map = {
-            "RESOURCE_EXHAUSTED": (ErrorType.RATE_LIMIT, "请求过于频繁"),
-            "INVALID_ARGUMENT": (ErrorType.INVALID_REQUEST, "参数无效"),
-            "NOT_FOUND": (ErrorType.MODEL_ERROR, "资源不存在"),
-            "PERMISSION_DENIED": (ErrorType.AUTH_ERROR, "权限被拒绝"),
-            "UNAUTHENTICATED": (ErrorType.AUTH_ERROR, "未授权"),
-            "INTERNAL": (ErrorType.UPSTREAM_ERROR, "内部错误"),
-            "UNAVAILABLE": (ErrorType.UPSTREAM_ERROR, "服务不可用"),
-            "DEADLINE_EXCEEDED": (ErrorType.TIMEOUT, "请求超时"),
-            "CANCELLED": (ErrorType.UNKNOWN, "请求被取消"),
-            "FAILED_PRECONDITION": (ErrorType.INVALID_REQUEST, "前置条件失败"),
-        }
-        if google_code in type_map:
-            error_type, desc = type_map[google_code]
+
+    def _rules_for(self, status_code: int) -> Tuple[List[ClassificationRule], Optional[ErrorClassification]]:
+        entry = self._by_status.get(status_code)
+        if entry is None:
+            rules = [rule for rule in self.rules if rule.matches_status(status_code)]
+            direct = _to_classification(rules[0], status_code) if rules and not rules[0].keywords else None
+            entry = self._by_status[status_code] = (rules, direct)
+        return entry
+
+    def classify(self, status_code: int, error_text: str) -> ErrorClassification:
+        rules, direct = self._rules_for(status_code)
+        if direct is not None:
+            return direct
+
+        head = (error_text or "")[:self.max_chars]
+        fingerprint = head.encode("utf-8", "replace")
+        if self._normalize_digits:
+            fingerprint = fingerprint.translate(_DIGITS_TO_ZERO)
+        key = (status_code, len(fingerprint), hash(fingerprint))
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS_TOTAL.inc(cache="error_classifier")
+            return cached
+
+        self.misses += 1
+        CACHE_MISSES_TOTAL.inc(cache="error_classifier")
+        result = self._classify(status_code, rules, head)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _classify(status_code: int, rules: List[ClassificationRule], text: str) -> ErrorClassification:
+        text_lower = text.lower()
+        seen: Dict[str, bool] = {}
+
+        def has(keyword: str) -> bool:
+            found = seen.get(keyword)
+            if found is None:
+                found = seen[keyword] = keyword in text_lower
+            return found
+
+        for rule in rules:
+            if all(any(has(kw) for kw in group) for group in rule.keywords):
+                return _to_classification(rule, status_code)
+
+        code_match = _GOOGLE_CODE_RE.search(text)
+        if code_match and code_match.group(1) in GOOGLE_CODE_MAP:
+            google_code = code_match.group(1)
+            error_type, desc = GOOGLE_CODE_MAP[google_code]
             return ErrorClassification(
                 error_type=error_type,
                 error_code=google_code,
@@ -256,17 +248,79 @@ def classify_error(status_code: int, error_text: str) -> ErrorClassification:
                 is_retryable=error_type in [ErrorType.RATE_LIMIT, ErrorType.UPSTREAM_ERROR, ErrorType.TIMEOUT],
                 should_disable_credential=error_type == ErrorType.AUTH_ERROR
             )
-    
-    # === 4. 默认分类 ===
+        return _DEFAULT_CLASSIFICATION
+
+    def cache_info(self) -> dict:
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def load_rules(path: str) -> List[ClassificationRule]:
+    """
+    从 JSON 文件加载自定义规则（排在内置规则之前），格式:
+        [{"type": "QUOTA_EXHAUSTED", "code": "MY_CODE", "description": "...",
+          "status": [429], "min_status": null, "keywords": [["关键词A", "关键词B"], ["关键词C"]],
+          "retryable": false, "disable_credential": false}]
+    keywords 为小写；每组至少命中一个，且所有组都须命中
+    """
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f)
+    return [
+        _rule(
+            item["type"], item["code"], item.get("description", ""),
+            item.get("retryable", False), item.get("disable_credential", False),
+            status=item.get("status"), min_status=item.get("min_status"),
+            keywords=[[kw.lower() for kw in group] for group in item.get("keywords", [])],
+        )
+        for item in items
+    ]
+
+
+def create_classifier() -> ErrorClassifier:
+    from app.config import settings
+
+    rules = list(DEFAULT_RULES)
+    if settings.error_classifier_rules_file:
+        try:
+            custom = load_rules(settings.error_classifier_rules_file)
+            rules = custom + rules
+            log_info("ErrorClassifier", f"已加载 {len(custom)} 条自定义错误分类规则")
+        except Exception as e:
+            log_warning("ErrorClassifier", f"加载自定义错误分类规则失败，使用内置规则: {e}")
+    return ErrorClassifier(
+        rules,
+        max_chars=settings.error_classifier_max_chars,
+        cache_size=settings.error_classifier_cache_size,
+    )
+
+
+def _to_classification(rule: ClassificationRule, status_code: int) -> ErrorClassification:
     return ErrorClassification(
-        error_type=ErrorType.UNKNOWN,
-        error_code="UNKNOWN",
-        description="未知错误",
-        is_retryable=True,
-        should_disable_credential=False
+        error_type=rule.error_type,
+        error_code=rule.error_code.replace("{status}", str(status_code)),
+        description=rule.description,
+        is_retryable=rule.is_retryable,
+        should_disable_credential=rule.should_disable_credential
     )
 
 
+# 全局实例
+classifier = create_classifier()
+
+
+def classify_error(status_code: int, error_text: str) -> ErrorClassification:
+    """
+    智能分类错误
+    
+    Args:
+        status_code: HTTP 状态码
+        error_text: 错误信息文本
+    
+    Returns:
+        ErrorClassification 包含错误类型、错误码和其他元信息
+    """
+    return classifier.classify(status_code, error_text)
+
+
 def classify_error_simple(status_code: int, error_text: str) -> Tuple[str, str]:
     """
     简化版错误分类，仅返回 (error_type, error_code)
@@ -288,8 +342,6 @@ def extract_google_error_details(error_text: str) -> Optional[dict]:
     Returns:
         包含 code, message, status 等字段的字典，解析失败返回 None
     """
-    import json
-    
     try:
         # 尝试直接解析整个错误文本为 JSON
         data = json.loads(error_text)
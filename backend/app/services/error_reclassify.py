@@ -0,0 +1,119 @@
+"""
+历史报错重新分类
+
+早期以及部分转发路径写入的使用日志没有 error_type / error_code，报错统计按 error_type 分组时会漏算。
+后台任务按 id 顺序分块扫描 status_code != 200 且 error_type 为空的记录，在进程池中分类后
+批量 UPDATE 写回：
+
+- 可恢复：已分类的记录不再满足条件，中断后重新启动会从剩余记录继续
+- 限速：每块之间休眠 reclassify_chunk_delay 秒，避免挤占正常请求的数据库和 CPU
+- 进度写入 manage 的后台任务状态，经 /api/manage/credentials/task-status/{task_id} 查询
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, func, update
+
+from app.config import settings
+from app.utils.logger import log_info, log_error, log_success
+
+
+def _classify_chunk(rows: List[Tuple[int, int, Optional[str]]]) -> List[dict]:
+    """在子进程中执行：[(id, status_code, error_message)] -> 批量 UPDATE 参数"""
+    from app.services.error_classifier import classify_error
+
+    results = []
+    for log_id, status_code, error_message in rows:
+        classification = classify_error(status_code or 0, error_message or "")
+        results.append({
+            "id": log_id,
+            "error_type": classification.error_type,
+            "error_code": classification.error_code,
+        })
+    return results
+
+
+class ErrorReclassifier:
+    """同一时间只运行一个重新分类任务"""
+
+    def __init__(self):
+        self.task_id: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, task_id: str, progress: dict) -> str:
+        """启动任务并返回 task_id；已有任务在运行时返回它的 task_id"""
+        if self.running:
+            return self.task_id
+        self.task_id = task_id
+        self._task = asyncio.create_task(self._run(progress))
+        return task_id
+
+    async def _run(self, progress: dict):
+        from app.database import async_session
+        from app.models.user import UsageLog
+
+        conditions = [UsageLog.status_code != 200, UsageLog.error_type.is_(None)]
+        progress.update({"status": "running", "total": 0, "processed": 0, "progress": 0, "last_id": 0})
+        executor = None
+        try:
+            async with async_session() as db:
+                total = (await db.execute(select(func.count(UsageLog.id)).where(*conditions))).scalar() or 0
+            progress["total"] = total
+            log_info("Reclassify", f"开始重新分类历史报错: {total} 条")
+            if settings.reclassify_workers > 0 and total:
+                # spawn：不继承父进程的事件循环、数据库连接和线程
+                executor = ProcessPoolExecutor(
+                    max_workers=settings.reclassify_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+            loop = asyncio.get_running_loop()
+            last_id = 0
+            while True:
+                async with async_session() as db:
+                    result = await db.execute(
+                        select(UsageLog.id, UsageLog.status_code, UsageLog.error_message)
+                        .where(*conditions)
+                        .where(UsageLog.id > last_id)
+                        .order_by(UsageLog.id)
+                        .limit(settings.reclassify_batch_size)
+                    )
+                    rows = [tuple(row) for row in result.all()]
+                if not rows:
+                    break
+
+                if executor is not None:
+                    values = await loop.run_in_executor(executor, _classify_chunk, rows)
+                else:
+                    values = _classify_chunk(rows)
+
+                async with async_session() as db:
+                    await db.execute(update(UsageLog), values)
+                    await db.commit()
+
+                last_id = rows[-1][0]
+                progress["processed"] += len(rows)
+                progress["last_id"] = last_id
+                progress["progress"] = min(int(progress["processed"] * 100 / total), 100) if total else 100
+                await asyncio.sleep(settings.reclassify_chunk_delay)
+
+            progress["status"] = "done"
+            progress["progress"] = 100
+            log_success("Reclassify", f"历史报错重新分类完成: {progress['processed']} 条")
+        except Exception as e:
+            progress["status"] = "failed"
+            progress["error"] = str(e)
+            log_error("Reclassify", f"历史报错重新分类中断（可重新启动继续）: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 全局实例
+error_reclassifier = ErrorReclassifier()
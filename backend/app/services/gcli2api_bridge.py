@@ -8,9 +8,14 @@ from typing import Optional, Dict, Any, AsyncIterator
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 from app.config import settings
-import logging
-
-logger = logging.getLogger(__name__)
+from app.services.metrics import (
+    ACTIVE_STREAMS, STREAM_DURATION_SECONDS, UPSTREAM_TTFB_SECONDS, UpstreamTrace
+)
+from app.services.usage_accounting import SSEUsageTracker, usage_accounting
+from app.services.response_cache import StreamRecorder
+from app.utils.logger import log_info, log_error
+from app.utils.streaming import ClosingStreamingResponse
+import time
 
 
 class Gcli2apiBridge:
@@ -27,6 +32,13 @@ class Gcli2apiBridge:
         password = self.panel_password if use_panel_password else self.api_password
         return {"Authorization": f"Bearer {password}"}
 
+    @staticmethod
+    def _metric_labels(path: str, json_data: Optional[Dict[str, Any]]) -> Dict[str, str]:
+        """指标标签：按桥接路径区分 gcli2api / antigravity"""
+        endpoint_name = "antigravity" if path.startswith("/antigravity") else "gcli2api"
+        model = json_data.get("model", "") if isinstance(json_data, dict) else ""
+        return {"endpoint_name": endpoint_name, "model": model or ""}
+
     async def forward_request(
         self,
         path: str,
@@ -65,7 +77,12 @@ class Gcli2apiBridge:
         if headers:
             forward_headers.update(headers)
 
-        logger.info(f"[gcli2api Bridge] {method} {url}")
+        log_info("gcli2api Bridge", "%s %s", method, url)
+
+        # 管理接口（面板密码）不计入代理链路指标
+        labels = None if use_panel_password else self._metric_labels(path, json_data)
+        extensions = {"trace": UpstreamTrace(**labels)} if labels else None
+        request_start = time.perf_counter()
 
         try:
             async with httpx.AsyncClient(timeout=self.timeout) as client:
@@ -74,22 +91,25 @@ class Gcli2apiBridge:
                         url,
                         json=json_data,
                         headers=forward_headers,
-                        params=params
+                        params=params,
+                        extensions=extensions
                     )
                 elif method.upper() == "GET":
                     response = await client.get(
                         url,
                         headers=forward_headers,
-                        params=params
+                        params=params,
+                        extensions=extensions
                     )
                 else:
                     raise ValueError(f"Unsupported HTTP method: {method}")
 
+                if labels:
+                    UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - request_start, **labels)
+
                 # 检查响应状态
                 if response.status_code >= 400:
-                    logger.error(
-                        f"[gcli2api Bridge] Error {response.status_code}: {response.text}"
-                    )
+                    log_error("gcli2api Bridge", "Error %s: %s", response.status_code, response.text)
                     raise HTTPException(
                         status_code=response.status_code,
                         detail=response.text
@@ -106,19 +126,19 @@ class Gcli2apiBridge:
                     return response.text
 
         except httpx.TimeoutException:
-            logger.error(f"[gcli2api Bridge] Timeout: {url}")
+            log_error("gcli2api Bridge", "Timeout: %s", url)
             raise HTTPException(
                 status_code=504,
                 detail="gcli2api service timeout"
             )
         except httpx.ConnectError:
-            logger.error(f"[gcli2api Bridge] Connection failed: {url}")
+            log_error("gcli2api Bridge", "Connection failed: %s", url)
             raise HTTPException(
                 status_code=503,
                 detail="Cannot connect to gcli2api service. Please ensure it's running."
             )
         except Exception as e:
-            logger.error(f"[gcli2api Bridge] Unexpected error: {str(e)}")
+            log_error("gcli2api Bridge", "Unexpected error: %s", str(e))
             raise HTTPException(
                 status_code=500,
                 detail=f"gcli2api bridge error: {str(e)}"
@@ -129,7 +149,9 @@ class Gcli2apiBridge:
         path: str,
         json_data: Optional[Dict[str, Any]] = None,
         headers: Optional[Dict[str, str]] = None,
-        use_panel_password: bool = False
+        use_panel_password: bool = False,
+        usage_tracker: Optional[SSEUsageTracker] = None,
+        stream_recorder: Optional[StreamRecorder] = None
     ) -> StreamingResponse:
         """
         转发流式请求到 gcli2api
@@ -139,6 +161,8 @@ class Gcli2apiBridge:
             json_data: JSON 请求体
             headers: 额外的请求头
             use_panel_password: 是否使用面板密码
+            usage_tracker: 用量统计（逐块累计字节数并读取最后的 usage）
+            stream_recorder: 响应缓存的流记录（上游流正常结束后写入缓存）
 
         Returns:
             StreamingResponse
@@ -156,44 +180,72 @@ class Gcli2apiBridge:
         if headers:
             forward_headers.update(headers)
 
-        logger.info(f"[gcli2api Bridge] POST {url} (stream)")
+        log_info("gcli2api Bridge", "POST %s (stream)", url)
+
+        labels = self._metric_labels(path, json_data)
 
         async def stream_generator() -> AsyncIterator[bytes]:
             """流式生成器"""
+            stream_start = time.perf_counter()
+            first_chunk = True
+            ACTIVE_STREAMS.inc(endpoint_name=labels["endpoint_name"])
             try:
                 async with httpx.AsyncClient(timeout=self.timeout) as client:
                     async with client.stream(
                         "POST",
                         url,
                         json=json_data,
-                        headers=forward_headers
+                        headers=forward_headers,
+                        extensions={"trace": UpstreamTrace(**labels)}
                     ) as response:
                         # 检查响应状态
                         if response.status_code >= 400:
                             error_text = await response.aread()
-                            logger.error(
-                                f"[gcli2api Bridge] Stream error {response.status_code}: {error_text}"
-                            )
+                            log_error("gcli2api Bridge", "Stream error %s: %s", response.status_code, error_text)
                             # 返回错误信息
                             yield f"data: {{\"error\": \"{error_text.decode()}\"}}\n\n".encode()
                             return
 
                         # 流式传输数据
                         async for chunk in response.aiter_bytes():
+                            if first_chunk:
+                                UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - stream_start, **labels)
+                                first_chunk = False
+                            if usage_tracker is not None:
+                                usage_tracker.feed(chunk)
+                            if stream_recorder is not None:
+                                stream_recorder.feed(chunk)
                             yield chunk
 
+                if stream_recorder is not None:
+                    await stream_recorder.commit()
+
             except httpx.TimeoutException:
-                logger.error(f"[gcli2api Bridge] Stream timeout: {url}")
+                log_error("gcli2api Bridge", "Stream timeout: %s", url)
                 yield b"data: {\"error\": \"gcli2api service timeout\"}\n\n"
             except httpx.ConnectError:
-                logger.error(f"[gcli2api Bridge] Stream connection failed: {url}")
+                log_error("gcli2api Bridge", "Stream connection failed: %s", url)
                 yield b"data: {\"error\": \"Cannot connect to gcli2api service\"}\n\n"
             except Exception as e:
-                logger.error(f"[gcli2api Bridge] Stream error: {str(e)}")
+                log_error("gcli2api Bridge", "Stream error: %s", str(e))
                 yield f"data: {{\"error\": \"{str(e)}\"}}\n\n".encode()
-
-        return StreamingResponse(
+            except BaseException:
+                # 客户端断开或关闭时中断（CancelledError / GeneratorExit）：日志状态码改为 499
+                if usage_tracker is not None:
+                    usage_accounting.finish_stream(usage_tracker, interrupted=True)
+                raise
+            finally:
+                ACTIVE_STREAMS.dec(endpoint_name=labels["endpoint_name"])
+                STREAM_DURATION_SECONDS.observe(time.perf_counter() - stream_start, **labels)
+                if usage_tracker is not None:
+                    usage_accounting.finish_stream(usage_tracker)
+
+        if usage_tracker is None:
+            return StreamingResponse(stream_generator(), media_type="text/event-stream")
+        # 生成器从未被迭代（响应开始前客户端断开）时 finally 不会执行，由响应结束时补记为中断
+        return ClosingStreamingResponse(
             stream_generator(),
+            lambda: usage_accounting.finish_stream(usage_tracker, interrupted=True),
             media_type="text/event-stream"
         )
 
@@ -234,11 +286,11 @@ class Gcli2apiBridge:
                         'model_cooldowns': state.get('model_cooldowns', {}),
                     })
 
-            logger.info(f"获取到 {len(credentials)} 个 GCLI 凭证")
+            log_info("gcli2api Bridge", "获取到 %s 个 GCLI 凭证", len(credentials))
             return credentials
 
         except Exception as e:
-            logger.error(f"获取 GCLI 凭证失败: {e}")
+            log_error("gcli2api Bridge", "获取 GCLI 凭证失败: %s", e)
             return []
 
     async def get_antigravity_credentials(self) -> list[Dict[str, Any]]:
@@ -270,11 +322,11 @@ class Gcli2apiBridge:
                         'model_cooldowns': state.get('model_cooldowns', {}),
                     })
 
-            logger.info(f"获取到 {len(credentials)} 个 Antigravity 凭证")
+            log_info("gcli2api Bridge", "获取到 %s 个 Antigravity 凭证", len(credentials))
             return credentials
 
         except Exception as e:
-            logger.error(f"获取 Antigravity 凭证失败: {e}")
+            log_error("gcli2api Bridge", "获取 Antigravity 凭证失败: %s", e)
             return []
 
     async def delete_gcli_credential(self, filename: str) -> bool:
@@ -294,11 +346,11 @@ class Gcli2apiBridge:
                 json_data={'filename': filename, 'action': 'delete'},
                 use_panel_password=True
             )
-            logger.info(f"成功删除 GCLI 凭证: {filename}")
+            log_info("gcli2api Bridge", "成功删除 GCLI 凭证: %s", filename)
             return True
 
         except Exception as e:
-            logger.error(f"删除 GCLI 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "删除 GCLI 凭证失败 %s: %s", filename, e)
             return False
 
     async def delete_antigravity_credential(self, filename: str) -> bool:
@@ -318,11 +370,11 @@ class Gcli2apiBridge:
                 json_data={'filename': filename, 'action': 'delete'},
                 use_panel_password=True
             )
-            logger.info(f"成功删除 Antigravity 凭证: {filename}")
+            log_info("gcli2api Bridge", "成功删除 Antigravity 凭证: %s", filename)
             return True
 
         except Exception as e:
-            logger.error(f"删除 Antigravity 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "删除 Antigravity 凭证失败 %s: %s", filename, e)
             return False
 
     async def enable_gcli_credential(self, filename: str) -> bool:
@@ -336,7 +388,7 @@ class Gcli2apiBridge:
             )
             return True
         except Exception as e:
-            logger.error(f"启用 GCLI 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "启用 GCLI 凭证失败 %s: %s", filename, e)
             return False
 
     async def disable_gcli_credential(self, filename: str) -> bool:
@@ -350,7 +402,7 @@ class Gcli2apiBridge:
             )
             return True
         except Exception as e:
-            logger.error(f"禁用 GCLI 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "禁用 GCLI 凭证失败 %s: %s", filename, e)
             return False
 
     async def enable_antigravity_credential(self, filename: str) -> bool:
@@ -364,7 +416,7 @@ class Gcli2apiBridge:
             )
             return True
         except Exception as e:
-            logger.error(f"启用 Antigravity 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "启用 Antigravity 凭证失败 %s: %s", filename, e)
             return False
 
     async def disable_antigravity_credential(self, filename: str) -> bool:
@@ -378,7 +430,7 @@ class Gcli2apiBridge:
             )
             return True
         except Exception as e:
-            logger.error(f"禁用 Antigravity 凭证失败 {filename}: {e}")
+            log_error("gcli2api Bridge", "禁用 Antigravity 凭证失败 %s: %s", filename, e)
             return False
 
     async def health_check(self) -> bool:
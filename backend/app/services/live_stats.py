@@ -0,0 +1,304 @@
+"""
+实时统计
+
+在内存中维护今日请求统计（总数 / 成功 / 失败、按模型、按状态码）、最近 1 小时请求数
+和最近 24 小时活跃用户数，向订阅了 stats 的管理员推送增量，取代“收到通知后重新拉取
+全部统计”的方式。
+
+- 启动时从数据库加载一次基线（load）
+- 之后由 Session 的 after_flush / after_commit 事件驱动，UsageLog 提交后经总线（pubsub）
+  发布，每个 worker 都计入统计，因此多 worker 部署时各自的统计一致
+- 增量每隔 ws_log_batch_interval 秒合并推送一次；跨过统计日边界时推送完整快照
+
+WebSocket 协议:
+    客户端 → {"type": "subscribe", "topics": ["stats"]}（或连接时带 ?subscribe=stats）
+    服务端 → {"type": "stats_snapshot", "seq": n, "data": {...}}
+    服务端 → {"type": "stats_delta", "seq": n, "data": {...}}
+"""
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models.user import UsageLog
+from app.services.pubsub import bus
+from app.utils.logger import log_info, log_warning
+
+
+_PENDING_KEY = "live_stats_pending"
+
+# (user_id, model, status_code, created_at)
+LogRecord = Tuple[Optional[int], Optional[str], Optional[int], datetime]
+
+
+def start_of_stats_day(now: datetime) -> datetime:
+    """统计日起点：与配额一致，北京时间 15:00 (UTC 07:00) 重置"""
+    reset_time_utc = now.replace(hour=7, minute=0, second=0, microsecond=0)
+    return reset_time_utc - timedelta(days=1) if now < reset_time_utc else reset_time_utc
+
+
+class LiveStats:
+    """内存中的实时统计"""
+
+    def __init__(self):
+        self.loaded = False
+        self.seq = 0
+        self._reset(start_of_stats_day(datetime.utcnow()))
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def _reset(self, day_start: datetime):
+        self.day_start = day_start
+        self.total = 0
+        self.success = 0
+        self.by_model: Counter = Counter()
+        self.by_status: Counter = Counter()
+        # 按分钟的请求数 {分钟序号: 数量}，用于最近 1 小时滑动窗口
+        self.minute_buckets: Dict[int, int] = {}
+        # 用户最后请求时间 {user_id: 时间戳}，用于最近 24 小时活跃用户
+        self.user_last_seen: Dict[int, float] = {}
+        self._delta_totals = Counter()
+        self._delta_models: Counter = Counter()
+        self._delta_status: Counter = Counter()
+        self._day_changed = False
+
+    # ===== 统计 =====
+
+    def _roll_day(self, now: datetime):
+        day_start = start_of_stats_day(now)
+        if day_start != self.day_start:
+            # 活跃用户和小时窗口是滑动的，跨日保留
+            minute_buckets, user_last_seen = self.minute_buckets, self.user_last_seen
+            self._reset(day_start)
+            self.minute_buckets, self.user_last_seen = minute_buckets, user_last_seen
+            self._day_changed = True
+
+    def record(self, records: Iterable[LogRecord]):
+        """计入新提交的使用日志"""
+        now = datetime.utcnow()
+        self._roll_day(now)
+        for user_id, model, status_code, created_at in records:
+            created_at = created_at or now
+            ts = _epoch(created_at)
+            minute = int(ts // 60)
+            self.minute_buckets[minute] = self.minute_buckets.get(minute, 0) + 1
+            if user_id is not None:
+                self.user_last_seen[user_id] = max(self.user_last_seen.get(user_id, 0), ts)
+            if created_at < self.day_start:
+                continue
+            ok = status_code == 200
+            self.total += 1
+            self.success += ok
+            self._delta_totals["total"] += 1
+            self._delta_totals["success" if ok else "failed"] += 1
+            if model:
+                self.by_model[model] += 1
+                self._delta_models[model] += 1
+            if status_code is not None:
+                self.by_status[str(status_code)] += 1
+                self._delta_status[str(status_code)] += 1
+        self._schedule_flush()
+
+    def last_hour(self) -> int:
+        current = int(time.time() // 60)
+        for minute in [m for m in self.minute_buckets if m <= current - 60]:
+            del self.minute_buckets[minute]
+        return sum(self.minute_buckets.values())
+
+    def active_users(self) -> int:
+        cutoff = time.time() - 86400
+        for user_id in [u for u, ts in self.user_last_seen.items() if ts < cutoff]:
+            del self.user_last_seen[user_id]
+        return len(self.user_last_seen)
+
+    def snapshot(self) -> dict:
+        self._roll_day(datetime.utcnow())
+        return {
+            "day_start": self.day_start.isoformat() + "Z",
+            "today": {
+                "total": self.total,
+                "success": self.success,
+                "failed": self.total - self.success,
+            },
+            "by_model": dict(self.by_model.most_common()),
+            "by_status": dict(self.by_status),
+            "last_hour": self.last_hour(),
+            "active_users": self.active_users(),
+        }
+
+    def take_message(self) -> Optional[dict]:
+        """取出待推送的消息：跨日时为完整快照，否则为增量"""
+        if self._day_changed:
+            self._day_changed = False
+            self._delta_totals.clear()
+            self._delta_models.clear()
+            self._delta_status.clear()
+            self.seq += 1
+            return {"type": "stats_snapshot", "seq": self.seq, "data": self.snapshot()}
+        if not self._delta_totals:
+            return None
+        delta = {
+            "today": {k: self._delta_totals.get(k, 0) for k in ("total", "success", "failed")},
+            "by_model": dict(self._delta_models),
+            "by_status": dict(self._delta_status),
+            # 滑动窗口不是单调的，直接给当前值
+            "last_hour": self.last_hour(),
+            "active_users": self.active_users(),
+        }
+        self._delta_totals.clear()
+        self._delta_models.clear()
+        self._delta_status.clear()
+        self.seq += 1
+        return {"type": "stats_delta", "seq": self.seq, "data": delta}
+
+    async def subscribe(self, websocket) -> bool:
+        """
+        为管理员连接订阅实时统计并下发快照
+
+        先把尚未推送的增量发给已有订阅者，保证新订阅者的快照与后续增量衔接（seq 连续）。
+        """
+        from app.services.websocket import manager
+
+        if websocket not in manager.admin_connections:
+            return False
+        pending = self.take_message()
+        if pending and manager.stats_subscribers:
+            manager.send_to_stats_subscribers(pending)
+        manager.subscribe_stats(websocket)
+        await manager.send_to_socket(websocket, {"type": "stats_snapshot", "seq": self.seq, "data": self.snapshot()})
+        return True
+
+    # ===== 推送 =====
+
+    def _schedule_flush(self):
+        from app.services.websocket import timer_pending
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if timer_pending(self._flush_handle):
+            return
+        self._flush_handle = loop.call_later(settings.ws_log_batch_interval, self._flush)
+
+    def _flush(self):
+        from app.services.websocket import manager
+
+        self._flush_handle = None
+        if not manager.stats_subscribers:
+            # 无人订阅时不生成增量，但计数照常累加
+            self._delta_totals.clear()
+            self._delta_models.clear()
+            self._delta_status.clear()
+            return
+        message = self.take_message()
+        if message:
+            manager.send_to_stats_subscribers(message)
+
+    # ===== 基线 =====
+
+    async def load(self, db):
+        """从数据库加载今日统计基线"""
+        now = datetime.utcnow()
+        day_start = start_of_stats_day(now)
+        hour_ago = now - timedelta(hours=1)
+        day_ago = now - timedelta(days=1)
+
+        today = (await db.execute(
+            select(UsageLog.model, UsageLog.status_code, func.count(UsageLog.id))
+            .where(UsageLog.created_at >= day_start)
+            .group_by(UsageLog.model, UsageLog.status_code)
+        )).all()
+
+        if db.get_bind().dialect.name == "postgresql":
+            minute_expr = func.date_trunc("minute", UsageLog.created_at)
+        else:
+            minute_expr = func.strftime("%Y-%m-%d %H:%M:00", UsageLog.created_at)
+        minutes = (await db.execute(
+            select(minute_expr, func.count(UsageLog.id))
+            .where(UsageLog.created_at >= hour_ago)
+            .group_by(minute_expr)
+        )).all()
+
+        users = (await db.execute(
+            select(UsageLog.user_id, func.max(UsageLog.created_at))
+            .where(UsageLog.created_at >= day_ago)
+            .group_by(UsageLog.user_id)
+        )).all()
+
+        self._reset(day_start)
+        for model, status_code, count in today:
+            self.total += count
+            if status_code == 200:
+                self.success += count
+            if model:
+                self.by_model[model] += count
+            if status_code is not None:
+                self.by_status[str(status_code)] += count
+        for minute_value, count in minutes:
+            if isinstance(minute_value, str):
+                minute_value = datetime.fromisoformat(minute_value)
+            if minute_value is not None:
+                self.minute_buckets[int(_epoch(minute_value) // 60)] = count
+        for user_id, last_seen in users:
+            if user_id is not None and last_seen is not None:
+                if isinstance(last_seen, str):
+                    last_seen = datetime.fromisoformat(last_seen)
+                self.user_last_seen[user_id] = _epoch(last_seen)
+        self.loaded = True
+        log_info("LiveStats", f"实时统计基线已加载: 今日 {self.total} 次请求")
+
+
+def _epoch(value: datetime) -> float:
+    if value.tzinfo:
+        return value.timestamp()
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+
+# 全局实例
+live_stats = LiveStats()
+
+
+# ===== Session 事件：UsageLog 提交后计入统计 =====
+
+@event.listens_for(Session, "after_flush")
+def _collect_usage_logs(session, flush_context):
+    records: List[LogRecord] = [
+        (obj.__dict__.get("user_id"), obj.__dict__.get("model"),
+         obj.__dict__.get("status_code"), obj.__dict__.get("created_at"))
+        for obj in session.new if isinstance(obj, UsageLog)
+    ]
+    if records:
+        session.info.setdefault(_PENDING_KEY, []).extend(records)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_usage_logs(session):
+    records = session.info.pop(_PENDING_KEY, None)
+    if records:
+        bus.publish("usage_logs", [
+            [user_id, model, status_code, created_at.isoformat() if created_at else None]
+            for user_id, model, status_code, created_at in records
+        ])
+
+
+def _on_usage_logs(data):
+    try:
+        live_stats.record(
+            (user_id, model, status_code, datetime.fromisoformat(created_at) if created_at else None)
+            for user_id, model, status_code, created_at in data
+        )
+    except Exception as e:
+        log_warning("LiveStats", f"实时统计更新失败: {e}")
+
+
+bus.subscribe("usage_logs", _on_usage_logs)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_usage_logs(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,357 @@
+"""
+运行指标采集
+
+提供 Prometheus 文本格式的计数器 / 直方图 / 仪表盘，由 /metrics 接口导出。
+不依赖 prometheus_client，所有指标都在进程内存中累加。
+
+代理链路各阶段的耗时直方图：
+- 鉴权、配额检查、请求体解析（进入端点轮询之前）
+- 上游建连、首字节时间（TTFB）、流式总时长（按端点）
+- 使用日志写入
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# 每个指标最多保留的标签组合数，超出后归入 __overflow__（防止用户传入的模型名撑爆内存）
+MAX_SERIES_PER_METRIC = 1000
+OVERFLOW_LABEL = "__overflow__"
+
+# 默认耗时分桶（秒）：覆盖从亚毫秒级的内存操作到几分钟的长流式响应
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类：负责标签校验与序列数量上限"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 collector: Optional[Callable[[], Iterable[Tuple[dict, float]]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collector = collector
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES_PER_METRIC:
+            return tuple(OVERFLOW_LABEL for _ in self.labelnames)
+        return key
+
+    def _header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+
+    def _items(self) -> List[Tuple[Tuple[str, ...], float]]:
+        """传入 collector 时在抓取时实时读取，否则读取 set / inc 记录的值"""
+        if self.collector is not None:
+            try:
+                return [
+                    (tuple(str(labels.get(n, "")) for n in self.labelnames), value)
+                    for labels, value in self.collector()
+                ]
+            except Exception:
+                return []
+        with self._lock:
+            return list(self._series.items())
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    单调递增计数器
+
+    可以直接 inc，也可以传入 collector 回调在抓取时读取其他模块维护的累计值
+    """
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = self._header()
+        for key, value in self._items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    仪表盘
+
+    可以直接 set / inc / dec，也可以传入 collector 回调在抓取时实时读取，
+    回调返回 [(标签字典, 值), ...]。
+    """
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self) -> List[str]:
+        lines = self._header()
+        for key, value in self._items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # [各桶计数..., 总和, 总数]
+                series = [0] * len(self.buckets) + [0.0, 0]
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """统计代码块耗时：with HISTOGRAM.time(endpoint_name=..., model=...): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标重复注册: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                collector: Optional[Callable] = None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, collector))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+              collector: Optional[Callable] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collector))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+# 全局注册表
+registry = MetricsRegistry()
+
+STAGE_LABELS = ("endpoint_name", "model")
+
+
+# ===== 代理链路各阶段耗时 =====
+AUTH_SECONDS = registry.histogram(
+    "proxy_auth_seconds", "API Key 鉴权耗时", STAGE_LABELS)
+QUOTA_CHECK_SECONDS = registry.histogram(
+    "proxy_quota_check_seconds", "配额检查耗时", STAGE_LABELS)
+BODY_PARSE_SECONDS = registry.histogram(
+    "proxy_body_parse_seconds", "请求体 JSON 解析耗时", STAGE_LABELS)
+UPSTREAM_CONNECT_SECONDS = registry.histogram(
+    "proxy_upstream_connect_seconds", "上游 TCP/TLS 建连耗时（复用连接时不产生样本）", STAGE_LABELS)
+UPSTREAM_TTFB_SECONDS = registry.histogram(
+    "proxy_upstream_ttfb_seconds", "发出上游请求到收到首字节的耗时", STAGE_LABELS)
+STREAM_DURATION_SECONDS = registry.histogram(
+    "proxy_stream_duration_seconds", "流式响应总时长", STAGE_LABELS)
+LOG_WRITE_SECONDS = registry.histogram(
+    "proxy_log_write_seconds", "使用日志写入耗时", STAGE_LABELS)
+DB_SESSION_SECONDS = registry.histogram(
+    "db_session_seconds", "get_db 会话从创建到关闭的持续时间")
+
+# ===== 计数器 =====
+FALLBACKS_TOTAL = registry.counter(
+    "proxy_fallbacks_total", "端点失败后切换到下一个端点的次数", STAGE_LABELS)
+ENDPOINT_ERRORS_TOTAL = registry.counter(
+    "proxy_endpoint_errors_total", "各端点请求失败次数", ("endpoint_name", "status_code"))
+CACHE_HITS_TOTAL = registry.counter(
+    "cache_hits_total", "缓存命中次数", ("cache",))
+CACHE_MISSES_TOTAL = registry.counter(
+    "cache_misses_total", "缓存未命中次数", ("cache",))
+PREFIX_AFFINITY_TOTAL = registry.counter(
+    "prefix_affinity_total", "前缀亲和路由结果：home 首选端点 / spill 让给后备端点 / overloaded 全部过载", ("result",))
+
+# ===== 仪表盘 =====
+ACTIVE_STREAMS = registry.gauge(
+    "proxy_active_streams", "正在进行的流式响应数", ("endpoint_name",))
+DB_SESSIONS_ACTIVE = registry.gauge(
+    "db_sessions_active", "通过 get_db 打开且尚未关闭的会话数")
+
+
+def _collect_db_pool() -> List[Tuple[dict, float]]:
+    from app.database import get_pool_stats
+
+    samples = []
+    for pool_name, stats in get_pool_stats().items():
+        for field in ("size", "checked_out", "checked_in", "overflow"):
+            if field in stats:
+                samples.append(({"pool": pool_name, "state": field}, stats[field]))
+    return samples
+
+
+def _collect_websocket() -> List[Tuple[dict, float]]:
+    from app.services.websocket import manager
+
+    total = sum(len(conns) for conns in manager.active_connections.values())
+    return [
+        ({"role": "all"}, total),
+        ({"role": "admin"}, len(manager.admin_connections)),
+    ]
+
+
+def _collect_openai_in_flight() -> List[Tuple[dict, float]]:
+    from app.services.endpoint_registry import endpoint_registry
+
+    return [({"endpoint_name": f"openai:{name}"}, count) for name, count in endpoint_registry.in_flight().items()]
+
+
+def _collect_log_queue() -> List[Tuple[dict, float]]:
+    from app.utils.logger import get_log_stats
+
+    return [({}, get_log_stats()["queued"])]
+
+
+def _collect_log_dropped() -> List[Tuple[dict, float]]:
+    from app.utils.logger import get_log_stats
+
+    stats = get_log_stats()
+    return [
+        ({"reason": "queue_full"}, stats["dropped"]),
+        ({"reason": "sampled"}, stats["sampled"]),
+    ]
+
+
+DB_POOL_CONNECTIONS = registry.gauge(
+    "db_pool_connections", "数据库连接池使用情况", ("pool", "state"), collector=_collect_db_pool)
+WEBSOCKET_CONNECTIONS = registry.gauge(
+    "websocket_connections", "WebSocket 连接数", ("role",), collector=_collect_websocket)
+OPENAI_IN_FLIGHT = registry.gauge(
+    "openai_endpoint_in_flight", "OpenAI 端点在途请求数", ("endpoint_name",), collector=_collect_openai_in_flight)
+LOG_QUEUE_RECORDS = registry.gauge(
+    "log_queue_records", "日志管道队列中等待写出的日志条数", collector=_collect_log_queue)
+LOG_DROPPED_TOTAL = registry.counter(
+    "log_records_dropped_total", "日志管道丢弃的日志条数：queue_full 队列满 / sampled 采样", ("reason",),
+    collector=_collect_log_dropped)
+
+
+def _collect_response_cache() -> List[Tuple[dict, float]]:
+    from app.services.response_cache import response_cache
+
+    stats = response_cache.stats()
+    return [
+        ({"tier": "memory"}, stats["memory_bytes"]),
+        ({"tier": "disk"}, stats["disk_bytes"]),
+    ]
+
+
+RESPONSE_CACHE_BYTES = registry.gauge(
+    "response_cache_bytes", "响应缓存占用的字节数", ("tier",), collector=_collect_response_cache)
+
+
+class UpstreamTrace:
+    """
+    httpx 的 trace 扩展回调，记录上游建连耗时（TCP + TLS）
+
+    用法: client.post(url, ..., extensions={"trace": UpstreamTrace("gcli2api", model)})
+    连接池复用已有连接时不会触发建连事件，也就不产生样本。
+    """
+
+    def __init__(self, endpoint_name: str, model: str = ""):
+        self.labels = {"endpoint_name": endpoint_name, "model": model}
+        self._connect_started: Optional[float] = None
+
+    async def __call__(self, event_name: str, info: dict):
+        if event_name in ("connection.connect_tcp.started", "connection.connect_unix_socket.started"):
+            self._connect_started = time.perf_counter()
+        elif event_name.endswith(".send_request_headers.started") and self._connect_started is not None:
+            # 开始发送请求头意味着 TCP/TLS 都已就绪
+            UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - self._connect_started, **self.labels)
+            self._connect_started = None
@@ -0,0 +1,200 @@
+"""
+模型目录（/v1/models）
+
+合并内置模型和各 OpenAI 兼容端点的上游模型列表，预先序列化为 JSON 字节并计算 ETag，
+请求时直接返回内存中的响应体（支持 If-None-Match → 304）。
+
+- 刷新时并发请求所有启用端点的 /v1/models，每个端点单独超时
+- 过期后先返回旧数据，同时在后台刷新（stale-while-revalidate）；只有首次构建需要等待
+- 某个端点刷新失败时保留它上一次成功的模型列表
+- 管理员增删改端点后经总线通知所有 worker 重新刷新
+- 刷新后同步更新模型路由表（model_router）
+"""
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from app.config import settings
+from app.services.endpoint_registry import endpoint_registry
+from app.services.metrics import CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL
+from app.services.model_router import (
+    model_router, GEMINI_BASE_MODELS, THINKING_SUFFIXES, SEARCH_SUFFIX,
+    GEMINI_IMAGE_MODELS, ANTIGRAVITY_MODELS, CLAUDE_MODELS
+)
+from app.services.pubsub import bus
+from app.services.upstream_clients import upstream_clients
+from app.utils.logger import log_warning
+
+
+def _builtin_models() -> List[dict]:
+    """内置模型（Gemini / Antigravity / Claude，无前缀，自动轮询）"""
+    models = []
+    for base in GEMINI_BASE_MODELS:
+        # 基础模型
+        models.append({"id": base, "object": "model", "owned_by": "google"})
+        # thinking 变体
+        for suffix in THINKING_SUFFIXES:
+            models.append({"id": f"{base}{suffix}", "object": "model", "owned_by": "google"})
+        # search 变体
+        models.append({"id": f"{base}{SEARCH_SUFFIX}", "object": "model", "owned_by": "google"})
+        # thinking + search 组合
+        for suffix in THINKING_SUFFIXES:
+            models.append({"id": f"{base}{suffix}{SEARCH_SUFFIX}", "object": "model", "owned_by": "google"})
+
+    # Image 模型 / Antigravity 特有模型
+    for model_id in GEMINI_IMAGE_MODELS + ANTIGRAVITY_MODELS:
+        models.append({"id": model_id, "object": "model", "owned_by": "google"})
+
+    # Claude 模型
+    for model_id in CLAUDE_MODELS:
+        models.append({"id": model_id, "object": "model", "owned_by": "anthropic"})
+    return models
+
+
+class ModelCatalog:
+    """预构建的模型列表响应"""
+
+    def __init__(self):
+        self.body: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.built_at = 0.0
+        # {endpoint_id: 上次成功获取的模型列表}
+        self._endpoint_models: Dict[int, List[dict]] = {}
+        self._endpoint_errors: Dict[int, str] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        # 刷新进行中收到失效通知：本轮读到的可能是旧端点，结束后再刷新一次
+        self._dirty = False
+        self._builtin = _builtin_models()
+
+    @property
+    def fresh(self) -> bool:
+        return self.body is not None and time.time() - self.built_at < settings.models_cache_ttl
+
+    async def get(self) -> Tuple[bytes, str]:
+        """返回 (响应体, ETag)；过期时返回旧数据并在后台刷新"""
+        if self.body is None:
+            CACHE_MISSES_TOTAL.inc(cache="models")
+            await self.refresh()
+        else:
+            CACHE_HITS_TOTAL.inc(cache="models")
+            if not self.fresh:
+                self.refresh_in_background()
+        return self.body, self.etag
+
+    def refresh_in_background(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def refresh(self):
+        """刷新（已有刷新在进行时等待它完成）"""
+        self.refresh_in_background()
+        await asyncio.shield(self._refresh_task)
+
+    def invalidate(self):
+        """端点变更后调用：立即在后台重新刷新，期间仍返回旧数据"""
+        self.built_at = 0.0
+        model_router.mark_endpoints_changed()
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._dirty = True
+            return
+        try:
+            self.refresh_in_background()
+        except RuntimeError:
+            # 无事件循环，下次请求时刷新
+            pass
+
+    async def _refresh(self):
+        self._dirty = False
+        try:
+            await self._rebuild()
+        finally:
+            if self._dirty:
+                self.built_at = 0.0
+                asyncio.get_running_loop().call_soon(self.refresh_in_background)
+
+    async def _rebuild(self):
+        try:
+            endpoints = [(ep.id, ep.name, ep.base_url, ep.api_key) for ep in await endpoint_registry.get_active()]
+        except Exception as e:
+            log_warning("Models", f"读取 OpenAI 端点失败，沿用旧模型列表: {e}")
+            endpoints = None
+
+        if endpoints is not None:
+            results = await asyncio.gather(
+                *(self._fetch(upstream_clients.get(base_url), name, base_url, api_key)
+                  for _, name, base_url, api_key in endpoints),
+                return_exceptions=True,
+            )
+            active_ids = {endpoint_id for endpoint_id, *_ in endpoints}
+            for endpoint_id in list(self._endpoint_models):
+                if endpoint_id not in active_ids:
+                    del self._endpoint_models[endpoint_id]
+            self._endpoint_errors.clear()
+            for (endpoint_id, name, _, _), fetched in zip(endpoints, results):
+                if isinstance(fetched, BaseException):
+                    # 静默失败，保留该端点上一次的模型列表
+                    error = str(fetched) or type(fetched).__name__
+                    self._endpoint_errors[endpoint_id] = error
+                    log_warning("Models", f"从 {name} 获取模型失败: {error}")
+                else:
+                    self._endpoint_models[endpoint_id] = fetched
+            order = [endpoint_id for endpoint_id, *_ in endpoints]
+            # 更新路由表：没有成功获取过列表的端点能力未知
+            model_router.update_openai(
+                {endpoint_id: [m["id"] for m in models] for endpoint_id, models in self._endpoint_models.items()},
+                unknown=[endpoint_id for endpoint_id in order if endpoint_id not in self._endpoint_models],
+            )
+        else:
+            order = list(self._endpoint_models)
+
+        models = list(self._builtin)
+        for endpoint_id in order:
+            models.extend(self._endpoint_models.get(endpoint_id, ()))
+        self.body = json.dumps({"object": "list", "data": models}, ensure_ascii=False, separators=(",", ":")).encode()
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        self.built_at = time.time()
+
+    @staticmethod
+    async def _fetch(client: httpx.AsyncClient, name: str, base_url: str, api_key: str) -> List[dict]:
+        # 转发时使用 {base_url}/chat/completions，base_url 通常已包含 /v1
+        models_url = f"{base_url}/models" if base_url.endswith("/v1") else f"{base_url}/v1/models"
+        response = await asyncio.wait_for(
+            client.get(models_url, headers={"Authorization": f"Bearer {api_key}"}),
+            timeout=settings.models_fetch_timeout,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        upstream_data = response.json()
+        endpoint_models = []
+        for model in upstream_data.get("data") or []:
+            model_id = model.get("id", "")
+            if model_id:
+                endpoint_models.append({
+                    "id": model_id,
+                    "object": "model",
+                    "owned_by": model.get("owned_by", name)
+                })
+        return endpoint_models
+
+    def status(self) -> dict:
+        return {
+            "built_at": self.built_at,
+            "fresh": self.fresh,
+            "etag": self.etag,
+            "endpoints": {endpoint_id: len(models) for endpoint_id, models in self._endpoint_models.items()},
+            "errors": dict(self._endpoint_errors),
+        }
+
+
+# 全局实例
+model_catalog = ModelCatalog()
+
+bus.subscribe("model_catalog_invalidate", lambda _: model_catalog.invalidate())
+
+
+def invalidate_model_catalog():
+    """通知所有 worker 的模型目录重新刷新"""
+    bus.publish("model_catalog_invalidate")
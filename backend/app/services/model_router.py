@@ -0,0 +1,163 @@
+"""
+模型路由表
+
+根据请求的模型决定要尝试哪些端点，跳过不可能成功的端点（例如 gpt-4o 不再先打到
+gcli2api / antigravity，claude-* 不再打到 gcli2api）。
+
+- 内置端点（gcli2api / antigravity）的能力来自静态模型列表和前缀规则，
+  模型名先去掉 -maxthinking / -nothinking / -search 等后缀再匹配
+- OpenAI 端点的能力来自模型目录（model_catalog）获取的各端点 /v1/models
+- 完全未知的模型保持原有行为：按 endpoint_priority 全部尝试
+- 尚未获取到模型列表的 OpenAI 端点（新建、获取失败）能力未知，作为兜底保留在最后
+"""
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.utils.logger import log_debug
+
+
+# 基础 Gemini 模型（gcli2api 和 antigravity 都支持）
+GEMINI_BASE_MODELS = [
+    "gemini-2.5-pro",
+    "gemini-2.5-flash",
+    "gemini-3-pro-preview",
+    "gemini-3-flash-preview",
+]
+# 模型后缀（可组合，如 -maxthinking-search）
+THINKING_SUFFIXES = ["-maxthinking", "-nothinking"]
+SEARCH_SUFFIX = "-search"
+GEMINI_IMAGE_MODELS = ["gemini-2.5-flash-image"]
+# Antigravity 特有模型
+ANTIGRAVITY_MODELS = [
+    "gemini-3-pro-low",
+    "gemini-3-pro-high",
+    "gemini-3-pro-image",
+    "gemini-2.5-flash-lite",
+]
+# Claude 模型（仅 antigravity）
+CLAUDE_MODELS = [
+    "claude-sonnet-4-5",
+    "claude-sonnet-4-5-thinking",
+    "claude-opus-4-5-thinking",
+]
+
+BOTH = ("gcli2api", "antigravity")
+
+# 不在静态列表中时按前缀判断内置端点能力（空元组表示内置端点都不支持）
+PREFIX_ROUTES: List[Tuple[str, Tuple[str, ...]]] = [
+    ("claude-", ("antigravity",)),
+    ("gpt-", ()),
+    ("o1", ()),
+    ("o3", ()),
+    ("o4", ()),
+    ("deepseek-", ()),
+    ("qwen", ()),
+]
+
+
+def base_model(model: str) -> str:
+    """去掉 thinking / search 后缀"""
+    changed = True
+    while changed:
+        changed = False
+        for suffix in (SEARCH_SUFFIX, *THINKING_SUFFIXES):
+            if model.endswith(suffix) and len(model) > len(suffix):
+                model = model[:-len(suffix)]
+                changed = True
+    return model
+
+
+class ModelRouter:
+    """模型 -> 可用端点 索引"""
+
+    def __init__(self):
+        self._builtin: Dict[str, Tuple[str, ...]] = {}
+        for model in GEMINI_BASE_MODELS + GEMINI_IMAGE_MODELS:
+            self._builtin[model] = BOTH
+        for model in ANTIGRAVITY_MODELS + CLAUDE_MODELS:
+            self._builtin[model] = ("antigravity",)
+        # {模型 id: [OpenAI 端点 id]}，由模型目录刷新后更新
+        self._openai: Dict[str, Set[int]] = {}
+        # 已知模型列表的 OpenAI 端点
+        self._openai_known: Set[int] = set()
+        # 启用但从未成功获取模型列表的 OpenAI 端点
+        self._openai_unknown: Set[int] = set()
+        # 模型目录尚未加载，或端点增删改后尚未刷新：可能存在能力未知的端点
+        self._openai_pending = True
+
+    # ===== 更新 =====
+
+    def update_openai(self, endpoint_models: Dict[int, Iterable[str]], unknown: Iterable[int] = ()):
+        """
+        模型目录刷新后调用
+
+        endpoint_models: {端点 id: 模型 id 列表}，只包含已成功获取列表的端点
+        unknown: 启用但尚未获取到模型列表的端点 id
+        """
+        index: Dict[str, Set[int]] = {}
+        for endpoint_id, models in endpoint_models.items():
+            for model in models:
+                index.setdefault(model, set()).add(endpoint_id)
+        self._openai = index
+        self._openai_known = set(endpoint_models)
+        self._openai_unknown = set(unknown) - self._openai_known
+        self._openai_pending = False
+
+    def mark_endpoints_changed(self):
+        """端点增删改后调用：在下次目录刷新前把未知端点视为可能可用"""
+        self._openai_pending = True
+
+    # ===== 查询 =====
+
+    def builtin_backends(self, model: str) -> Optional[Tuple[str, ...]]:
+        """内置端点能力；None 表示未知"""
+        backends = self._builtin.get(model)
+        if backends is None:
+            backends = self._builtin.get(base_model(model))
+        if backends is None:
+            for prefix, routed in PREFIX_ROUTES:
+                if model.startswith(prefix):
+                    return routed
+        return backends
+
+    def plan(self, model: str, priority: List[str]) -> List[str]:
+        """按优先级返回要尝试的端点类型（gcli2api / antigravity / openai）"""
+        builtin = self.builtin_backends(model)
+        openai_ids = self._openai.get(model)
+        if builtin is None and not openai_ids:
+            # 未知模型：保持原有顺序全部尝试
+            return list(priority)
+
+        allowed = set(builtin or ())
+        if openai_ids or self._openai_unknown or self._openai_pending:
+            allowed.add("openai")
+        planned = [name for name in priority if name in allowed]
+        if len(planned) < len(priority):
+            log_debug("Router", "模型 %s 路由到: %s", model, ", ".join(planned) or "无")
+        return planned
+
+    def openai_candidates(self, model: str, endpoints: list) -> list:
+        """
+        过滤并排序 OpenAI 端点（保持原优先级）
+
+        声明支持该模型的端点在前，能力未知的端点在后，已知不支持的端点跳过；
+        没有任何端点声明支持且模型完全未知时返回全部端点。
+        """
+        openai_ids = self._openai.get(model, set())
+        if not openai_ids and self.builtin_backends(model) is None:
+            return list(endpoints)
+        serving = [ep for ep in endpoints if ep.id in openai_ids]
+        unknown = [ep for ep in endpoints if ep.id not in self._openai_known]
+        return serving + unknown
+
+    def status(self) -> dict:
+        return {
+            "builtin_models": len(self._builtin),
+            "openai_models": len(self._openai),
+            "openai_endpoints_known": sorted(self._openai_known),
+            "openai_endpoints_unknown": sorted(self._openai_unknown),
+            "pending": self._openai_pending,
+        }
+
+
+# 全局实例
+model_router = ModelRouter()
@@ -0,0 +1,66 @@
+"""
+提示词前缀亲和路由
+
+Gemini / Claude 等上游对重复的长前缀（系统提示词、角色卡）有上下文缓存，同一前缀持续发往
+同一账号 / 端点时命中率最高。这里对会话开头 prefix_affinity_bytes 字节（system + messages /
+contents 按顺序拼接）计算指纹，再用 rendezvous（最高随机权重）哈希把指纹映射到成员：
+
+- 同一指纹在成员列表不变时总是排出同样的顺序，增删成员只影响落在该成员上的指纹
+- 短于 prefix_affinity_min_bytes 的会话没有可复用的前缀，不做亲和
+- 负载上限和冷却由调用方处理（见 EndpointRegistry.affinity）
+
+gcli2api / Antigravity 的凭证由 gcli2api 自行选择，这里只作用于 OpenAI 端点。
+"""
+import hashlib
+from typing import Callable, Iterator, List, Optional, TypeVar
+
+from app.config import settings
+
+T = TypeVar("T")
+
+_PREFIX_KEYS = ("system", "systemInstruction", "system_instruction", "messages", "contents")
+
+
+def _texts(value) -> Iterator[str]:
+    """按出现顺序遍历消息中的字符串（含角色名）"""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, list):
+        for item in value:
+            yield from _texts(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _texts(item)
+
+
+def prefix_fingerprint(body: dict) -> Optional[str]:
+    """会话开头 prefix_affinity_bytes 字节的指纹；未启用或前缀太短时返回 None"""
+    if not settings.prefix_affinity_enabled:
+        return None
+    limit = settings.prefix_affinity_bytes
+    digest = hashlib.blake2b(digest_size=8)
+    taken = 0
+    for key in _PREFIX_KEYS:
+        value = body.get(key)
+        if value is None:
+            continue
+        for text in _texts(value):
+            # 先按字符截断（字符数 <= 字节数），避免对超长文本整体编码
+            data = text[:limit - taken].encode("utf-8")[:limit - taken]
+            digest.update(data)
+            digest.update(b"\x00")
+            taken += len(data)
+            if taken >= limit:
+                return digest.hexdigest()
+    if taken < settings.prefix_affinity_min_bytes:
+        return None
+    return digest.hexdigest()
+
+
+def rendezvous_rank(fingerprint: str, members: List[T], key: Callable[[T], object]) -> List[T]:
+    """按 hash(指纹, 成员) 从高到低排序成员"""
+    def score(member) -> int:
+        data = f"{fingerprint}:{key(member)}".encode()
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+    return sorted(members, key=score, reverse=True)
@@ -0,0 +1,371 @@
+"""
+进程间发布/订阅总线
+
+WebSocket 推送（日志、统计、凭证/用户变更）和实时统计记录都先发布到总线，
+每个 worker 收到后只推送给自己持有的连接。多 worker / 多节点部署时，
+连接在 worker A 的管理员也能看到 worker B 产生的日志。
+
+后端（PUBSUB_BACKEND）:
+- memory:   进程内直接分发（单 worker）
+- postgres: PostgreSQL LISTEN/NOTIFY，多节点共用同一个数据库即可，无需额外中间件
+- unix:     本机 Unix socket 集线器，第一个启动的 worker 充当集线器，其余 worker 连接它；
+            集线器退出后其余 worker 自动重新选举（适合 SQLite + 多 worker）
+- auto:     使用 PostgreSQL 时为 postgres，否则为 memory
+
+发布是非阻塞的（可在同步代码如 Session 事件中调用），消息体必须可 JSON 序列化。
+"""
+import asyncio
+import json
+import os
+import random
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+
+from app.config import settings
+from app.utils.logger import log_info, log_warning, log_error
+
+
+Handler = Callable[[dict], None]
+
+# PostgreSQL NOTIFY 负载上限为 8000 字节
+PG_PAYLOAD_LIMIT = 7900
+PG_CHANNEL = "catie_pubsub"
+
+
+class PubSub:
+    """总线基类：负责本地订阅者分发，子类实现跨进程传输"""
+
+    backend = "memory"
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex[:12]
+        self._handlers: Dict[str, List[Handler]] = defaultdict(list)
+        self.started = False
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, channel: str, handler: Handler):
+        """注册本地处理函数（在事件循环中以同步方式调用）"""
+        self._handlers[channel].append(handler)
+
+    def _deliver(self, channel: str, data):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(data)
+            except Exception as e:
+                log_error("PubSub", f"处理 {channel} 消息失败: {e}")
+
+    def publish(self, channel: str, data=None):
+        """发布消息（非阻塞）"""
+        self.published += 1
+        self._deliver_soon(channel, data)
+
+    def _deliver_soon(self, channel: str, data):
+        try:
+            asyncio.get_running_loop().call_soon(self._deliver, channel, data)
+        except RuntimeError:
+            self._deliver(channel, data)
+
+    async def start(self):
+        self.started = True
+
+    async def stop(self):
+        self.started = False
+
+    def status(self) -> dict:
+        return {
+            "backend": self.backend,
+            "node_id": self.node_id,
+            "started": self.started,
+            "published": self.published,
+            "received": self.received,
+        }
+
+
+class MemoryPubSub(PubSub):
+    """进程内总线"""
+
+
+class PostgresPubSub(PubSub):
+    """
+    基于 PostgreSQL LISTEN/NOTIFY 的总线
+
+    使用两条独立的 asyncpg 连接：一条 LISTEN，一条由发送任务批量 NOTIFY。
+    本节点发布的消息直接本地分发，收到带有自身 node_id 的通知时忽略。
+    """
+
+    backend = "postgres"
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self._listen_conn = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def publish(self, channel: str, data=None):
+        self.published += 1
+        self._deliver_soon(channel, data)
+        if not self.started or self._queue is None:
+            return
+        payload = json.dumps({"n": self.node_id, "c": channel, "d": data}, separators=(",", ":"), ensure_ascii=False)
+        if len(payload.encode()) > PG_PAYLOAD_LIMIT:
+            log_warning("PubSub", f"{channel} 消息超过 NOTIFY 上限，仅在本节点分发")
+            return
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            log_warning("PubSub", "NOTIFY 发送队列已满，丢弃消息")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("n") == self.node_id:
+            return
+        self.received += 1
+        self._deliver(message.get("c"), message.get("d"))
+
+    async def start(self):
+        import asyncpg
+
+        self._queue = asyncio.Queue(maxsize=10000)
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        await self._listen_conn.add_listener(PG_CHANNEL, self._on_notify)
+        self._tasks.append(asyncio.create_task(self._sender()))
+        self.started = True
+        log_info("PubSub", f"PostgreSQL LISTEN/NOTIFY 总线已启动 (node={self.node_id})")
+
+    async def _sender(self):
+        import asyncpg
+
+        conn = None
+        while True:
+            payload = await self._queue.get()
+            batch = [payload]
+            while not self._queue.empty() and len(batch) < 100:
+                batch.append(self._queue.get_nowait())
+            try:
+                if conn is None or conn.is_closed():
+                    conn = await asyncpg.connect(self.dsn)
+                await conn.executemany("SELECT pg_notify($1, $2)", [(PG_CHANNEL, p) for p in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_warning("PubSub", f"NOTIFY 发送失败，丢弃 {len(batch)} 条: {e}")
+                conn = None
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        self.started = False
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        if self._listen_conn is not None:
+            try:
+                await self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+
+
+class UnixSocketPubSub(PubSub):
+    """
+    本机 Unix socket 集线器总线
+
+    每个 worker 先尝试连接 socket；连接不上则自己绑定成为集线器。
+    集线器把收到的消息转发给其余所有连接并在本地分发；
+    非集线器 worker 把消息发给集线器，同时在本地分发。
+    """
+
+    backend = "unix"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.is_hub = False
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._hub_writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock_fd: Optional[int] = None
+
+    @staticmethod
+    def _encode(node_id: str, channel: str, data) -> bytes:
+        return (json.dumps({"n": node_id, "c": channel, "d": data}, separators=(",", ":"), ensure_ascii=False) + "\n").encode()
+
+    def publish(self, channel: str, data=None):
+        self.published += 1
+        self._deliver_soon(channel, data)
+        if not self.started:
+            return
+        line = self._encode(self.node_id, channel, data)
+        if self.is_hub:
+            self._fan_out(line, exclude=None)
+        elif self._hub_writer is not None:
+            self._write(self._hub_writer, line)
+
+    def _write(self, writer: asyncio.StreamWriter, line: bytes) -> bool:
+        # 对端消费过慢时丢弃，避免缓冲无限增长
+        if writer.is_closing() or writer.transport.get_write_buffer_size() > 4 * 1024 * 1024:
+            return False
+        writer.write(line)
+        return True
+
+    def _fan_out(self, line: bytes, exclude: Optional[asyncio.StreamWriter]):
+        for peer in list(self._peers):
+            if peer is not exclude:
+                self._write(peer, line)
+
+    def _receive(self, line: bytes):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        self.received += 1
+        self._deliver(message.get("c"), message.get("d"))
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """集线器：处理一个 worker 连接"""
+        self._peers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._fan_out(line, exclude=writer)
+                self._receive(line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    def _try_lock(self) -> bool:
+        """集线器选举：持有锁文件的排他锁者为集线器，进程退出时锁自动释放"""
+        import fcntl
+
+        fd = os.open(self.path + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _release_lock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _become_hub(self) -> bool:
+        if not self._try_lock():
+            return False
+        try:
+            # 残留的 socket 文件（上一个集线器已退出）
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = await asyncio.start_unix_server(self._handle_peer, path=self.path)
+        except OSError as e:
+            log_warning("PubSub", f"绑定集线器 socket 失败: {e}")
+            self._release_lock()
+            return False
+        self.is_hub = True
+        log_info("PubSub", f"Unix socket 总线: 本 worker 作为集线器 ({self.path})")
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if await self._become_hub():
+                    await self._server.serve_forever()
+                    return
+                await asyncio.sleep(0.5)
+                continue
+            except OSError as e:
+                log_warning("PubSub", f"连接集线器失败: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            self._hub_writer = writer
+            log_info("PubSub", f"Unix socket 总线: 已连接集线器 ({self.path})")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self._receive(line)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                self._hub_writer = None
+                writer.close()
+            log_warning("PubSub", "与集线器的连接断开，重新选举")
+            await asyncio.sleep(random.uniform(0.05, 0.5))
+
+    async def start(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+        self.started = True
+
+    async def stop(self):
+        self.started = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for peer in list(self._peers):
+            peer.close()
+        self._peers.clear()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if self.is_hub:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+        self._release_lock()
+        self.is_hub = False
+
+    def status(self) -> dict:
+        status = super().status()
+        status.update({"path": self.path, "is_hub": self.is_hub, "peers": len(self._peers)})
+        return status
+
+
+def _postgres_dsn(database_url: str) -> str:
+    """SQLAlchemy URL -> asyncpg DSN"""
+    return database_url.replace("postgresql+asyncpg://", "postgresql://", 1).replace("postgres+asyncpg://", "postgresql://", 1)
+
+
+def create_bus() -> PubSub:
+    backend = (settings.pubsub_backend or "auto").lower()
+    is_postgres = settings.database_url.startswith(("postgresql", "postgres"))
+    if backend == "auto":
+        backend = "postgres" if is_postgres else "memory"
+
+    if backend == "postgres":
+        if not is_postgres:
+            log_warning("PubSub", "postgres 总线需要 PostgreSQL 数据库，回退到 memory")
+            return MemoryPubSub()
+        return PostgresPubSub(_postgres_dsn(settings.database_url))
+    if backend == "unix":
+        return UnixSocketPubSub(settings.pubsub_unix_path)
+    return MemoryPubSub()
+
+
+# 全局实例
+bus = create_bus()
+
+
+async def start_bus():
+    """启动总线；跨进程后端启动失败时仍可在本进程内分发"""
+    try:
+        await bus.start()
+    except Exception as e:
+        log_error("PubSub", f"{bus.backend} 总线启动失败，仅在本进程内分发: {e}")
@@ -0,0 +1,187 @@
+"""
+速率限制（纯内存，热路径不访问数据库）
+
+- RPM：GCRA（通用信元速率算法，等价于令牌桶），按用户和按 API Key 分别限制，
+  每个键只保存一个“理论到达时间”浮点数
+- 并发流：按用户限制同时进行的流式请求数，响应结束（含流式传输完成）后由中间件释放
+- 用户分级：捐赠了公共凭证的用户为贡献者（contributor_rpm / contributor_max_streams），
+  其余为普通用户（base_rpm / base_max_streams）；贡献者名单启动时加载并定期刷新
+- 管理员不受限制；超限返回 429 并带 Retry-After 头
+
+限额按 worker 计算，多 worker 部署时实际总限额约为 worker 数 × 配置值。
+"""
+import asyncio
+import math
+import time
+from typing import Dict, Optional, Set
+
+from fastapi import HTTPException
+
+from app.config import settings
+from app.services.token_quota import token_quota, QUOTA_RESERVATION_STATE
+from app.services.admission import admission, ADMISSION_STATE
+from app.utils.logger import log_info, log_warning
+
+
+class GCRA:
+    """GCRA 限流器：rate 次/分钟，允许突发 burst 次"""
+
+    def __init__(self):
+        # {键: 理论到达时间 (monotonic)}
+        self._tat: Dict[str, float] = {}
+        self._checks = 0
+
+    def check(self, key: str, rate: int, burst: int) -> float:
+        """允许则记一次并返回 0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        interval = 60.0 / rate
+        tolerance = interval * (max(burst, 1) - 1)
+        tat = max(self._tat.get(key, now), now)
+        allow_at = tat - tolerance
+        if now < allow_at:
+            return allow_at - now
+        self._tat[key] = tat + interval
+        self._checks += 1
+        if self._checks % 10000 == 0:
+            self._prune(now)
+        return 0.0
+
+    def _prune(self, now: float):
+        """移除已经完全恢复的键，防止无限增长"""
+        for key in [k for k, tat in self._tat.items() if tat <= now]:
+            del self._tat[key]
+
+
+class RateLimiter:
+    """按用户 / API Key 的 RPM 和并发流限制"""
+
+    def __init__(self):
+        self.rpm = GCRA()
+        self._streams: Dict[int, int] = {}
+        self._contributors: Set[int] = set()
+        self._contributors_loaded = False
+
+    # ===== 用户分级 =====
+
+    def is_contributor(self, user_id: int) -> bool:
+        return user_id in self._contributors
+
+    async def load_contributors(self):
+        """加载贡献者名单（有启用的公共凭证的用户）"""
+        from sqlalchemy import select, distinct
+        from app.database import async_session
+        from app.models.user import Credential
+
+        try:
+            async with async_session() as db:
+                result = await db.execute(
+                    select(distinct(Credential.user_id))
+                    .where(Credential.is_public == True)
+                    .where(Credential.is_active == True)
+                )
+                self._contributors = {row[0] for row in result.all() if row[0] is not None}
+            if not self._contributors_loaded:
+                log_info("RateLimit", f"贡献者名单已加载: {len(self._contributors)} 人")
+            self._contributors_loaded = True
+        except Exception as e:
+            log_warning("RateLimit", f"加载贡献者名单失败: {e}")
+
+    async def run(self):
+        """后台任务：定期刷新贡献者名单"""
+        while True:
+            await self.load_contributors()
+            await asyncio.sleep(settings.rate_limit_refresh_interval)
+
+    # ===== 检查 =====
+
+    def check(self, user, api_key: str, stream: bool) -> Optional[int]:
+        """
+        检查并记录一次请求；超限时抛出 429
+
+        返回占用的并发流用户 id（需在响应结束后 release_stream），未占用返回 None
+        """
+        if user.is_admin:
+            return None
+        contributor = self.is_contributor(user.id)
+        rpm = settings.contributor_rpm if contributor else settings.base_rpm
+        max_streams = settings.contributor_max_streams if contributor else settings.base_max_streams
+
+        if stream and max_streams and self._streams.get(user.id, 0) >= max_streams:
+            raise HTTPException(
+                status_code=429,
+                detail=f"并发流式请求已达上限: {max_streams}",
+                headers={"Retry-After": "1"},
+            )
+
+        if rpm:
+            burst = settings.rate_limit_burst or rpm
+            wait = self.rpm.check(f"user:{user.id}", rpm, burst)
+            if wait:
+                self._reject(f"速率限制: {rpm} 次/分钟", wait)
+        if settings.api_key_rpm:
+            wait = self.rpm.check(f"key:{api_key}", settings.api_key_rpm, settings.rate_limit_burst or settings.api_key_rpm)
+            if wait:
+                self._reject(f"API Key 速率限制: {settings.api_key_rpm} 次/分钟", wait)
+
+        if stream:
+            self._streams[user.id] = self._streams.get(user.id, 0) + 1
+            return user.id
+        return None
+
+    @staticmethod
+    def _reject(detail: str, wait: float):
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(math.ceil(wait), 1))},
+        )
+
+    def release_stream(self, user_id: int):
+        count = self._streams.get(user_id, 0) - 1
+        if count > 0:
+            self._streams[user_id] = count
+        else:
+            self._streams.pop(user_id, None)
+
+
+# 全局实例
+rate_limiter = RateLimiter()
+
+# request.state 上记录占用的并发流
+STREAM_SLOT_STATE = "rate_limit_stream_user"
+
+
+class RateLimitReleaseMiddleware:
+    """
+    ASGI 中间件：响应完全发送后（流式响应在流结束后）释放并发流名额和上游准入名额，并核对 token 配额预留
+
+    纯 ASGI 实现，await 下游应用返回时响应体已全部发送完毕。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            state = scope.get("state", {})
+            user_id = state.get(STREAM_SLOT_STATE)
+            if user_id is not None:
+                rate_limiter.release_stream(user_id)
+            reservation = state.get(QUOTA_RESERVATION_STATE)
+            if reservation is not None:
+                token_quota.release(reservation, status.get("code"))
+            pool = state.get(ADMISSION_STATE)
+            if pool is not None:
+                admission.release(pool)
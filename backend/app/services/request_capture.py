@@ -0,0 +1,119 @@
+"""
+请求采样存储
+
+使用日志（usage_logs）只保留截断的错误信息，请求内容和完整错误信息按采样率
+压缩后写入 request_captures 表（与日志在同一事务中插入，按 log_id 关联）：
+
+- 默认保存所有失败请求、1% 的成功请求（capture_error_rate / capture_success_rate）
+- 只有被采样的请求才序列化请求体，未采样的请求没有额外开销
+- 日志详情接口按 log_id 单独查询并解压，列表接口不读取
+- 后台任务按 capture_retention_days 清理过期记录；SQLite 不执行外键级联，
+  另外清理日志已删除的孤儿记录（PostgreSQL 由 ON DELETE CASCADE 删除）
+"""
+import asyncio
+import json
+import random
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+from sqlalchemy import select, delete, exists
+
+from app.config import settings
+from app.models.user import RequestCapture, UsageLog
+from app.utils.logger import log_info, log_warning
+
+
+def _pack(value: Union[dict, bytes, str, None]) -> Optional[bytes]:
+    if value is None or value == b"" or value == "":
+        return None
+    if isinstance(value, bytes):
+        raw = value
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+    else:
+        raw = json.dumps(value, ensure_ascii=False).encode("utf-8")
+    return zlib.compress(raw[:settings.capture_max_bytes])
+
+
+def _unpack(blob: Optional[bytes]) -> Optional[str]:
+    if not blob:
+        return None
+    return zlib.decompress(blob).decode("utf-8", "replace")
+
+
+class RequestCaptureStore:
+    """请求采样的写入、读取和清理"""
+
+    def __init__(self):
+        # 上次清理孤儿记录的时间：之后写入的采样与日志同一事务插入，下次只检查更早的记录
+        self._swept_at: Optional[datetime] = None
+
+    @staticmethod
+    def sampled(status_code: Optional[int]) -> bool:
+        rate = settings.capture_success_rate if status_code == 200 else settings.capture_error_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def attach(self, log, body: Union[dict, bytes, str, None]):
+        """
+        写入日志前调用：按采样率把请求体和完整错误信息挂到日志上（随日志一起插入），
+        并把日志行中的错误信息截断到 usage_log_error_chars
+        """
+        error = log.error_message
+        if self.sampled(log.status_code):
+            try:
+                log.capture = RequestCapture(request_blob=_pack(body), error_blob=_pack(error))
+            except Exception as e:
+                log_warning("Capture", "请求采样失败: %s", e)
+        if error and len(error) > settings.usage_log_error_chars:
+            log.error_message = error[:settings.usage_log_error_chars]
+
+    @staticmethod
+    async def load(db, log_id: int) -> Optional[dict]:
+        """日志详情：读取并解压采样内容，未采样返回 None"""
+        result = await db.execute(
+            select(RequestCapture.request_blob, RequestCapture.error_blob)
+            .where(RequestCapture.log_id == log_id)
+            .limit(1)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        return {"request_body": _unpack(row.request_blob), "error_message": _unpack(row.error_blob)}
+
+    async def purge(self):
+        """删除过期记录和孤儿记录（孤儿记录只在 SQLite 上出现）"""
+        from app.database import async_session, is_sqlite
+
+        try:
+            async with async_session() as db:
+                expired = orphaned = 0
+                if settings.capture_retention_days > 0:
+                    cutoff = datetime.utcnow() - timedelta(days=settings.capture_retention_days)
+                    result = await db.execute(delete(RequestCapture).where(RequestCapture.created_at < cutoff))
+                    expired = result.rowcount
+                if is_sqlite:
+                    swept_at = datetime.utcnow()
+                    query = delete(RequestCapture).where(
+                        ~exists().where(UsageLog.id == RequestCapture.log_id)
+                    )
+                    if self._swept_at is not None:
+                        query = query.where(RequestCapture.created_at < self._swept_at)
+                    orphaned = (await db.execute(query)).rowcount
+                await db.commit()
+                if is_sqlite:
+                    self._swept_at = swept_at
+            if expired or orphaned:
+                log_info("Capture", "已清理请求采样: 过期 %s, 孤儿 %s", expired, orphaned)
+        except Exception as e:
+            log_warning("Capture", "清理请求采样失败: %s", e)
+
+    async def run(self):
+        """后台任务：定期清理"""
+        while True:
+            await self.purge()
+            await asyncio.sleep(3600)
+
+
+# 全局实例
+capture_store = RequestCaptureStore()
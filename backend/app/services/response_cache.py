@@ -0,0 +1,309 @@
+"""
+确定性非流式请求的响应缓存（默认关闭，response_cache_enabled）
+
+评测、分类等工具会反复发送完全相同的 temperature=0 请求，每次都消耗上游配额。
+缓存按 (接口, 模型, 请求体规范化 JSON) 的哈希保存成功响应的原始字节：
+
+- 只缓存非流式请求，且 temperature 为 0 或请求头 X-Response-Cache: 1 显式开启
+  （X-Response-Cache: 0 可对 temperature=0 的请求关闭）
+- 内存层按总字节数限制（response_cache_max_bytes），LRU 淘汰
+- 可选磁盘层（response_cache_disk_path，SQLite 文件）：内存淘汰的条目写入磁盘，
+  内存未命中时查磁盘并提升回内存；磁盘层同样按总字节数淘汰最久未访问的条目
+- 默认按用户隔离（key 含用户 id），response_cache_shared 开启后所有用户共用
+- 流式请求（response_cache_streams）：StreamRecorder 记录上游 SSE 流的分块边界和块间隔，
+  只有上游流正常结束（无异常、无客户端断开、无 error 块）才写入；命中时由 replay_stream
+  按原分块重新生成 SSE 流，立即发送或按记录的间隔 × response_cache_stream_pacing 发送
+- 命中时写入 cache_hit=True 的使用日志；是否计入配额由 response_cache_hit_quota 决定
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.metrics import CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL
+from app.utils.logger import log_info, log_warning
+
+# 不影响响应内容的字段
+_IGNORED_FIELDS = frozenset({"stream", "stream_options", "user"})
+_TRUE_VALUES = ("1", "true", "on", "yes")
+_FALSE_VALUES = ("0", "false", "off", "no")
+
+# 流式条目：每块前缀 (距上一块的毫秒数, 块长度)
+_CHUNK_HEADER = struct.Struct(">II")
+
+
+def request_digest(body: dict) -> str:
+    """请求体规范化 JSON（键排序、忽略 stream 等字段）的哈希"""
+    canonical = json.dumps(
+        {k: v for k, v in body.items() if k not in _IGNORED_FIELDS},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _temperature(body: dict):
+    if "temperature" in body:
+        return body.get("temperature")
+    config = body.get("generationConfig") or body.get("generation_config")
+    if isinstance(config, dict):
+        return config.get("temperature")
+    return None
+
+
+class _DiskTier:
+    """SQLite 磁盘层（同步接口，由调用方放到线程池执行）"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_accessed ON response_cache (accessed)")
+        self.bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._delete(key)
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    def put_many(self, entries: List[Tuple[str, bytes, float]]):
+        now = time.time()
+        with self._lock:
+            for key, value, expires in entries:
+                self._delete(key)
+                self._conn.execute(
+                    "INSERT INTO response_cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), expires, now),
+                )
+                self.bytes += len(value)
+            self._evict(now)
+
+    def _delete(self, key: str):
+        row = self._conn.execute("SELECT size FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self.bytes -= row[0]
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM response_cache WHERE expires <= ?", (now,))
+        if self.bytes > settings.response_cache_disk_max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM response_cache ORDER BY accessed").fetchall()
+            for key, size in rows:
+                if self.bytes <= settings.response_cache_disk_max_bytes:
+                    break
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self.bytes -= size
+        self.bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self.bytes = 0
+
+
+class ResponseCache:
+    """内存 LRU（按字节数限制）+ 可选 SQLite 磁盘层"""
+
+    def __init__(self):
+        # {key: (响应字节, 过期时间)}
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self.bytes = 0
+        self._disk: Optional[_DiskTier] = None
+        self._disk_path: Optional[str] = None
+
+    # ===== 是否缓存 =====
+
+    def key_for(self, request, user, kind: str, model: str, body: dict, stream: bool = False) -> Optional[str]:
+        """返回缓存 key；不应缓存的请求返回 None"""
+        if not settings.response_cache_enabled:
+            return None
+        if stream:
+            if not settings.response_cache_streams:
+                return None
+            kind = f"{kind}-stream"
+        elif body.get("stream") is True:
+            return None
+        header = (request.headers.get("X-Response-Cache") or "").strip().lower()
+        if header in _FALSE_VALUES:
+            return None
+        if header not in _TRUE_VALUES and _temperature(body) != 0:
+            return None
+        scope = "*" if settings.response_cache_shared else str(user.id)
+        return f"{kind}:{model}:{scope}:{request_digest(body)}"
+
+    # ===== 读写 =====
+
+    def _disk_tier(self) -> Optional[_DiskTier]:
+        path = settings.response_cache_disk_path
+        if not path:
+            return None
+        if self._disk_path != path:
+            # 打开失败时记住路径，不再重试
+            self._disk_path = path
+            try:
+                self._disk = _DiskTier(path)
+                log_info("ResponseCache", "磁盘层已打开: %s (%s 字节)", path, self._disk.bytes)
+            except Exception as e:
+                self._disk = None
+                log_warning("ResponseCache", "打开磁盘层失败，仅使用内存: %s", e)
+        return self._disk
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None:
+            if entry[1] > now:
+                self._entries.move_to_end(key)
+                CACHE_HITS_TOTAL.inc(cache="response")
+                return entry[0]
+            self._remove(key)
+
+        disk = self._disk_tier()
+        if disk is not None:
+            try:
+                entry = await asyncio.to_thread(disk.get, key)
+            except Exception as e:
+                log_warning("ResponseCache", "读取磁盘层失败: %s", e)
+                entry = None
+            if entry is not None:
+                CACHE_HITS_TOTAL.inc(cache="response_disk")
+                await self._store(key, entry[0], entry[1])
+                return entry[0]
+        CACHE_MISSES_TOTAL.inc(cache="response")
+        return None
+
+    async def put(self, key: str, value: bytes):
+        if len(value) > settings.response_cache_max_entry_bytes:
+            return
+        await self._store(key, value, time.time() + settings.response_cache_ttl)
+
+    async def _store(self, key: str, value: bytes, expires: float):
+        self._remove(key)
+        self._entries[key] = (value, expires)
+        self.bytes += len(value)
+        evicted = []
+        while self.bytes > settings.response_cache_max_bytes and self._entries:
+            old_key, (old_value, old_expires) = self._entries.popitem(last=False)
+            self.bytes -= len(old_value)
+            evicted.append((old_key, old_value, old_expires))
+
+        # 内存淘汰的未过期条目写入磁盘层
+        disk = self._disk_tier() if evicted else None
+        if disk is not None:
+            now = time.time()
+            evicted = [entry for entry in evicted if entry[2] > now]
+            if evicted:
+                try:
+                    await asyncio.to_thread(disk.put_many, evicted)
+                except Exception as e:
+                    log_warning("ResponseCache", "写入磁盘层失败: %s", e)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[0])
+
+    async def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.clear)
+
+    async def persist(self):
+        """关闭前把内存层中未过期的条目写入磁盘层（未配置磁盘层时忽略）"""
+        disk = self._disk_tier() if self._entries else None
+        if disk is None:
+            return
+        now = time.time()
+        entries = [(key, value, expires) for key, (value, expires) in self._entries.items() if expires > now]
+        try:
+            await asyncio.to_thread(disk.put_many, entries)
+            log_info("ResponseCache", "已将 %s 个内存条目写入磁盘层", len(entries))
+        except Exception as e:
+            log_warning("ResponseCache", "写入磁盘层失败: %s", e)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "memory_bytes": self.bytes,
+            "disk_bytes": self._disk.bytes if self._disk is not None else 0,
+        }
+
+
+class StreamRecorder:
+    """记录上游 SSE 流，正常结束后由 commit 写入缓存"""
+
+    __slots__ = ("key", "_parts", "_size", "_last", "_failed")
+
+    def __init__(self, key: str):
+        self.key = key
+        self._parts: List[bytes] = []
+        self._size = 0
+        self._last = time.monotonic()
+        self._failed = False
+
+    def feed(self, chunk: bytes):
+        if self._failed:
+            return
+        # 上游在 200 流中返回的错误块不缓存
+        if b'"error"' in chunk:
+            self._failed = True
+            return
+        now = time.monotonic()
+        delay_ms = min(int((now - self._last) * 1000), 0xFFFFFFFF)
+        self._last = now
+        self._size += _CHUNK_HEADER.size + len(chunk)
+        if self._size > settings.response_cache_max_entry_bytes:
+            self._failed = True
+            self._parts = []
+            return
+        self._parts.append(_CHUNK_HEADER.pack(delay_ms, len(chunk)))
+        self._parts.append(chunk)
+
+    async def commit(self):
+        """上游流正常结束时调用"""
+        if self._failed or not self._parts:
+            return
+        value = b"".join(self._parts)
+        self._parts = []
+        await response_cache.put(self.key, value)
+
+
+def iter_stream_chunks(value: bytes):
+    """解码流式条目：逐块返回 (距上一块的毫秒数, 块)"""
+    offset = 0
+    while offset < len(value):
+        delay_ms, size = _CHUNK_HEADER.unpack_from(value, offset)
+        offset += _CHUNK_HEADER.size
+        yield delay_ms, value[offset:offset + size]
+        offset += size
+
+
+async def replay_stream(value: bytes) -> AsyncIterator[bytes]:
+    """按记录的分块重新生成 SSE 流（response_cache_stream_pacing 为 0 时不等待）"""
+    pacing = settings.response_cache_stream_pacing
+    for delay_ms, chunk in iter_stream_chunks(value):
+        if pacing > 0 and delay_ms:
+            await asyncio.sleep(delay_ms / 1000 * pacing)
+        yield chunk
+
+
+# 全局实例
+response_cache = ResponseCache()
@@ -0,0 +1,160 @@
+"""
+优雅关闭（排空进行中的请求后再退出）
+
+重新部署时 uvicorn 收到 SIGTERM 会立即停止监听，进行中的流式响应被容器的强制终止打断，
+内存中尚未写入的用量也随之丢失。关闭协调器接管 SIGTERM，分三步退出：
+
+1. 排空：/api/ready 返回 503（负载均衡摘除实例），新请求直接返回 503 + Retry-After
+2. 等待：进行中的请求（含流式响应）在 shutdown_drain_timeout 秒内自然结束，
+   超时后中断剩余请求（其 finally 中的用量记录照常执行）
+3. 退出：交回 uvicorn 关闭监听，lifespan 关闭阶段写入日志用量、端点统计、响应缓存等
+   写缓冲并关闭连接池
+
+SIGTERM 只能在主线程接管；在线程中运行（测试、基准测试）时可直接调用 drain()。
+再次收到 SIGTERM 时跳过排空立即关闭。
+"""
+import asyncio
+import json
+import signal
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from app.config import settings
+from app.utils.logger import log_info, log_warning
+
+# 排空期间仍然响应的路径（探针和监控）
+_PROBE_PATHS = frozenset({"/api/health", "/api/ready", "/health", "/metrics"})
+
+
+class ShutdownCoordinator:
+    """跟踪进行中的 HTTP 请求，关闭前排空"""
+
+    def __init__(self):
+        self.draining = False
+        # {请求所在任务: 路径}
+        self._active: Dict[asyncio.Task, str] = {}
+        # 关闭前需要等待完成的后台写入（如中断流的日志）
+        self._background: Set[asyncio.Task] = set()
+        self._drain_task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return not self.draining
+
+    def active(self) -> int:
+        return len(self._active)
+
+    def track(self, task: asyncio.Task, path: str):
+        self._active[task] = path
+
+    def untrack(self, task: asyncio.Task):
+        self._active.pop(task, None)
+
+    def defer(self, coro) -> asyncio.Task:
+        """启动后台写入任务，关闭时等待其完成"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    # ===== 排空 =====
+
+    async def drain(self, timeout: Optional[float] = None) -> int:
+        """停止接收新请求并等待进行中的请求结束；返回超时后被中断的请求数"""
+        timeout = settings.shutdown_drain_timeout if timeout is None else timeout
+        if not self.draining:
+            self.draining = True
+            log_warning("Shutdown", "开始排空: %s 个进行中的请求，最多等待 %s 秒", len(self._active), timeout)
+
+        deadline = time.monotonic() + timeout
+        while self._active and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        remaining = [task for task in self._active if task is not asyncio.current_task()]
+        if remaining:
+            log_warning("Shutdown", "排空超时，中断 %s 个请求: %s", len(remaining), sorted(set(self._active.values())))
+            for task in remaining:
+                task.cancel()
+            # 等待被中断请求的 finally（用量记录、名额释放）执行完
+            await asyncio.wait(remaining, timeout=5)
+        else:
+            log_info("Shutdown", "进行中的请求已全部结束")
+        await self.wait_background()
+        return len(remaining)
+
+    async def wait_background(self, timeout: float = 5):
+        if self._background:
+            await asyncio.wait(list(self._background), timeout=timeout)
+
+    # ===== 信号 =====
+
+    def install_signal_handler(self):
+        """接管 SIGTERM：先排空再交给原处理函数（uvicorn）关闭；只能在主线程调用"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+        if not callable(previous):
+            return
+        loop = asyncio.get_running_loop()
+
+        def handle_sigterm(signum, frame):
+            if self._drain_task is not None:
+                # 排空中再次收到 SIGTERM：立即关闭
+                previous(signum, frame)
+                return
+            loop.call_soon_threadsafe(self._start_drain, lambda: previous(signum, frame))
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def _start_drain(self, exit_server):
+        async def drain_then_exit():
+            try:
+                await self.drain()
+            finally:
+                exit_server()
+
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(drain_then_exit())
+
+
+class DrainMiddleware:
+    """
+    ASGI 中间件：记录进行中的 HTTP 请求；排空期间除探针外的新请求返回 503
+
+    纯 ASGI 实现，await 下游应用返回时响应体已全部发送完毕。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in _PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        if shutdown_coordinator.draining:
+            body = json.dumps({"detail": "服务正在重启，请稍后重试"}, ensure_ascii=False).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"5"),
+                    (b"connection", b"close"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        task = asyncio.current_task()
+        shutdown_coordinator.track(task, scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            shutdown_coordinator.untrack(task)
+
+
+# 全局实例
+shutdown_coordinator = ShutdownCoordinator()
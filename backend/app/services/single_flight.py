@@ -0,0 +1,208 @@
+"""
+相同请求合并（single-flight，默认关闭，single_flight_enabled）
+
+客户端激进重试或多个用户同时提交相同提示词时，顺序轮询会向上游发送 N 个相同请求。
+按 (接口, 模型, 是否流式, 请求体规范化 JSON 的哈希) 合并进行中的相同请求（不区分用户）：
+
+- 第一个请求（leader）正常转发，其余请求（follower）等待 leader 的结果
+- 非流式：follower 共享 leader 的成功响应体；leader 返回 HTTP 错误时 follower 收到同样的错误，
+  其他情况（非 JSON 成功响应等）follower 各自转发
+- 流式：上游流由后台任务拉取到扇出缓冲区，leader 和所有 follower 作为订阅者从头读取，
+  响应沿用上游响应的状态码和响应头；所有订阅者断开后停止拉取。
+  缓冲区超过 single_flight_max_stream_bytes 后不再接受新的 follower
+- 配额按调用方分别计算：每个 follower 写入自己的使用日志（endpoint 带 "(coalesced)"）和 token 用量
+"""
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from app.config import settings
+from app.services.metrics import CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL
+from app.services.response_cache import request_digest
+from app.utils.logger import log_warning
+from app.utils.streaming import ClosingStreamingResponse
+
+
+class FanOutSubscription:
+    """
+    扇出缓冲区的一个订阅者
+
+    获取时即计入订阅者（避免开始读取前上游流被取消）；读取结束时退订，
+    响应从未被迭代时由 ClosingStreamingResponse 调用 close() 退订
+    """
+
+    __slots__ = ("_fanout", "_closed")
+
+    def __init__(self, fanout: "StreamFanOut"):
+        self._fanout = fanout
+        self._closed = False
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._fanout._read(self)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._fanout._leave()
+
+
+class StreamFanOut:
+    """单个上游流的扇出缓冲区"""
+
+    def __init__(self, iterator: AsyncIterator[bytes], on_detach: Callable[[], None],
+                 on_close: Optional[Callable[[], None]] = None,
+                 status_code: int = 200, headers: Optional[Dict[str, str]] = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self._done = False
+        self._subscribers = 0
+        self._changed = asyncio.Event()
+        self._on_detach = on_detach
+        self._on_close = on_close
+        self._detached = False
+        self._task = asyncio.create_task(self._pump(iterator))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _detach(self):
+        """不再接受新的订阅者"""
+        if not self._detached:
+            self._detached = True
+            self._on_detach()
+
+    async def _pump(self, iterator: AsyncIterator[bytes]):
+        try:
+            async for chunk in iterator:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+                if self._size > settings.single_flight_max_stream_bytes:
+                    self._detach()
+                self._notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log_warning("SingleFlight", "上游流读取失败: %s", e)
+        finally:
+            self._done = True
+            self._detach()
+            self._notify()
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            if self._on_close is not None:
+                # 上游响应的清理（如并发名额），其生成器未开始时 aclose 不会执行 finally
+                self._on_close()
+
+    def subscribe(self) -> FanOutSubscription:
+        """从头读取上游流（已缓冲的部分立即返回）"""
+        self._subscribers += 1
+        return FanOutSubscription(self)
+
+    def response(self, subscription: FanOutSubscription, headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+        """订阅者的流式响应（沿用上游响应的状态码和响应头）"""
+        return ClosingStreamingResponse(
+            subscription, subscription.close,
+            status_code=self.status_code, headers={**self.headers, **(headers or {})},
+        )
+
+    def _leave(self):
+        self._subscribers -= 1
+        if self._subscribers == 0 and not self._done:
+            # 所有订阅者都已断开
+            self._task.cancel()
+
+    async def _read(self, subscription: FanOutSubscription) -> AsyncIterator[bytes]:
+        index = 0
+        try:
+            while True:
+                if index < len(self._chunks):
+                    chunk = self._chunks[index]
+                    index += 1
+                    yield chunk
+                elif self._done:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            subscription.close()
+
+
+# leader 的共享结果：非流式为响应体字节，流式为扇出缓冲区；None 表示 follower 自行转发
+SharedResult = Union[bytes, StreamFanOut, None]
+
+
+class SingleFlight:
+    """进行中请求的合并表"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key_for(kind: str, model: str, body: dict, stream: bool) -> Optional[str]:
+        if not settings.single_flight_enabled:
+            return None
+        return f"{kind}:{model}:{'stream' if stream else 'json'}:{request_digest(body)}"
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def claim(self, key: str) -> Tuple[bool, asyncio.Future]:
+        """返回 (是否为 leader, 共享结果)"""
+        future = self._calls.get(key)
+        if future is not None:
+            CACHE_HITS_TOTAL.inc(cache="single_flight")
+            return False, future
+        future = asyncio.get_running_loop().create_future()
+        # follower 都已离开时避免 "exception was never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        CACHE_MISSES_TOTAL.inc(cache="single_flight")
+        return True, future
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    async def lead(self, key: str, future: asyncio.Future, call: Callable[[], Awaitable[Response]]) -> Response:
+        """leader：执行转发并把结果共享给 follower"""
+        try:
+            response = await call()
+        except HTTPException as e:
+            self._forget(key, future)
+            future.set_exception(e)
+            raise
+        except BaseException:
+            self._forget(key, future)
+            future.set_result(None)
+            raise
+
+        if isinstance(response, StreamingResponse):
+            fanout = StreamFanOut(
+                response.body_iterator, lambda: self._forget(key, future),
+                on_close=getattr(response, "on_close", None),
+                status_code=response.status_code, headers=dict(response.headers),
+            )
+            future.set_result(fanout)
+            return fanout.response(fanout.subscribe())
+
+        self._forget(key, future)
+        if isinstance(response, JSONResponse) and response.status_code == 200:
+            future.set_result(bytes(response.body))
+        else:
+            future.set_result(None)
+        return response
+
+    @staticmethod
+    async def follow(future: asyncio.Future) -> SharedResult:
+        """follower：等待 leader 的结果（leader 的 HTTP 错误原样抛出）"""
+        return await asyncio.shield(future)
+
+
+# 全局实例
+single_flight = SingleFlight()
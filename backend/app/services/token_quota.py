@@ -0,0 +1,269 @@
+"""
+按 token 计算的每日配额（quota_mode = "tokens"）
+
+按次数计算时一次长上下文的 2.5-pro 请求和一次短的 flash 请求占用相同配额。
+token 模式下每个请求在转发前估算成本并预留，响应结束后用实际用量核对：
+
+- 估算：对 messages / contents / system 中的文本做近似分词（ASCII 约 4 字符 1 token，
+  其他字符约 1 字符 1 token，图片等附件按固定值），加上预计输出 token_quota_completion_estimate，
+  再乘以模型权重（token_quota_model_weights，如 flash=1、pro=4、3-pro=8）
+- 预算：daily_quota × token_quota_unit（沿用用户现有的每日配额设置），与次数配额同样在
+  北京时间 15:00 (UTC 07:00) 重置
+- 核对：响应成功时（usage_accounting 写入日志用量时）用实际 token × 权重替换预留，
+  上游没有返回用量时按估算计入；计入量写入日志的 quota_cost 列。失败请求退回预留。
+  被中断的流（499）同样计入：上游已经生成了输出
+- 已用量保存在内存中，每个窗口首次检查时以及每隔 token_quota_sync_interval 秒从 usage_logs 的
+  quota_cost 重新汇总，加上已计入但日志尚未写入的部分（流式请求由 usage_accounting 延迟写入）；
+  多 worker 之间的偏差不超过一个同步间隔
+"""
+import contextvars
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select, func, case
+
+from app.config import settings
+from app.utils.logger import log_warning
+
+# 附件（图片、文件等）按固定 token 计算，不展开 base64 内容
+_ATTACHMENT_KEYS = frozenset({"inlineData", "inline_data", "fileData", "file_data", "image_url", "input_audio"})
+_ATTACHMENT_TOKENS = 258
+_PROMPT_KEYS = ("messages", "contents", "system", "systemInstruction", "system_instruction")
+
+QUOTA_RESERVATION_STATE = "token_quota_reservation"
+
+# 当前请求的预留，由 usage_accounting 在读取到实际用量时核对
+current_reservation: contextvars.ContextVar[Optional["Reservation"]] = contextvars.ContextVar(
+    "token_quota_reservation", default=None
+)
+
+
+def approx_tokens(text: str) -> int:
+    """近似 token 数：ASCII 约 4 字符 1 token，其他字符（中日韩等）约 1 字符 1 token"""
+    chars = len(text)
+    if not chars:
+        return 0
+    # UTF-8 下非 ASCII 字符多为 3 字节（中日韩），多出的字节数 / 2 约等于字符数
+    wide = (len(text.encode("utf-8")) - chars) // 2
+    return (chars - wide + 3) // 4 + wide
+
+
+def _count(value) -> int:
+    if isinstance(value, str):
+        return approx_tokens(value)
+    if isinstance(value, list):
+        return sum(_count(item) for item in value)
+    if isinstance(value, dict):
+        total = 0
+        for key, item in value.items():
+            if key in _ATTACHMENT_KEYS:
+                total += _ATTACHMENT_TOKENS
+            elif key not in ("role", "type"):
+                total += _count(item)
+        return total
+    return 0
+
+
+def estimate_prompt_tokens(body: dict) -> int:
+    """估算请求体中提示词的 token 数（OpenAI messages / Gemini contents）"""
+    total = 0
+    for key in _PROMPT_KEYS:
+        value = body.get(key)
+        if value is not None:
+            total += _count(value)
+    # gcli2api 格式：{"request": {"contents": ...}}
+    inner = body.get("request")
+    if isinstance(inner, dict):
+        total += estimate_prompt_tokens(inner)
+    return total
+
+
+def parse_model_weights(spec: str) -> List[Tuple[str, float]]:
+    """spec 形如 "3-pro=8,pro=4,flash=1"，按顺序匹配模型名子串"""
+    weights = []
+    for item in (spec or "").split(","):
+        pattern, sep, weight = item.partition("=")
+        if not sep or not pattern.strip():
+            continue
+        try:
+            weights.append((pattern.strip().lower(), float(weight)))
+        except ValueError:
+            continue
+    return weights
+
+
+class Reservation:
+    """单个请求的预留"""
+
+    __slots__ = ("user_id", "weight", "estimate", "settled")
+
+    def __init__(self, user_id: int, weight: float, estimate: float):
+        self.user_id = user_id
+        self.weight = weight
+        self.estimate = estimate
+        self.settled = False
+
+
+class _UserBudget:
+    __slots__ = ("window_start", "used", "reserved", "unpersisted", "synced_at")
+
+    def __init__(self, window_start: datetime):
+        self.window_start = window_start
+        self.used = 0.0  # 已核对的加权 token
+        self.reserved = 0.0  # 进行中请求的预留
+        self.unpersisted = 0.0  # 已计入但尚未写入日志 quota_cost 的部分
+        self.synced_at = 0.0
+
+
+class TokenQuota:
+    """按用户的 token 预算（纯内存，定期与 usage_logs 同步）"""
+
+    def __init__(self):
+        self._budgets: Dict[int, _UserBudget] = {}
+        self._weights_spec: Optional[str] = None
+        self._weights: List[Tuple[str, float]] = []
+        self._window: Optional[datetime] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.quota_mode == "tokens"
+
+    def weight(self, model: Optional[str]) -> float:
+        if self._weights_spec != settings.token_quota_model_weights:
+            self._weights_spec = settings.token_quota_model_weights
+            self._weights = parse_model_weights(self._weights_spec)
+        name = (model or "").lower()
+        for pattern, weight in self._weights:
+            if pattern in name:
+                return weight
+        return 1.0
+
+    @staticmethod
+    def budget(user) -> float:
+        return float((user.daily_quota or 0) * settings.token_quota_unit)
+
+    async def _sync(self, db, user_id: int, state: _UserBudget):
+        """从 usage_logs 重新汇总当前窗口的已用量（quota_cost；没有该值的旧日志按 token × 权重）"""
+        from app.models.user import UsageLog
+
+        tokens = func.coalesce(UsageLog.prompt_tokens, 0) + func.coalesce(UsageLog.completion_tokens, 0)
+        result = await db.execute(
+            select(
+                UsageLog.model,
+                func.sum(func.coalesce(UsageLog.quota_cost, 0)),
+                func.sum(case((UsageLog.quota_cost.is_(None), tokens), else_=0)),
+            )
+            .where(UsageLog.user_id == user_id)
+            .where(UsageLog.created_at >= state.window_start)
+            .group_by(UsageLog.model)
+        )
+        state.used = state.unpersisted + sum(
+            (cost or 0) + (legacy or 0) * self.weight(model) for model, cost, legacy in result.all()
+        )
+        state.synced_at = time.monotonic()
+
+    async def reserve(self, db, user, model: Optional[str], body: dict, window_start: datetime) -> Reservation:
+        """估算并预留本次请求的成本，超出预算时抛出 429"""
+        if window_start != self._window:
+            self._window = window_start
+            self._prune(window_start)
+        state = self._budgets.get(user.id)
+        if state is None or state.window_start != window_start:
+            state = self._budgets[user.id] = _UserBudget(window_start)
+        if time.monotonic() - state.synced_at >= settings.token_quota_sync_interval:
+            try:
+                await self._sync(db, user.id, state)
+            except Exception as e:
+                log_warning("TokenQuota", "同步已用 token 失败: %s", e)
+
+        weight = self.weight(model)
+        estimate = (estimate_prompt_tokens(body) + settings.token_quota_completion_estimate) * weight
+        budget = self.budget(user)
+        if state.used + state.reserved + estimate > budget:
+            used = int(state.used + state.reserved)
+            log_warning("Auth", "token 配额已用尽: %s, %s/%s (本次预计 %s)", user.username, used, int(budget), int(estimate))
+            raise HTTPException(
+                status_code=429,
+                detail=f"已达到每日 token 配额限制 ({used}/{int(budget)}，本次预计 {int(estimate)})",
+            )
+        state.reserved += estimate
+        reservation = Reservation(user.id, weight, estimate)
+        current_reservation.set(reservation)
+        return reservation
+
+    def settle(self, reservation: Optional[Reservation], prompt: Optional[int], completion: Optional[int],
+               persisted: bool = True) -> Optional[float]:
+        """
+        响应成功时调用：用实际 token × 权重替换预留（上游没有返回用量时按估算）
+
+        返回计入量（由调用方写入日志的 quota_cost）；已核对或未预留时返回 None。
+        persisted=False 表示日志稍后才写入，写入后调用 persisted_cost
+        """
+        if reservation is None or reservation.settled:
+            return None
+        reservation.settled = True
+        if prompt is None and completion is None:
+            cost = reservation.estimate
+        else:
+            cost = ((prompt or 0) + (completion or 0)) * reservation.weight
+        state = self._budgets.get(reservation.user_id)
+        if state is not None:
+            state.reserved = max(state.reserved - reservation.estimate, 0.0)
+            state.used += cost
+            if not persisted:
+                state.unpersisted += cost
+        return cost
+
+    def persisted_cost(self, user_id: int, cost: float):
+        """延迟写入的 quota_cost 已写入日志"""
+        state = self._budgets.get(user_id)
+        if state is not None:
+            state.unpersisted = max(state.unpersisted - cost, 0.0)
+
+    def release(self, reservation: Reservation, status_code: Optional[int]):
+        """
+        响应结束后调用：失败请求退回预留；未核对的成功请求按估算计入
+        （只在内存中计入，下次同步时丢失，正常路径都应在写日志时 settle）
+        """
+        if reservation.settled:
+            return
+        reservation.settled = True
+        state = self._budgets.get(reservation.user_id)
+        if state is None:
+            return
+        state.reserved = max(state.reserved - reservation.estimate, 0.0)
+        if status_code is not None and status_code < 400:
+            state.used += reservation.estimate
+
+    def usage(self, user) -> Optional[dict]:
+        """用户当前窗口的 token 用量（未使用过返回 None）"""
+        state = self._budgets.get(user.id)
+        if state is None:
+            return None
+        return {
+            "used": int(state.used),
+            "reserved": int(state.reserved),
+            "budget": int(self.budget(user)),
+            "window_start": state.window_start.isoformat(),
+        }
+
+    def _prune(self, window_start: datetime):
+        """进入新窗口时移除上一个窗口的用户状态"""
+        for user_id in [uid for uid, state in self._budgets.items()
+                        if state.window_start < window_start and not state.reserved]:
+            del self._budgets[user_id]
+
+
+def quota_window_start(now: Optional[datetime] = None) -> datetime:
+    """配额在北京时间 15:00 (UTC 07:00) 重置"""
+    now = now or datetime.utcnow()
+    reset_time_utc = now.replace(hour=7, minute=0, second=0, microsecond=0)
+    if now < reset_time_utc:
+        return reset_time_utc - timedelta(days=1)
+    return reset_time_utc
+
+
+# 全局实例
+token_quota = TokenQuota()
@@ -0,0 +1,47 @@
+"""
+上游 HTTP 客户端池
+
+按 base_url 复用 httpx.AsyncClient，保持长连接（keep-alive），
+避免每次转发都重新建立 TCP / TLS 连接。关闭应用时统一释放。
+"""
+import asyncio
+from typing import Dict, Tuple
+
+import httpx
+
+from app.config import settings
+
+
+class UpstreamClientPool:
+    """{base_url: AsyncClient}"""
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, int], httpx.AsyncClient] = {}
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        # 连接绑定在事件循环上，按循环区分（测试中会重建应用）
+        key = (base_url, id(asyncio.get_running_loop()))
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=settings.upstream_timeout,
+                limits=httpx.Limits(
+                    max_connections=settings.upstream_max_connections,
+                    max_keepalive_connections=settings.upstream_max_keepalive,
+                    keepalive_expiry=settings.upstream_keepalive_expiry,
+                ),
+            )
+            self._clients[key] = client
+        return client
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            try:
+                await client.aclose()
+            except Exception:
+                pass
+
+
+# 全局实例
+upstream_clients = UpstreamClientPool()
@@ -0,0 +1,282 @@
+"""
+Token / 流量统计
+
+从上游响应中读取 token 用量，写入 usage_logs 的 prompt_tokens / completion_tokens / response_bytes，
+并按 (日期, 用户, 模型) 汇总到 usage_daily 表，用于容量规划和按 token 计算配额：
+
+- 非流式：直接读取响应 JSON 中的 usage（OpenAI）或 usageMetadata（Gemini）
+- 流式：SSEUsageTracker 逐块累计字节数，只解析包含 "usage 的完整行（通常只有最后一两块），
+  不缓存整个响应
+- gcli2api 流式请求的日志在流开始前写入（状态码 200），流结束后补写 token（内存合并，定期批量 UPDATE）；
+  流被中断（客户端断开、关闭时排空超时）时状态码改为 499
+- 读取到实际用量时核对 token 配额的预留（token_quota）
+- 日汇总在内存中累加增量，每隔 usage_flush_interval 秒写入（col = col + n，多 worker 互不覆盖）
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models.user import UsageLog, UsageDaily
+from app.services.token_quota import token_quota, current_reservation
+from app.utils.logger import log_warning
+
+# 流被中断时补写的状态码和错误信息（与 OpenAI 端点的中断日志一致）
+INTERRUPTED_STATUS = 499
+INTERRUPTED_MESSAGE = "流式响应被中断"
+
+# 单行 SSE 数据的最大缓存长度，超长的行（通常是大段正文）直接跳过
+_MAX_LINE_BYTES = 256 * 1024
+
+_PENDING_KEY = "usage_accounting_pending"
+
+# 已绑定日志但一直没有结束的流（生成器未被迭代也未被关闭）在此时间后不再等待补写（秒）
+_LOG_META_TTL = 6 * 3600
+
+
+def extract_usage(data) -> Optional[Tuple[int, int]]:
+    """从响应 JSON 中读取 (prompt_tokens, completion_tokens)，没有用量信息时返回 None"""
+    if not isinstance(data, dict):
+        return None
+    usage = data.get("usage")
+    if isinstance(usage, dict):
+        prompt = usage.get("prompt_tokens", usage.get("input_tokens")) or 0
+        completion = usage.get("completion_tokens", usage.get("output_tokens")) or 0
+        return int(prompt), int(completion)
+    meta = data.get("usageMetadata")
+    if meta is None and isinstance(data.get("response"), dict):
+        meta = data["response"].get("usageMetadata")
+    if isinstance(meta, dict):
+        prompt = meta.get("promptTokenCount") or 0
+        completion = (meta.get("candidatesTokenCount") or 0) + (meta.get("thoughtsTokenCount") or 0)
+        return int(prompt), int(completion)
+    return None
+
+
+class SSEUsageTracker:
+    """流式响应的增量用量解析"""
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "response_bytes", "log_id", "reservation", "_tail")
+
+    def __init__(self):
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.response_bytes = 0
+        self.log_id: Optional[int] = None  # 日志先于流结束写入时由调用方绑定
+        # 流在响应任务中迭代，创建时取出当前请求的 token 配额预留
+        self.reservation = current_reservation.get()
+        self._tail = b""
+
+    def feed(self, chunk: bytes):
+        self.response_bytes += len(chunk)
+        buffer = self._tail + chunk if self._tail else chunk
+        end = buffer.rfind(b"\n")
+        if end < 0:
+            self._tail = buffer if len(buffer) <= _MAX_LINE_BYTES else b""
+            return
+        self._tail = buffer[end + 1:]
+        if len(self._tail) > _MAX_LINE_BYTES:
+            self._tail = b""
+        if b'"usage' not in buffer:
+            return
+        for line in buffer[:end].split(b"\n"):
+            if b'"usage' in line:
+                self._parse_line(line)
+
+    def _parse_line(self, line: bytes):
+        line = line.strip()
+        if line.startswith(b"data:"):
+            line = line[5:].strip()
+        # 非 SSE 的 JSON 数组流（[{...},\n{...}]）
+        line = line.lstrip(b"[,").rstrip(b",]")
+        try:
+            usage = extract_usage(json.loads(line))
+        except ValueError:
+            return
+        if usage is not None:
+            # 用量是累计值，以最后一次为准
+            self.prompt_tokens, self.completion_tokens = usage
+
+    def apply(self, log: UsageLog):
+        """写入日志前调用"""
+        log.prompt_tokens = self.prompt_tokens
+        log.completion_tokens = self.completion_tokens
+        log.response_bytes = self.response_bytes
+        cost = token_quota.settle(self.reservation, self.prompt_tokens, self.completion_tokens)
+        if cost is not None:
+            log.quota_cost = cost
+
+
+def apply_usage(log: UsageLog, data, response_bytes: Optional[int] = None):
+    """非流式成功响应：写入日志前调用（没有用量信息时 token 配额按估算计入）"""
+    usage = extract_usage(data)
+    if usage is not None:
+        log.prompt_tokens, log.completion_tokens = usage
+    cost = token_quota.settle(current_reservation.get(), *(usage or (None, None)))
+    if cost is not None:
+        log.quota_cost = cost
+    if response_bytes is not None:
+        log.response_bytes = response_bytes
+
+
+class UsageAccounting:
+    """日汇总增量和流结束后补写的日志用量"""
+
+    def __init__(self):
+        # {(日期, 用户 id, 模型): [请求数, prompt, completion, 字节数]}
+        self._daily: Dict[Tuple[str, int, str], List[int]] = {}
+        # {日志 id: (prompt, completion, 字节数, token 配额计入量, 用户 id, 是否被中断)}
+        self._log_updates: Dict[int, Tuple[Optional[int], Optional[int], int, Optional[float], int, bool]] = {}
+        # {日志 id: (日期, 用户 id, 模型, 绑定时间)}
+        self._log_meta: Dict[int, Tuple[str, int, str, float]] = {}
+
+    def add(self, day: str, user_id: int, model: Optional[str], requests: int,
+            prompt: Optional[int], completion: Optional[int], response_bytes: Optional[int]):
+        totals = self._daily.setdefault((day, user_id, model or ""), [0, 0, 0, 0])
+        totals[0] += requests
+        totals[1] += prompt or 0
+        totals[2] += completion or 0
+        totals[3] += response_bytes or 0
+
+    def bind(self, tracker: SSEUsageTracker, log: UsageLog):
+        """流开始前已写入的日志：流结束后按 log_id 补写用量"""
+        tracker.log_id = log.id
+        created_at = log.created_at or datetime.utcnow()
+        self._log_meta[log.id] = (created_at.date().isoformat(), log.user_id, log.model or "", time.monotonic())
+
+    def finish_stream(self, tracker: SSEUsageTracker, interrupted: bool = False):
+        """流结束时调用，可重复调用（未绑定日志的 tracker 由调用方自行 apply）"""
+        meta = self._log_meta.pop(tracker.log_id, None) if tracker.log_id is not None else None
+        cost = token_quota.settle(
+            tracker.reservation, tracker.prompt_tokens, tracker.completion_tokens, persisted=meta is None
+        )
+        if meta is None:
+            return
+        day, user_id, model, _ = meta
+        self._log_updates[tracker.log_id] = (
+            tracker.prompt_tokens, tracker.completion_tokens, tracker.response_bytes, cost, user_id, interrupted
+        )
+        self.add(day, user_id, model, 0, tracker.prompt_tokens, tracker.completion_tokens, tracker.response_bytes)
+
+    def pending(self) -> int:
+        return len(self._daily) + len(self._log_updates)
+
+    async def flush(self):
+        """批量写入日志用量和日汇总"""
+        from app.database import async_session
+
+        self._expire_log_meta()
+        if not self._daily and not self._log_updates:
+            return
+        daily, self._daily = self._daily, {}
+        log_updates, self._log_updates = self._log_updates, {}
+        try:
+            async with async_session() as db:
+                if log_updates:
+                    await db.execute(update(UsageLog), [
+                        {"id": log_id, "prompt_tokens": prompt, "completion_tokens": completion,
+                         "response_bytes": size, "quota_cost": cost,
+                         "status_code": INTERRUPTED_STATUS if interrupted else 200,
+                         "error_message": INTERRUPTED_MESSAGE if interrupted else None}
+                        for log_id, (prompt, completion, size, cost, _, interrupted) in log_updates.items()
+                    ])
+                    await db.commit()
+                    for _, _, _, cost, user_id, _ in log_updates.values():
+                        if cost is not None:
+                            token_quota.persisted_cost(user_id, cost)
+                    log_updates = {}
+                # 逐行提交，失败时只重试尚未写入的行
+                for key in list(daily):
+                    await self._upsert_daily(db, key, daily[key])
+                    del daily[key]
+        except Exception as e:
+            log_warning("Usage", f"用量统计写入失败，下次重试: {e}")
+            for log_id, values in log_updates.items():
+                self._log_updates.setdefault(log_id, values)
+            for (day, user_id, model), totals in daily.items():
+                self.add(day, user_id, model, *totals)
+
+    def _expire_log_meta(self):
+        deadline = time.monotonic() - _LOG_META_TTL
+        expired = [log_id for log_id, meta in self._log_meta.items() if meta[3] < deadline]
+        for log_id in expired:
+            del self._log_meta[log_id]
+        if expired:
+            log_warning("Usage", "%s 个流式日志超过 %s 秒未结束，不再补写用量", len(expired), _LOG_META_TTL)
+
+    @staticmethod
+    async def _upsert_daily(db, key: Tuple[str, int, str], totals: List[int]):
+        day, user_id, model = key
+        requests, prompt, completion, size = totals
+        values = {
+            "requests": UsageDaily.requests + requests,
+            "prompt_tokens": UsageDaily.prompt_tokens + prompt,
+            "completion_tokens": UsageDaily.completion_tokens + completion,
+            "response_bytes": UsageDaily.response_bytes + size,
+        }
+        where = (UsageDaily.day == day, UsageDaily.user_id == user_id, UsageDaily.model == model)
+        for _ in range(2):
+            result = await db.execute(update(UsageDaily).where(*where).values(**values))
+            if result.rowcount:
+                await db.commit()
+                return
+            db.add(UsageDaily(
+                day=day, user_id=user_id, model=model, requests=requests,
+                prompt_tokens=prompt, completion_tokens=completion, response_bytes=size,
+            ))
+            try:
+                await db.commit()
+                return
+            except IntegrityError:
+                # 其他 worker 同时插入了同一行，改为累加
+                await db.rollback()
+        raise RuntimeError(f"usage_daily 写入冲突: {key}")
+
+    async def run(self):
+        """后台任务：定期写入（关闭时由调用方再 flush 一次）"""
+        while True:
+            await asyncio.sleep(settings.usage_flush_interval)
+            await self.flush()
+
+    @staticmethod
+    async def daily(db, start_day: str, end_day: str, user_id: Optional[int] = None) -> List[UsageDaily]:
+        query = select(UsageDaily).where(UsageDaily.day >= start_day, UsageDaily.day <= end_day)
+        if user_id is not None:
+            query = query.where(UsageDaily.user_id == user_id)
+        result = await db.execute(query.order_by(UsageDaily.day, UsageDaily.user_id, UsageDaily.model))
+        return list(result.scalars().all())
+
+
+# 全局实例
+usage_accounting = UsageAccounting()
+
+
+# ===== Session 事件：UsageLog 提交后计入日汇总 =====
+
+@event.listens_for(Session, "after_flush")
+def _collect_usage(session, flush_context):
+    records = [
+        ((obj.__dict__.get("created_at") or datetime.utcnow()).date().isoformat(),
+         obj.__dict__.get("user_id"), obj.__dict__.get("model"), obj.__dict__.get("prompt_tokens"),
+         obj.__dict__.get("completion_tokens"), obj.__dict__.get("response_bytes"))
+        for obj in session.new if isinstance(obj, UsageLog)
+    ]
+    if records:
+        session.info.setdefault(_PENDING_KEY, []).extend(records)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_usage(session):
+    for day, user_id, model, prompt, completion, size in session.info.pop(_PENDING_KEY, ()):
+        usage_accounting.add(day, user_id, model, 1, prompt, completion, size)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_usage(session):
+    session.info.pop(_PENDING_KEY, None)
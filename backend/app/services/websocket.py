@@ -1,17 +1,102 @@
 from fastapi import WebSocket
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set
 import json
 import asyncio
+import time
+
+from app.config import settings
+from app.services.metrics import registry
+from app.services.pubsub import bus
+
+
+WEBSOCKET_DROPPED_TOTAL = registry.counter(
+    "websocket_dropped_messages_total", "因发送队列已满或合并而丢弃的 WebSocket 消息数", ("reason",))
+
+# 只是“有更新”提醒、不带数据的消息类型：队列中已有同类型待发送时直接合并
+COALESCIBLE_TYPES = {"stats_update", "credential_update", "user_update"}
+
+
+def timer_pending(handle: Optional[asyncio.TimerHandle]) -> bool:
+    """
+    定时器是否仍在等待触发
+
+    到期超过 1 秒仍未清除的句柄属于已关闭的事件循环（如测试中重建应用），视为失效。
+    """
+    if handle is None or handle.cancelled():
+        return False
+    return handle.when() > asyncio.get_running_loop().time() - 1
+
+
+def _dumps(message: dict) -> str:
+    # 与 WebSocket.send_json 的序列化方式保持一致
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class _Outbound:
+    """
+    单个连接的发送队列
+
+    由独立的写任务负责发送，慢消费者只会让自己的队列积压：
+    队列满时丢弃最旧的消息，同类型的提醒消息在队列中只保留一条。
+    """
+
+    def __init__(self, websocket: WebSocket, on_failure):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.ws_send_queue_size)
+        self.pending_types: Set[str] = set()
+        self._on_failure = on_failure
+        self.task = asyncio.create_task(self._writer())
+
+    def offer(self, text: str, msg_type: Optional[str] = None):
+        """非阻塞入队"""
+        if msg_type in COALESCIBLE_TYPES and msg_type in self.pending_types:
+            WEBSOCKET_DROPPED_TOTAL.inc(reason="coalesced")
+            return
+
+        if self.queue.full():
+            try:
+                _, dropped_type = self.queue.get_nowait()
+                self.pending_types.discard(dropped_type)
+                WEBSOCKET_DROPPED_TOTAL.inc(reason="queue_full")
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait((text, msg_type))
+        if msg_type in COALESCIBLE_TYPES:
+            self.pending_types.add(msg_type)
+
+    async def _writer(self):
+        try:
+            while True:
+                text, msg_type = await self.queue.get()
+                self.pending_types.discard(msg_type)
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=settings.ws_send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 发送失败或超时：视为连接已断开
+            self._on_failure(self.websocket)
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.task.cancel()
+
 
 class ConnectionManager:
     """WebSocket 连接管理器"""
-    
+
     def __init__(self):
         # 存储活跃连接 {user_id: set(websocket)}
         self.active_connections: Dict[int, Set[WebSocket]] = {}
         # 管理员连接（接收所有更新）
         self.admin_connections: Set[WebSocket] = set()
-    
+        # 订阅了实时统计增量的管理员连接（不再接收 stats_update 提醒）
+        self.stats_subscribers: Set[WebSocket] = set()
+        # 每个连接的发送队列
+        self._outbound: Dict[WebSocket, _Outbound] = {}
+
     async def connect(self, websocket: WebSocket, user_id: int, is_admin: bool = False):
         await websocket.accept()
         if user_id not in self.active_connections:
@@ -19,70 +104,157 @@ class ConnectionManager:
         self.active_connections[user_id].add(websocket)
         if is_admin:
             self.admin_connections.add(websocket)
-    
+        self._outbound[websocket] = _Outbound(websocket, self._drop)
+
     def disconnect(self, websocket: WebSocket, user_id: int):
         if user_id in self.active_connections:
             self.active_connections[user_id].discard(websocket)
+            if not self.active_connections[user_id]:
+                del self.active_connections[user_id]
+        self._drop(websocket)
+
+    def _drop(self, websocket: WebSocket):
+        """移除连接的发送队列（不区分用户，用于写任务发送失败时）"""
         self.admin_connections.discard(websocket)
-    
+        self.stats_subscribers.discard(websocket)
+        for connections in self.active_connections.values():
+            connections.discard(websocket)
+        outbound = self._outbound.pop(websocket, None)
+        if outbound is not None and outbound.task is not asyncio.current_task():
+            outbound.close()
+
+    def _offer(self, connections, message: dict):
+        """序列化一次，放入各连接的发送队列"""
+        if not connections:
+            return
+        text = _dumps(message)
+        msg_type = message.get("type")
+        for connection in list(connections):
+            outbound = self._outbound.get(connection)
+            if outbound is not None:
+                outbound.offer(text, msg_type)
+
+    def is_connected(self, websocket: WebSocket) -> bool:
+        return websocket in self._outbound
+
+    def subscribe_stats(self, websocket: WebSocket) -> bool:
+        """订阅实时统计增量（仅管理员）"""
+        if websocket not in self.admin_connections:
+            return False
+        self.stats_subscribers.add(websocket)
+        return True
+
+    def send_to_stats_subscribers(self, message: dict):
+        self._offer(self.stats_subscribers, message)
+
+    async def send_to_socket(self, websocket: WebSocket, message: dict):
+        """发送给单个连接（与广播共用发送队列，避免并发写同一个 socket）"""
+        outbound = self._outbound.get(websocket)
+        if outbound is not None:
+            outbound.offer(_dumps(message), message.get("type"))
+
     async def send_personal(self, user_id: int, message: dict):
         """发送给特定用户"""
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id].copy():
-                try:
-                    await connection.send_json(message)
-                except:
-                    self.active_connections[user_id].discard(connection)
-    
+        self._offer(self.active_connections.get(user_id), message)
+
     async def send_to_admins(self, message: dict):
         """发送给所有管理员"""
-        for connection in self.admin_connections.copy():
-            try:
-                await connection.send_json(message)
-            except:
-                self.admin_connections.discard(connection)
-    
+        self._offer(self.admin_connections, message)
+
     async def broadcast(self, message: dict):
         """广播给所有连接"""
-        for connections in self.active_connections.values():
-            for connection in connections.copy():
-                try:
-                    await connection.send_json(message)
-                except:
-                    connections.discard(connection)
+        self._offer([c for conns in self.active_connections.values() for c in conns], message)
 
 
 # 全局连接管理器
 manager = ConnectionManager()
 
 
+class _Broadcaster:
+    """
+    管理后台推送的合并器
+
+    - stats_update：防抖，每个间隔内最多推送一次
+    - log_update：每隔 ws_log_batch_interval 秒把期间的新日志合并为一个数组推送
+    """
+
+    def __init__(self):
+        self._stats_handle: Optional[asyncio.TimerHandle] = None
+        self._stats_last_sent = 0.0
+        self._log_buffer: List[dict] = []
+        self._log_handle: Optional[asyncio.TimerHandle] = None
+
+    def request_stats(self):
+        if timer_pending(self._stats_handle):
+            return
+        delay = max(self._stats_last_sent + settings.ws_stats_debounce_seconds - time.monotonic(), 0)
+        self._stats_handle = asyncio.get_running_loop().call_later(delay, self._flush_stats)
+
+    def _flush_stats(self):
+        self._stats_handle = None
+        self._stats_last_sent = time.monotonic()
+        # 已订阅实时统计的连接会收到增量，不再需要“重新拉取”提醒
+        manager._offer(manager.admin_connections - manager.stats_subscribers, {
+            "type": "stats_update",
+            "message": "统计数据已更新"
+        })
+
+    def add_log(self, log_data: dict):
+        if not manager.admin_connections:
+            return
+        # 防止无人消费时缓冲无限增长
+        if len(self._log_buffer) >= settings.ws_send_queue_size * 10:
+            self._log_buffer.pop(0)
+            WEBSOCKET_DROPPED_TOTAL.inc(reason="log_buffer_full")
+        self._log_buffer.append(log_data)
+        if not timer_pending(self._log_handle):
+            self._log_handle = asyncio.get_running_loop().call_later(
+                settings.ws_log_batch_interval, self._flush_logs
+            )
+
+    def _flush_logs(self):
+        self._log_handle = None
+        batch, self._log_buffer = self._log_buffer, []
+        if batch:
+            manager._offer(manager.admin_connections, {
+                "type": "log_update",
+                "data": batch,
+                "count": len(batch)
+            })
+
+
+broadcaster = _Broadcaster()
+
+
+# ===== 经总线分发：每个 worker 只推送给自己持有的连接 =====
+
+bus.subscribe("stats_update", lambda _: broadcaster.request_stats())
+bus.subscribe("log_update", broadcaster.add_log)
+bus.subscribe("credential_update", lambda _: manager._offer(manager.admin_connections, {
+    "type": "credential_update",
+    "message": "凭证列表已更新"
+}))
+bus.subscribe("user_update", lambda _: manager._offer(manager.admin_connections, {
+    "type": "user_update",
+    "message": "用户列表已更新"
+}))
+
+
 async def notify_stats_update():
-    """通知统计数据更新"""
-    await manager.send_to_admins({
-        "type": "stats_update",
-        "message": "统计数据已更新"
-    })
+    """通知统计数据更新（防抖，不阻塞调用方）"""
+    bus.publish("stats_update")
 
 
 async def notify_credential_update():
     """通知凭证更新"""
-    await manager.send_to_admins({
-        "type": "credential_update",
-        "message": "凭证列表已更新"
-    })
+    bus.publish("credential_update")
 
 
 async def notify_user_update():
     """通知用户列表更新"""
-    await manager.send_to_admins({
-        "type": "user_update",
-        "message": "用户列表已更新"
-    })
+    bus.publish("user_update")
 
 
 async def notify_log_update(log_data: dict):
-    """通知新日志"""
-    await manager.send_to_admins({
-        "type": "log_update",
-        "data": log_data
-    })
+    """通知新日志（批量合并后推送，data 为日志数组）"""
+    bus.publish("log_update", log_data)
@@ -3,10 +3,21 @@
 
 提供标准化的日志记录功能，替代项目中的 print() 调用
 支持颜色输出、日志级别、结构化日志等功能
+
+日志经有界队列（QueueHandler）交给后台线程（QueueListener）写出，stdout 是慢管道
+（如 docker logs）时也不会阻塞事件循环；队列满时直接丢弃并计数。
+消息在后台线程中才格式化（log_info("Proxy", "模型: %s", model) 形式的参数惰性格式化），
+高频模块的 INFO 日志可按模块采样（log_sample_rates）。
 """
+import atexit
+import json
 import logging
+import queue
 import sys
-from typing import Optional, Any
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Any
 from datetime import datetime
 
 
@@ -31,15 +42,173 @@ class ColoredFormatter(logging.Formatter):
         if self.use_colors:
             levelname = record.levelname
             if levelname in self.COLORS:
+                # 同一条记录还会交给文件 handler，格式化后恢复原级别名
                 record.levelname = f"{self.COLORS[levelname]}{levelname}{self.RESET}"
+                try:
+                    return super().format(record)
+                finally:
+                    record.levelname = levelname
         return super().format(record)
 
 
+class JsonFormatter(logging.Formatter):
+    """结构化 JSON 日志（每行一个对象），便于日志平台检索"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "module": getattr(record, "log_module", record.name),
+            "message": str(getattr(record, "log_message", None) or record.getMessage()),
+        }
+        context = getattr(record, "log_context", None)
+        if context:
+            data["context"] = context
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _LogStats:
+    """日志管道计数（/metrics 导出）"""
+
+    def __init__(self):
+        self.dropped = 0  # 队列满被丢弃
+        self.sampled = 0  # 被采样丢弃
+
+
+log_stats = _LogStats()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """有界队列 handler：不格式化、不阻塞，队列满时丢弃并计数"""
+
+    def prepare(self, record):
+        # 同进程队列无需序列化，格式化推迟到监听线程
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats.dropped += 1
+
+
+class _LogPipeline:
+    """当前生效的队列 + 后台监听线程"""
+
+    def __init__(self):
+        self.queue: Optional[queue.Queue] = None
+        self.listener: Optional[QueueListener] = None
+        self._lock = threading.Lock()
+
+    def start(self, logger: logging.Logger, handlers: List[logging.Handler], queue_size: int):
+        """（重新）启动管道：先切换到新队列，再停止旧监听线程（旧队列中的记录会写完）"""
+        with self._lock:
+            new_queue = queue.Queue(maxsize=max(queue_size, 0))
+            listener = QueueListener(new_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            old_listener = self.listener
+            self.queue, self.listener = new_queue, listener
+            logger.handlers = [BoundedQueueHandler(new_queue)]
+            if old_listener is not None:
+                old_listener.stop()
+                for handler in old_listener.handlers:
+                    handler.close()
+
+    def stop(self):
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def flush(self, timeout: float):
+        """等待队列中的日志写完（最多 timeout 秒）"""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+
+_pipeline = _LogPipeline()
+atexit.register(_pipeline.stop)
+
+
+class _Sampler:
+    """按模块采样 INFO 日志：采样率 r 表示每 round(1/r) 条保留 1 条"""
+
+    def __init__(self):
+        self._every: Dict[str, int] = {}
+        self._counts: Dict[str, int] = {}
+
+    def configure(self, spec: str):
+        """spec 形如 "Auth=0.1,Sequential=0.2" """
+        every = {}
+        for item in (spec or "").split(","):
+            module, sep, rate = item.partition("=")
+            if not sep:
+                continue
+            try:
+                rate = float(rate)
+            except ValueError:
+                continue
+            if 0 < rate < 1:
+                every[module.strip()] = max(round(1 / rate), 1)
+        self._every = every
+        self._counts = {}
+
+    def keep(self, module: str) -> bool:
+        every = self._every.get(module)
+        if every is None:
+            return True
+        count = self._counts.get(module, 0) + 1
+        self._counts[module] = count
+        return every == 1 or count % every == 1
+
+
+_sampler = _Sampler()
+
+
+def _build_handlers(use_colors: bool, log_file: Optional[str], json_format: bool) -> List[logging.Handler]:
+    # 控制台 handler
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.DEBUG)
+    if json_format:
+        console_formatter = JsonFormatter()
+    else:
+        console_formatter = ColoredFormatter(
+            '%(asctime)s [%(levelname)s] %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S',
+            use_colors=use_colors
+        )
+    console_handler.setFormatter(console_formatter)
+    handlers = [console_handler]
+
+    # 文件 handler（可选）
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setLevel(logging.DEBUG)
+        if json_format:
+            file_formatter = JsonFormatter()
+        else:
+            file_formatter = logging.Formatter(
+                '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'
+            )
+        file_handler.setFormatter(file_formatter)
+        handlers.append(file_handler)
+    return handlers
+
+
 def setup_logger(
     name: str = "cati_cli",
     level: str = "INFO",
     use_colors: bool = True,
-    log_file: Optional[str] = None
+    log_file: Optional[str] = None,
+    json_format: bool = False,
+    queue_size: int = 10000
 ) -> logging.Logger:
     """
     设置日志记录器
@@ -49,126 +218,173 @@ def setup_logger(
         level: 日志级别 (DEBUG, INFO, WARNING, ERROR, CRITICAL)
         use_colors: 是否使用颜色输出
         log_file: 日志文件路径（可选）
+        json_format: 是否输出 JSON 格式
+        queue_size: 日志队列长度，满时丢弃新日志
 
     Returns:
         配置好的 Logger 实例
     """
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, level.upper()))
+    logger.propagate = False
 
     # 避免重复添加 handler
     if logger.handlers:
         return logger
 
-    # 控制台 handler
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.DEBUG)
-    console_formatter = ColoredFormatter(
-        '%(asctime)s [%(levelname)s] %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        use_colors=use_colors
+    _pipeline.start(logger, _build_handlers(use_colors, log_file, json_format), queue_size)
+    return logger
+
+
+def configure_logging():
+    """按配置重建日志管道（格式、队列长度、采样率），应用启动时调用"""
+    from app.config import settings
+
+    logger.setLevel(getattr(logging, settings.log_level.upper(), logging.INFO))
+    _sampler.configure(settings.log_sample_rates)
+    _pipeline.start(
+        logger,
+        _build_handlers(True, settings.log_file or None, settings.log_format == "json"),
+        settings.log_queue_size,
     )
-    console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
 
-    # 文件 handler（可选）
-    if log_file:
-        file_handler = logging.FileHandler(log_file, encoding='utf-8')
-        file_handler.setLevel(logging.DEBUG)
-        file_formatter = logging.Formatter(
-            '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
 
-    return logger
+def get_log_stats() -> dict:
+    return {"queued": _pipeline.depth(), "dropped": log_stats.dropped, "sampled": log_stats.sampled}
+
+
+def flush_logs(timeout: float = 5.0):
+    """关闭前等待日志队列写完（同步阻塞，异步代码中放到线程池执行）"""
+    _pipeline.flush(timeout)
 
 
 # 全局日志实例
 logger = setup_logger()
 
 
+class _LazyMessage:
+    """在监听线程中才执行 message % args"""
+
+    __slots__ = ("message", "args")
+
+    def __init__(self, message: str, args: tuple):
+        self.message = message
+        self.args = args
+
+    def __str__(self):
+        if not self.args:
+            return self.message
+        try:
+            return self.message % self.args
+        except (TypeError, ValueError):
+            return f"{self.message} {self.args}"
+
+
+class _Context:
+    __slots__ = ("kwargs",)
+
+    def __init__(self, kwargs: dict):
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return f" | {self.kwargs}"
+
+
+def _log(level: int, module: str, prefix: str, message: str, args: tuple, kwargs: dict,
+         exc_info: Optional[Exception] = None):
+    if not logger.isEnabledFor(level):
+        return
+    if level == logging.INFO and not _sampler.keep(module):
+        log_stats.sampled += 1
+        return
+    text = _LazyMessage(message, args)
+    logger.log(
+        level, "[%s] %s%s%s", module, prefix, text, _Context(kwargs) if kwargs else "",
+        exc_info=exc_info,
+        extra={"log_module": module, "log_message": text, "log_context": kwargs or None},
+    )
+
+
 # ===== 便捷日志函数 =====
 
-def log_debug(module: str, message: str, **kwargs):
+def log_debug(module: str, message: str, *args, **kwargs):
     """
     记录 DEBUG 级别日志
 
     Args:
         module: 模块名称（如 "Proxy", "Auth"）
-        message: 日志消息
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.debug(f"[{module}] {message}{extra_info}")
+    _log(logging.DEBUG, module, "", message, args, kwargs)
 
 
-def log_info(module: str, message: str, **kwargs):
+def log_info(module: str, message: str, *args, **kwargs):
     """
-    记录 INFO 级别日志
+    记录 INFO 级别日志（可按模块采样）
 
     Args:
-        module: 模块名称
-        message: 日志消息
+        module: 模块名称（如 "Proxy", "Auth"）
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.info(f"[{module}] {message}{extra_info}")
+    _log(logging.INFO, module, "", message, args, kwargs)
 
 
-def log_warning(module: str, message: str, **kwargs):
+def log_warning(module: str, message: str, *args, **kwargs):
     """
     记录 WARNING 级别日志（带 ⚠️ emoji）
 
     Args:
-        module: 模块名称
-        message: 日志消息
+        module: 模块名称（如 "Proxy", "Auth"）
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.warning(f"[{module}] ⚠️ {message}{extra_info}")
+    _log(logging.WARNING, module, "⚠️ ", message, args, kwargs)
 
 
-def log_error(module: str, message: str, exc_info: Optional[Exception] = None, **kwargs):
+def log_error(module: str, message: str, *args, exc_info: Optional[Exception] = None, **kwargs):
     """
     记录 ERROR 级别日志（带 ❌ emoji）
 
     Args:
-        module: 模块名称
-        message: 日志消息
+        module: 模块名称（如 "Proxy", "Auth"）
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         exc_info: 异常对象（可选）
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.error(f"[{module}] ❌ {message}{extra_info}", exc_info=exc_info)
+    _log(logging.ERROR, module, "❌ ", message, args, kwargs, exc_info)
 
 
-def log_success(module: str, message: str, **kwargs):
+def log_success(module: str, message: str, *args, **kwargs):
     """
-    记录成功日志（INFO 级别，带 ✅ emoji）
+    记录成功日志（INFO 级别，带 ✅ emoji，可按模块采样）
 
     Args:
-        module: 模块名称
-        message: 日志消息
+        module: 模块名称（如 "Proxy", "Auth"）
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.info(f"[{module}] ✅ {message}{extra_info}")
+    _log(logging.INFO, module, "✅ ", message, args, kwargs)
 
 
-def log_critical(module: str, message: str, exc_info: Optional[Exception] = None, **kwargs):
+def log_critical(module: str, message: str, *args, exc_info: Optional[Exception] = None, **kwargs):
     """
     记录 CRITICAL 级别日志（带 🔥 emoji）
 
     Args:
-        module: 模块名称
-        message: 日志消息
+        module: 模块名称（如 "Proxy", "Auth"）
+        message: 日志消息，可包含 %s 占位符（配合 args 惰性格式化）
+        *args: 消息格式化参数
         exc_info: 异常对象（可选）
         **kwargs: 额外的上下文信息
     """
-    extra_info = f" | {kwargs}" if kwargs else ""
-    logger.critical(f"[{module}] 🔥 {message}{extra_info}", exc_info=exc_info)
+    _log(logging.CRITICAL, module, "🔥 ", message, args, kwargs, exc_info)
 
 
 # ===== 特殊用途日志函数 =====
@@ -305,6 +521,9 @@ def print_log(message: str, level: str = "INFO", module: str = "App", flush: boo
 __all__ = [
     'logger',
     'setup_logger',
+    'configure_logging',
+    'get_log_stats',
+    'JsonFormatter',
     'log_debug',
     'log_info',
     'log_warning',
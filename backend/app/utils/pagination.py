@@ -0,0 +1,157 @@
+"""
+日志列表分页工具
+
+提供基于 (created_at, id) 的游标分页（keyset pagination）和近似计数，
+避免深分页时 OFFSET 扫描以及每次筛选都执行全表 COUNT(*)。
+
+游标对前端是不透明的字符串，只需原样回传 next_cursor 即可翻到下一页。
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import select, func, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+# 精确计数的上限：超过此数量时只返回“至少 N 条”的估算值
+COUNT_CAP = 10000
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """将 (created_at, id) 编码为不透明游标"""
+    raw = json.dumps([created_at.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    解码游标
+
+    Raises:
+        ValueError: 游标格式无效
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+
+
+def apply_keyset(query, model, cursor: Optional[str]):
+    """
+    为查询追加 keyset 条件和排序（按 created_at, id 倒序）
+
+    Args:
+        query: select 查询
+        model: 带 created_at / id 列的 ORM 模型
+        cursor: 上一页返回的 next_cursor，为空表示第一页
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.where(tuple_(model.created_at, model.id) < tuple_(created_at, row_id))
+    return query.order_by(model.created_at.desc(), model.id.desc())
+
+
+def next_cursor_for(rows, limit: int, model_attr: str = "UsageLog") -> Optional[str]:
+    """根据本页结果生成下一页游标（不足一页说明已到末尾）"""
+    if len(rows) < limit or not rows:
+        return None
+    last = getattr(rows[-1], model_attr)
+    return encode_cursor(last.created_at, last.id)
+
+
+class _Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) 包装，用于读取 PostgreSQL 规划器的行数估算"""
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def _is_postgres(db: AsyncSession) -> bool:
+    """会话实际连接的是否为 PostgreSQL（只读副本可能与主库类型不同）"""
+    try:
+        return db.get_bind().dialect.name == "postgresql"
+    except Exception:
+        return False
+
+
+async def _planner_estimate(db: AsyncSession, query) -> Optional[int]:
+    """读取 PostgreSQL 规划器对查询结果行数的估算"""
+    try:
+        # 使用 SAVEPOINT：PostgreSQL 上语句失败会中止整个事务，之后的列表查询也会失败
+        async with db.begin_nested():
+            result = await db.execute(_Explain(query))
+            plan = result.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception:
+        return None
+
+
+async def _table_estimate(db: AsyncSession, table_name: str) -> Optional[int]:
+    """不带筛选条件时的整表行数估算"""
+    try:
+        if _is_postgres(db):
+            async with db.begin_nested():
+                result = await db.execute(
+                    text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"),
+                    {"name": table_name}
+                )
+                value = result.scalar()
+            # reltuples 为 -1 表示表尚未 ANALYZE
+            return int(value) if value is not None and value >= 0 else None
+        # SQLite: 自增主键基本连续，用 id 区间估算（走主键索引，O(1)）
+        result = await db.execute(text(f"SELECT MIN(id), MAX(id) FROM {table_name}"))
+        row = result.first()
+        if not row or row[0] is None:
+            return 0
+        return int(row[1]) - int(row[0]) + 1
+    except Exception:
+        return None
+
+
+async def estimate_count(
+    db: AsyncSession,
+    query,
+    table_name: str,
+    filtered: bool = True
+) -> Tuple[int, bool]:
+    """
+    估算查询的结果总数
+
+    - 无筛选条件：使用表统计信息（PostgreSQL reltuples / SQLite id 区间）
+    - 有筛选条件（PostgreSQL）：使用规划器估算
+    - 其他情况：精确计数，但最多数到 COUNT_CAP 条
+
+    Args:
+        query: 不含排序/分页的 select 查询
+        table_name: 主表名
+        filtered: 查询是否带有筛选条件
+
+    Returns:
+        (总数, 是否为估算值)
+    """
+    if not filtered:
+        estimate = await _table_estimate(db, table_name)
+        if estimate is not None:
+            return estimate, True
+    elif _is_postgres(db):
+        estimate = await _planner_estimate(db, query)
+        if estimate is not None:
+            return estimate, True
+
+    capped = select(func.count()).select_from(query.limit(COUNT_CAP).subquery())
+    count = (await db.execute(capped)).scalar() or 0
+    return count, count >= COUNT_CAP
@@ -89,6 +89,7 @@ SKIP_PREFIXES: List[str] = [
     "/oauth/",
     "/favicon",
     "/index.html",
+    "/metrics",
 ]
 
 
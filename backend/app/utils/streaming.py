@@ -0,0 +1,26 @@
+"""
+流式响应工具
+"""
+from typing import Callable
+
+from fastapi.responses import StreamingResponse
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    发送结束时调用 on_close 的流式响应
+
+    客户端在响应体开始前断开时生成器从未被迭代，其 finally 不会执行；
+    需要在流结束时释放的资源（并发名额、扇出订阅等）由 __call__ 结束时兜底释放。
+    on_close 需幂等（生成器 finally 中通常也会释放）
+    """
+
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
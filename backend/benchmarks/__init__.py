@@ -0,0 +1,11 @@
+"""
+压测工具包
+
+- mock_upstream: 本地模拟 gcli2api / OpenAI 上游（可配置延迟、错误率、SSE 分块节奏）
+- loadgen: 并发压测驱动，在进程内启动真实应用或压测已运行的实例
+- report: 结果统计（吞吐、延迟分位数、TTFB、日志写入速率）与不同提交间的对比
+
+用法（在 backend 目录下）:
+    python -m benchmarks.loadgen --concurrency 50 --requests 2000 --stream-ratio 0.5
+    python -m benchmarks.report benchmarks/results/old.json benchmarks/results/new.json
+"""
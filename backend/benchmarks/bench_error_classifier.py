@@ -0,0 +1,125 @@
+"""
+错误分类器基准测试
+
+语料为上游（Google / Antigravity / OpenAI 兼容端点）实际返回过的错误文本，
+分别测量首次分类（未命中缓存）和重复分类（命中缓存）的吞吐量:
+    python -m benchmarks.bench_error_classifier --rounds 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.error_classifier import DEFAULT_RULES, ErrorClassifier  # noqa: E402
+
+
+def _google_error(code: int, status: str, message: str, details: list = None) -> str:
+    error = {"code": code, "message": message, "status": status}
+    if details:
+        error["details"] = details
+    return json.dumps({"error": error}, indent=2)
+
+
+_QUOTA_DETAILS = [
+    {
+        "@type": "type.googleapis.com/google.rpc.ErrorInfo",
+        "reason": "RATE_LIMIT_EXCEEDED",
+        "domain": "cloudcode-pa.googleapis.com",
+        "metadata": {"quota_limit": "GenerateContentRequestsPerMinutePerProjectPerRegion", "quota_limit_value": "60"},
+    },
+    {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "37s"},
+]
+
+# (状态码, 错误文本)
+CORPUS = [
+    (429, _google_error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")),
+    (429, _google_error(429, "RESOURCE_EXHAUSTED",
+                        "Quota exceeded for quota metric 'Generate Content API requests per minute'",
+                        _QUOTA_DETAILS)),
+    (429, _google_error(429, "RESOURCE_EXHAUSTED", "You have exhausted your capacity on this model.")),
+    (429, "Rate limit reached for requests. Please try again in 20s."),
+    (403, _google_error(403, "PERMISSION_DENIED",
+                        "The caller does not have permission. Cloud Code Private API has not been used in project 123456789012")),
+    (403, _google_error(403, "PERMISSION_DENIED", "Daily limit for Gemini Code Assist reached")),
+    (403, "This API method requires billing to be enabled. Please enable billing on project #123456789012"),
+    (403, "Forbidden"),
+    (401, _google_error(401, "UNAUTHENTICATED",
+                        "Request had invalid authentication credentials. Expected OAuth 2 access token.")),
+    (400, _google_error(400, "INVALID_ARGUMENT", "Request contains an invalid argument.")),
+    (400, _google_error(400, "INVALID_ARGUMENT", "Unable to submit request because it has an empty text parameter.")),
+    (400, _google_error(400, "FAILED_PRECONDITION", "User location is not supported for the API use.")),
+    (400, '{"promptFeedback": {"blockReason": "SAFETY", "safetyRatings": [{"category": "HARM_CATEGORY_HARASSMENT", "probability": "HIGH"}]}}'),
+    (400, _google_error(400, "NOT_FOUND", "Requested entity was not found: model gemini-9-ultra not found")),
+    (400, '{"error": {"message": "The model `gpt-5-turbo` does not exist or you do not have access to it.", "type": "invalid_request_error"}}'),
+    (404, _google_error(404, "NOT_FOUND", "models/gemini-1.0-pro is not found for API version v1internal")),
+    (500, _google_error(500, "INTERNAL", "An internal error has occurred. Please retry or report in https://developers.generativeai.google/guide/troubleshooting")),
+    (502, "<html><head><title>502 Bad Gateway</title></head><body><center><h1>502 Bad Gateway</h1></center><hr><center>nginx</center></body></html>"),
+    (503, _google_error(503, "UNAVAILABLE", "The model is overloaded. Please try again later.")),
+    (504, "upstream request timeout"),
+    (0, "httpx.ReadTimeout: The read operation timed out"),
+    (0, "httpx.ConnectError: [Errno 111] Connection refused"),
+    (0, "ECONNRESET: socket hang up"),
+    (0, "[Errno -2] Name or service not known (getaddrinfo failed)"),
+    (0, "Token 刷新失败: invalid_grant (Token has been expired or revoked.)"),
+    (0, "Stream ended unexpectedly"),
+    (200, '{"error": {"code": "DEADLINE_EXCEEDED", "message": "deadline"}}'),
+    # 大响应体：带完整 debug 信息的多 KB 错误
+    (429, _google_error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted " + "x" * 6000, _QUOTA_DETAILS * 20)),
+    (500, "Traceback (most recent call last):\n" + "  File \"/srv/app.py\", line 42, in handler\n" * 400 + "RuntimeError: boom"),
+]
+
+
+def _variants(rounds: int):
+    """同一错误的不同实例（请求 ID、项目号、重试时间等数字不同）"""
+    for i in range(rounds):
+        for status, text in CORPUS:
+            yield status, text.replace("123456789012", str(100000000000 + i)).replace("37s", f"{i % 60}s")
+
+
+def run(rounds: int) -> dict:
+    samples = list(_variants(rounds))
+
+    # 首次分类：每次都用新的分类器（缓存为空）
+    cold = ErrorClassifier(DEFAULT_RULES, cache_size=0)
+    started = time.perf_counter()
+    for status, text in samples:
+        cold.classify(status, text)
+    cold_elapsed = time.perf_counter() - started
+
+    # 缓存命中：数字归一化后同一错误的不同实例共用一条缓存
+    warm = ErrorClassifier(DEFAULT_RULES)
+    for status, text in CORPUS:
+        warm.classify(status, text)
+    started = time.perf_counter()
+    for status, text in samples:
+        warm.classify(status, text)
+    warm_elapsed = time.perf_counter() - started
+
+    return {
+        "samples": len(samples),
+        "corpus": len(CORPUS),
+        "cold_us_per_call": cold_elapsed / len(samples) * 1e6,
+        "cold_calls_per_sec": len(samples) / cold_elapsed,
+        "memoised_us_per_call": warm_elapsed / len(samples) * 1e6,
+        "memoised_calls_per_sec": len(samples) / warm_elapsed,
+        "cache": warm.cache_info(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="错误分类器基准测试")
+    parser.add_argument("--rounds", type=int, default=200, help="语料重复轮数")
+    args = parser.parse_args()
+
+    result = run(args.rounds)
+    print(f"语料 {result['corpus']} 条，共分类 {result['samples']} 次")
+    print(f"未命中缓存: {result['cold_us_per_call']:.1f} µs/次  ({result['cold_calls_per_sec']:.0f} 次/秒)")
+    print(f"命中缓存:   {result['memoised_us_per_call']:.1f} µs/次  ({result['memoised_calls_per_sec']:.0f} 次/秒)")
+    print(f"缓存: {result['cache']}")
+
+
+if __name__ == "__main__":
+    main()
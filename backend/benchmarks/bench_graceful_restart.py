@@ -0,0 +1,251 @@
+"""
+优雅关闭场景测试：流式响应进行中重启服务
+
+在子进程中用 uvicorn 启动真实应用（SIGTERM 只能由主线程接管），上游为模拟上游。
+同时发起若干 gcli2api 和 OpenAI 端点的慢速流式请求，流进行到一半时向应用发送 SIGTERM，检查：
+
+- /api/ready 变为 503，新请求返回 503
+- 排空超时足够时所有流完整结束，用量（流结束后才写入的 token 数）在退出前写入数据库
+- 排空超时不足时流被中断，日志状态码为 499 并带上已转发的字节数
+
+两次重启共用同一个数据库文件:
+    python -m benchmarks.bench_graceful_restart --streams 4 --chunks 30 --chunk-interval-ms 100
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.loadgen import BENCH_ADMIN_PASSWORD, BENCH_UPSTREAM_PASSWORD, ServerThread, _free_port  # noqa: E402
+from benchmarks.mock_upstream import MockConfig, create_app as create_mock_app  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STREAM_KINDS = (
+    ("gcli2api", "gemini-2.5-flash"),
+    ("openai", "mock-gpt"),
+)
+
+
+def _start_app(port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+async def _wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=2) as client:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"应用启动失败，退出码 {process.returncode}")
+            try:
+                if (await client.get("/api/ready")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("应用启动超时")
+
+
+async def _setup(base_url: str, mock_url: str) -> str:
+    """创建指向模拟上游的 OpenAI 端点和 API Key"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        login = await client.post("/api/auth/login", json={"username": "admin", "password": BENCH_ADMIN_PASSWORD})
+        login.raise_for_status()
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        created = await client.post("/api/manage/openai-endpoints", headers=headers, data={
+            "name": "mock", "api_key": "sk-mock", "base_url": f"{mock_url}/v1",
+        })
+        created.raise_for_status()
+        created = await client.post("/api/auth/api-keys", json={"name": "restart"}, headers=headers)
+        created.raise_for_status()
+        return created.json()["key"]
+
+
+async def _stream(client: httpx.AsyncClient, model: str) -> dict:
+    body = {"model": model, "stream": True, "messages": [{"role": "user", "content": "讲个故事"}]}
+    result = {"status": 0, "bytes": 0, "complete": False}
+    tail = b""
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+            result["status"] = response.status_code
+            async for chunk in response.aiter_raw():
+                result["bytes"] += len(chunk)
+                tail = (tail + chunk)[-256:]
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["complete"] = b"[DONE]" in tail
+    return result
+
+
+async def _probe_after_signal(base_url: str, api_key: str) -> dict:
+    """SIGTERM 后检查就绪探针和新请求"""
+    await asyncio.sleep(0.3)
+    probe = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=5) as client:
+        try:
+            probe["ready"] = (await client.get("/api/ready")).status_code
+            response = await client.post(
+                "/v1/chat/completions", headers={"Authorization": f"Bearer {api_key}"},
+                json={"model": "gemini-2.5-flash", "messages": [{"role": "user", "content": "hi"}]},
+            )
+            probe["new_request"] = response.status_code
+        except httpx.TransportError as e:
+            probe["error"] = type(e).__name__
+    return probe
+
+
+def _logs_since(db_path: str, last_id: int) -> list:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(
+            "SELECT id, model, endpoint, status_code, completion_tokens, response_bytes FROM usage_logs "
+            "WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+
+def _max_log_id(db_path: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM usage_logs").fetchone()[0]
+
+
+async def _restart_once(base_url: str, process: subprocess.Popen, api_key: str, args) -> dict:
+    async with httpx.AsyncClient(base_url=base_url, timeout=120,
+                                 headers={"Authorization": f"Bearer {api_key}"}) as client:
+        streams = [
+            asyncio.create_task(_stream(client, model))
+            for _, model in STREAM_KINDS for _ in range(args.streams)
+        ]
+        await asyncio.sleep(args.signal_after)
+        signalled = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        probe = await _probe_after_signal(base_url, api_key)
+        results = await asyncio.gather(*streams)
+    while process.poll() is None and time.perf_counter() - signalled < 120:
+        await asyncio.sleep(0.05)
+    return {
+        "streams": results,
+        "probe": probe,
+        "exit_seconds": time.perf_counter() - signalled,
+        "exit_code": process.returncode,
+    }
+
+
+def _check(phase: str, outcome: dict, logs: list, graceful: bool, args) -> list:
+    """返回未通过的检查项"""
+    failures = []
+    if outcome["probe"].get("ready") != 503:
+        failures.append(f"/api/ready 未返回 503: {outcome['probe']}")
+    if outcome["probe"].get("new_request") != 503:
+        failures.append(f"排空期间新请求未返回 503: {outcome['probe']}")
+    complete = sum(1 for r in outcome["streams"] if r["complete"])
+    if graceful and complete != len(outcome["streams"]):
+        failures.append(f"有流未完整结束: {complete}/{len(outcome['streams'])}")
+    if not graceful and complete == len(outcome["streams"]):
+        failures.append("排空超时过长，流没有被中断（调大 --chunks 或调小 --cut-drain-timeout）")
+
+    stream_logs = [row for row in logs if row[3] != 503]
+    if len(stream_logs) != len(outcome["streams"]):
+        failures.append(f"流式请求日志数 {len(stream_logs)} != {len(outcome['streams'])}")
+    for row in stream_logs:
+        if graceful and (row[3] != 200 or row[4] != args.chunks):
+            failures.append(f"日志用量缺失: {row}")
+        elif not graceful and row[3] != 499:
+            failures.append(f"中断的流未记录为 499: {row}")
+        elif not row[5]:
+            failures.append(f"日志未记录转发字节数: {row}")
+    return failures
+
+
+def run(args) -> dict:
+    mock_config = MockConfig(latency_ms=50, jitter_ms=0, chunk_count=args.chunks,
+                             chunk_interval_ms=args.chunk_interval_ms)
+    mock = ServerThread(create_mock_app(mock_config), _free_port())
+    mock.start()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="catie-restart-") as tmpdir:
+        db_path = os.path.join(tmpdir, "restart.db")
+        env = {
+            "DATABASE_URL": f"sqlite+aiosqlite:///{db_path}",
+            "ADMIN_USERNAME": "admin",
+            "ADMIN_PASSWORD": BENCH_ADMIN_PASSWORD,
+            "GCLI2API_BASE_URL": mock.url,
+            "GCLI2API_API_PASSWORD": BENCH_UPSTREAM_PASSWORD,
+            "GCLI2API_PANEL_PASSWORD": BENCH_UPSTREAM_PASSWORD,
+            "ENABLE_GCLI2API_BRIDGE": "true",
+            "ENDPOINT_PRIORITY": "gcli2api,openai",
+            "METRICS_TOKEN": "",
+            "BASE_RPM": "0",
+            "BASE_MAX_STREAMS": "0",
+            # 流式用量只在关闭时写入，验证关闭阶段的写缓冲
+            "USAGE_FLUSH_INTERVAL": "3600",
+        }
+        api_key = None
+        phases = (("graceful", args.drain_timeout, True), ("cut", args.cut_drain_timeout, False))
+        try:
+            for phase, drain_timeout, graceful in phases:
+                port = _free_port()
+                base_url = f"http://127.0.0.1:{port}"
+                process = _start_app(port, {**env, "SHUTDOWN_DRAIN_TIMEOUT": str(drain_timeout)})
+                try:
+                    asyncio.run(_wait_ready(base_url, process))
+                    if api_key is None:
+                        api_key = asyncio.run(_setup(base_url, mock.url))
+                        # 等待模型目录刷新，mock-gpt 路由到 OpenAI 端点
+                        time.sleep(1)
+                    last_id = _max_log_id(db_path)
+                    outcome = asyncio.run(_restart_once(base_url, process, api_key, args))
+                finally:
+                    if process.poll() is None:
+                        process.kill()
+                        process.wait()
+                logs = _logs_since(db_path, last_id)
+                outcome["logs"] = logs
+                outcome["failures"] = _check(phase, outcome, logs, graceful, args)
+                results[phase] = outcome
+        finally:
+            mock.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="优雅关闭场景测试：流式响应进行中重启服务")
+    parser.add_argument("--streams", type=int, default=4, help="每种端点的并发流数")
+    parser.add_argument("--chunks", type=int, default=30, help="每个流的分块数")
+    parser.add_argument("--chunk-interval-ms", type=float, default=100)
+    parser.add_argument("--signal-after", type=float, default=1.0, help="发起请求后多久发送 SIGTERM（秒）")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="第一次重启的排空超时（足够流结束）")
+    parser.add_argument("--cut-drain-timeout", type=float, default=0.5, help="第二次重启的排空超时（流会被中断）")
+    args = parser.parse_args()
+
+    results = run(args)
+    failed = False
+    for phase, label in (("graceful", "排空后重启"), ("cut", "排空超时重启")):
+        r = results[phase]
+        complete = sum(1 for s in r["streams"] if s["complete"])
+        print(f"{label}: 完整结束的流 {complete}/{len(r['streams'])}  退出耗时 {r['exit_seconds']:.1f}s  "
+              f"退出码 {r['exit_code']}  探针 {r['probe']}")
+        for row in r["logs"]:
+            print(f"    日志 #{row[0]} {row[2]} status={row[3]} completion_tokens={row[4]} bytes={row[5]}")
+        for failure in r["failures"]:
+            print(f"    失败: {failure}")
+        failed = failed or bool(r["failures"])
+    print("FAIL" if failed else "PASS")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+前缀亲和路由基准测试
+
+启动若干个带模拟上下文缓存的 OpenAI 兼容上游（每个上游只缓存 context_cache_entries 个前缀），
+注册为同优先级的 OpenAI 端点，用若干个“角色卡”（长系统提示词 + 随机用户消息）压测，
+分别在关闭 / 开启前缀亲和时统计上游上下文缓存命中率和延迟:
+    python -m benchmarks.bench_prefix_affinity --endpoints 4 --personas 32 --requests 800
+
+关闭亲和时每个上游都会见到全部角色卡，命中率约为 缓存容量 / 角色卡数；
+开启后每张角色卡固定落在一个上游上，命中率接近 1 - 角色卡数 / 请求数。
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.loadgen import BENCH_ADMIN_PASSWORD, ServerThread, _free_port  # noqa: E402
+from benchmarks.mock_upstream import MockConfig, create_app as create_mock_app  # noqa: E402
+from benchmarks.report import percentile  # noqa: E402
+
+MODEL = "mock-gpt"
+
+
+def _persona(tag: str, index: int, size: int) -> str:
+    rng = random.Random(f"{tag}-{index}")
+    words = ["角色", "设定", "背景", "性格", "说话风格", "世界观", "规则", "禁忌"]
+    text = f"你是角色 {tag}-{index}。"
+    while len(text.encode("utf-8")) < size:
+        text += rng.choice(words) + str(rng.randint(0, 9999)) + "，"
+    return text
+
+
+async def _login(client: httpx.AsyncClient) -> str:
+    login = await client.post("/api/auth/login", json={"username": "admin", "password": BENCH_ADMIN_PASSWORD})
+    login.raise_for_status()
+    return login.json()["access_token"]
+
+
+async def _setup(base_url: str, mocks) -> str:
+    """创建 OpenAI 端点和压测用 API Key"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        token = await _login(client)
+        headers = {"Authorization": f"Bearer {token}"}
+        for i, mock in enumerate(mocks):
+            created = await client.post("/api/manage/openai-endpoints", headers=headers, data={
+                "name": f"mock-{i}", "api_key": "sk-mock", "base_url": f"{mock.url}/v1",
+            })
+            created.raise_for_status()
+        created = await client.post("/api/auth/api-keys", json={"name": "benchmark"}, headers=headers)
+        created.raise_for_status()
+        return created.json()["key"]
+
+
+async def _mock_hits(mocks) -> tuple:
+    hit = miss = 0
+    async with httpx.AsyncClient(timeout=10) as client:
+        for mock in mocks:
+            stats = (await client.get(f"{mock.url}/__mock__/stats")).json()["hits"]
+            hit += stats.get("context_cache_hit", 0)
+            miss += stats.get("context_cache_miss", 0)
+    return hit, miss
+
+
+async def _run_phase(base_url: str, api_key: str, mocks, tag: str, args) -> dict:
+    rng = random.Random(args.seed)
+    personas = [_persona(tag, i, args.prefix_bytes) for i in range(args.personas)]
+    before = await _mock_hits(mocks)
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(rng.randrange(args.personas))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60,
+                                 headers={"Authorization": f"Bearer {api_key}"}) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                persona = queue.get_nowait()
+                body = {
+                    "model": MODEL,
+                    "messages": [
+                        {"role": "system", "content": personas[persona]},
+                        {"role": "user", "content": f"第 {rng.randint(0, 10 ** 6)} 个问题"},
+                    ],
+                }
+                start = time.perf_counter()
+                response = await client.post("/v1/chat/completions", json=body)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    after = await _mock_hits(mocks)
+    hit, miss = after[0] - before[0], after[1] - before[1]
+    return {
+        "hit_rate": hit / (hit + miss) if hit + miss else 0.0,
+        "hits": hit,
+        "misses": miss,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "rps": len(latencies) / elapsed,
+    }
+
+
+def run(args) -> dict:
+    mock_config = MockConfig(
+        latency_ms=args.latency_ms, jitter_ms=0, chunk_count=4,
+        context_cache_bytes=args.prefix_bytes // 2, context_cache_entries=args.cache_entries,
+    )
+    mocks = [ServerThread(create_mock_app(mock_config), _free_port()) for _ in range(args.endpoints)]
+    for mock in mocks:
+        mock.start()
+
+    with tempfile.TemporaryDirectory(prefix="catie-bench-") as tmpdir:
+        os.environ.update({
+            "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}",
+            "ADMIN_USERNAME": "admin",
+            "ADMIN_PASSWORD": BENCH_ADMIN_PASSWORD,
+            "ENDPOINT_PRIORITY": "openai",
+            "BASE_RPM": "0",
+            "METRICS_TOKEN": "",
+            "PREFIX_AFFINITY_BYTES": str(args.prefix_bytes // 2),
+            "PREFIX_AFFINITY_MIN_BYTES": "512",
+        })
+
+        from app.config import settings
+        from app.main import app
+
+        server = ServerThread(app, _free_port())
+        server.start()
+        try:
+            api_key = asyncio.run(_setup(server.url, mocks))
+            results = {}
+            for enabled in (False, True):
+                settings.prefix_affinity_enabled = enabled
+                tag = "on" if enabled else "off"
+                results[tag] = asyncio.run(_run_phase(server.url, api_key, mocks, tag, args))
+        finally:
+            server.stop()
+            for mock in mocks:
+                mock.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前缀亲和路由基准测试")
+    parser.add_argument("--endpoints", type=int, default=4, help="OpenAI 端点（模拟上游）数")
+    parser.add_argument("--personas", type=int, default=32, help="角色卡（不同长前缀）数")
+    parser.add_argument("--cache-entries", type=int, default=10, help="每个上游缓存的前缀数")
+    parser.add_argument("--prefix-bytes", type=int, default=4096, help="角色卡长度（字节）")
+    parser.add_argument("--requests", type=int, default=800, help="每个阶段的请求数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=100, help="上游未命中缓存时的延迟")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = run(args)
+    for tag, label in (("off", "关闭亲和"), ("on", "开启亲和")):
+        r = results[tag]
+        print(f"{label}: 命中率 {r['hit_rate']:.1%} ({r['hits']}/{r['hits'] + r['misses']})  "
+              f"p50 {r['p50_ms']:.0f} ms  p95 {r['p95_ms']:.0f} ms  {r['rps']:.0f} req/s  错误 {r['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+压测驱动
+
+两种模式:
+- 进程内（默认）: 在临时目录创建独立的 SQLite 数据库，启动模拟上游和真实应用（均为 uvicorn，
+  各自运行在独立线程的事件循环中），自动创建 API Key 后开始压测。
+- 外部实例: --target http://host:port --api-key sk-xxx，压测已运行的服务（上游需自行指向模拟上游）。
+
+示例:
+    python -m benchmarks.loadgen --concurrency 50 --requests 2000 --stream-ratio 0.5
+    python -m benchmarks.loadgen --duration 60 --latency-ms 300 --error-rate 0.05 --output base.json
+    python -m benchmarks.loadgen --target http://127.0.0.1:10601 --api-key sk-xxx --concurrency 20
+
+注意: 进程内模式下压测客户端、应用和模拟上游共享同一个 Python 进程（GIL），
+绝对数值偏保守，适合在同一台机器上对比不同提交的相对变化。
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Awaitable, Callable, List, Optional
+
+import httpx
+
+# 允许以 python benchmarks/loadgen.py 方式运行
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_upstream import add_mock_arguments, config_from_args, create_app as create_mock_app
+from benchmarks.report import Sample, build_report, format_summary, save_report
+
+
+BENCH_ADMIN_PASSWORD = "bench-admin-password"
+BENCH_UPSTREAM_PASSWORD = "bench-upstream-password"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerThread:
+    """在独立线程中运行 uvicorn（每个线程有自己的事件循环）"""
+
+    def __init__(self, app, port: int):
+        import uvicorn
+
+        self.port = port
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", access_log=False,
+        ))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 30):
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if time.time() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"服务启动失败: {self.url}")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def _build_request(api: str, model: str, stream: bool, prompt: str):
+    """返回 (路径, 请求体)"""
+    if api == "gemini":
+        action = "streamGenerateContent" if stream else "generateContent"
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        return f"/v1beta/models/{model}:{action}", body
+    body = {
+        "model": model,
+        "stream": stream,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    return "/v1/chat/completions", body
+
+
+async def _one_request(client: httpx.AsyncClient, api: str, model: str, stream: bool, prompt: str) -> Sample:
+    path, body = _build_request(api, model, stream, prompt)
+    start = time.perf_counter()
+    ttfb = None
+    size = 0
+    error = None
+    status = 0
+    try:
+        async with client.stream("POST", path, json=body) as response:
+            status = response.status_code
+            head = b""
+            async for chunk in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                if len(head) < 512:
+                    head += chunk[:512]
+                size += len(chunk)
+            # 流式接口出错时仍返回 200，错误写在 SSE 数据里
+            if status == 200 and stream and head.startswith(b'data: {"error"'):
+                error = "stream error: " + head[:120].decode(errors="replace")
+            elif status != 200:
+                error = f"HTTP {status}: " + head[:120].decode(errors="replace")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return Sample(
+        stream=stream, status=status, latency=time.perf_counter() - start,
+        ttfb=ttfb, bytes=size, error=error,
+    )
+
+
+async def run_load(base_url: str, api_key: str, args,
+                   count_writes: Optional[Callable[[], Awaitable[Optional[int]]]] = None) -> tuple:
+    """
+    并发压测，返回 (样本列表, 实际耗时秒, 日志写入次数)
+
+    count_writes 读取累计日志写入次数，在预热之后和压测结束时各读取一次，预热请求不计入；
+    未传入或读取失败时写入次数为 None
+    """
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    headers = {"Authorization": f"Bearer {api_key}"}
+    samples: List[Sample] = []
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=args.timeout) as client:
+        # 预热：建立连接、填充缓存，不计入结果
+        for _ in range(args.warmup):
+            await _one_request(client, args.api, args.model, rng.random() < args.stream_ratio, args.prompt)
+
+        before = await count_writes() if count_writes is not None else None
+        counter = itertools.count()
+        deadline = time.perf_counter() + args.duration if args.duration else None
+
+        async def worker():
+            while True:
+                i = next(counter)
+                if args.requests and i >= args.requests:
+                    return
+                if deadline and time.perf_counter() >= deadline:
+                    return
+                stream = rng.random() < args.stream_ratio
+                samples.append(await _one_request(client, args.api, args.model, stream, args.prompt))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    after = await count_writes() if count_writes is not None else None
+    db_writes = after - before if before is not None and after is not None else None
+    return samples, elapsed, db_writes
+
+
+async def _scrape_log_writes(base_url: str, token: str) -> Optional[int]:
+    """从 /metrics 读取累计日志写入次数"""
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=10) as client:
+            response = await client.get("/metrics", headers=headers)
+            response.raise_for_status()
+    except Exception:
+        return None
+    total = 0
+    for line in response.text.splitlines():
+        if line.startswith("proxy_log_write_seconds_count"):
+            total += int(float(line.rsplit(" ", 1)[1]))
+    return total
+
+
+def _count_usage_logs(db_path: str) -> Optional[int]:
+    try:
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM usage_logs").fetchone()[0]
+    except Exception:
+        return None
+
+
+async def _create_api_key(base_url: str) -> str:
+    """以管理员身份登录并创建压测用 API Key"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        login = await client.post("/api/auth/login", json={"username": "admin", "password": BENCH_ADMIN_PASSWORD})
+        login.raise_for_status()
+        token = login.json()["access_token"]
+        created = await client.post(
+            "/api/auth/api-keys", json={"name": "benchmark"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        created.raise_for_status()
+        return created.json()["key"]
+
+
+def run_inprocess(args) -> dict:
+    """启动模拟上游和真实应用后压测"""
+    mock = ServerThread(create_mock_app(config_from_args(args)), _free_port())
+    mock.start()
+
+    with tempfile.TemporaryDirectory(prefix="catie-bench-") as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        # 必须在导入 app 之前设置，Settings 在导入时读取环境变量
+        os.environ.update({
+            "DATABASE_URL": f"sqlite+aiosqlite:///{db_path}",
+            "ADMIN_USERNAME": "admin",
+            "ADMIN_PASSWORD": BENCH_ADMIN_PASSWORD,
+            "GCLI2API_BASE_URL": mock.url,
+            "GCLI2API_API_PASSWORD": BENCH_UPSTREAM_PASSWORD,
+            "GCLI2API_PANEL_PASSWORD": BENCH_UPSTREAM_PASSWORD,
+            "ENABLE_GCLI2API_BRIDGE": "true",
+            "METRICS_TOKEN": "",
+        })
+        for key, value in args.env:
+            os.environ[key] = value
+
+        from app.main import app
+
+        server = ServerThread(app, _free_port())
+        server.start()
+        try:
+            api_key = asyncio.run(_create_api_key(server.url))
+            samples, elapsed, db_writes = asyncio.run(run_load(
+                server.url, api_key, args, lambda: asyncio.to_thread(_count_usage_logs, db_path)
+            ))
+        finally:
+            server.stop()
+            mock.stop()
+
+    return build_report(samples, elapsed, _report_config(args), db_writes)
+
+
+def run_external(args) -> dict:
+    """压测已运行的实例"""
+    if not args.api_key:
+        raise SystemExit("外部模式需要 --api-key")
+    samples, elapsed, db_writes = asyncio.run(run_load(
+        args.target, args.api_key, args, lambda: _scrape_log_writes(args.target, args.metrics_token)
+    ))
+    return build_report(samples, elapsed, _report_config(args), db_writes)
+
+
+def _report_config(args) -> dict:
+    config = {k: v for k, v in vars(args).items() if k not in ("api_key", "metrics_token", "output", "env")}
+    config["env"] = [key for key, _ in args.env]
+    return config
+
+
+def _parse_env(value: str):
+    key, sep, val = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("格式应为 KEY=VALUE")
+    return key, val
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catie 代理压测")
+    parser.add_argument("--target", default="inprocess", help="inprocess（默认）或已运行实例的 URL")
+    parser.add_argument("--api-key", default="", help="外部模式使用的 API Key")
+    parser.add_argument("--metrics-token", default="", help="外部模式抓取 /metrics 的令牌")
+    parser.add_argument("--api", choices=["openai", "gemini"], default="openai", help="压测的接口格式")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--prompt", default="用一句话介绍你自己。")
+    parser.add_argument("--concurrency", "-c", type=int, default=20, help="并发客户端数")
+    parser.add_argument("--requests", "-n", type=int, default=500, help="总请求数（与 --duration 二选一，0 表示不限）")
+    parser.add_argument("--duration", "-d", type=float, default=0, help="压测时长（秒），0 表示按请求数")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求占比 0~1")
+    parser.add_argument("--warmup", type=int, default=5, help="预热请求数（不计入结果）")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--env", type=_parse_env, action="append", default=[],
+                        help="进程内模式下额外设置的环境变量，如 --env SQLITE_ENGINE_MODE=null")
+    parser.add_argument("--output", "-o", default=None, help="结果 JSON 路径，默认 benchmarks/results/")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    if args.duration:
+        args.requests = 0
+
+    report = run_inprocess(args) if args.target == "inprocess" else run_external(args)
+    path = save_report(report, args.output)
+    print(format_summary(report))
+    print(f"结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+模拟上游服务
+
+模拟 gcli2api（GeminiCLI / Antigravity）和 OpenAI 兼容端点，供压测使用：
+- POST /v1/chat/completions、/antigravity/v1/chat/completions（OpenAI 格式，支持 stream）
+- POST /v1beta/models/{model}:generateContent、:streamGenerateContent（Gemini 格式）
+- GET  /creds/status、/antigravity/creds/status（凭证状态列表）
+- GET  /v1/models（OpenAI 端点模型列表）
+- GET  /__mock__/stats（各路径请求计数，便于核对端点轮询分布；含模拟上下文缓存的命中数）
+
+模拟上下文缓存（--context-cache-bytes > 0）：chat/completions 请求的 messages 序列化后前 N 字节
+作为缓存键，LRU 保留 context_cache_entries 个；命中时延迟乘以 cached_latency_ratio。
+
+独立运行:
+    python -m benchmarks.mock_upstream --port 17861 --latency-ms 200 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockConfig:
+    """模拟上游的行为参数"""
+    latency_ms: float = 100  # 返回响应头之前的延迟
+    jitter_ms: float = 20  # 延迟随机抖动（±）
+    error_rate: float = 0.0  # 返回错误的概率 [0, 1]
+    error_statuses: tuple = (429, 500, 503)  # 错误时随机选取的状态码
+    chunk_count: int = 20  # 流式响应的分块数
+    chunk_interval_ms: float = 20  # 分块间隔
+    chunk_text: str = "你好，这是一段模拟输出。"  # 每块的文本内容
+    credential_count: int = 20  # /creds/status 返回的凭证数
+    context_cache_bytes: int = 0  # 模拟上下文缓存的前缀字节数，0 表示不模拟
+    context_cache_entries: int = 16  # 上下文缓存保留的前缀数（LRU）
+    cached_latency_ratio: float = 0.3  # 上下文缓存命中时的延迟倍数
+    seed: Optional[int] = None  # 随机种子，固定后结果可复现
+
+
+_ERROR_MESSAGES = {
+    429: "Resource has been exhausted (e.g. check quota).",
+    500: "Internal error encountered.",
+    503: "The model is overloaded. Please try again later.",
+}
+
+
+def create_app(config: Optional[MockConfig] = None) -> FastAPI:
+    """创建模拟上游应用"""
+    config = config or MockConfig()
+    rng = random.Random(config.seed)
+    hits = Counter()
+    context_cache = OrderedDict()
+
+    app = FastAPI(title="mock-upstream")
+
+    async def _delay(ratio: float = 1.0):
+        jitter = rng.uniform(-config.jitter_ms, config.jitter_ms) if config.jitter_ms else 0
+        await asyncio.sleep(max(config.latency_ms + jitter, 0) * ratio / 1000)
+
+    def _context_cache_ratio(messages) -> float:
+        """模拟上游上下文缓存：前缀命中返回 cached_latency_ratio，否则 1"""
+        if not config.context_cache_bytes:
+            return 1.0
+        prefix = json.dumps(messages, ensure_ascii=False).encode("utf-8")
+        if len(prefix) < config.context_cache_bytes:
+            return 1.0
+        key = prefix[:config.context_cache_bytes]
+        if key in context_cache:
+            context_cache.move_to_end(key)
+            hits["context_cache_hit"] += 1
+            return config.cached_latency_ratio
+        hits["context_cache_miss"] += 1
+        context_cache[key] = True
+        if len(context_cache) > config.context_cache_entries:
+            context_cache.popitem(last=False)
+        return 1.0
+
+    def _maybe_error() -> Optional[JSONResponse]:
+        if config.error_rate and rng.random() < config.error_rate:
+            status = rng.choice(config.error_statuses)
+            return JSONResponse(
+                status_code=status,
+                content={"error": {"code": status, "message": _ERROR_MESSAGES.get(status, "mock error")}}
+            )
+        return None
+
+    def _openai_chunk(model: str, index: int, content: str, finish: bool = False) -> bytes:
+        payload = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": {} if finish else {"content": content},
+                "finish_reason": "stop" if finish else None,
+            }],
+        }
+        if finish:
+            payload["usage"] = {"prompt_tokens": 10, "completion_tokens": config.chunk_count,
+                                "total_tokens": 10 + config.chunk_count}
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+    def _gemini_chunk(content: str, finish: bool = False) -> bytes:
+        payload = {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": content}]},
+                "finishReason": "STOP" if finish else None,
+                "index": 0,
+            }]
+        }
+        if finish:
+            payload["usageMetadata"] = {"promptTokenCount": 10, "candidatesTokenCount": config.chunk_count}
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+    async def _paced(chunks):
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(config.chunk_interval_ms / 1000)
+            yield chunk
+
+    async def _chat_completions(request: Request, route: str):
+        hits[route] += 1
+        body = await request.json()
+        model = body.get("model", "mock-model")
+        await _delay(_context_cache_ratio(body.get("messages")))
+        error = _maybe_error()
+        if error is not None:
+            return error
+
+        if body.get("stream"):
+            chunks = [_openai_chunk(model, i, config.chunk_text) for i in range(config.chunk_count)]
+            chunks.append(_openai_chunk(model, config.chunk_count, "", finish=True))
+            chunks.append(b"data: [DONE]\n\n")
+            return StreamingResponse(_paced(chunks), media_type="text/event-stream")
+
+        content = config.chunk_text * config.chunk_count
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": config.chunk_count, "total_tokens": 10 + config.chunk_count},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await _chat_completions(request, "gcli2api")
+
+    @app.post("/antigravity/v1/chat/completions")
+    async def antigravity_chat_completions(request: Request):
+        return await _chat_completions(request, "antigravity")
+
+    @app.post("/v1beta/models/{model:path}:generateContent")
+    async def generate_content(model: str):
+        hits["generateContent"] += 1
+        await _delay()
+        error = _maybe_error()
+        if error is not None:
+            return error
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": config.chunk_text * config.chunk_count}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": config.chunk_count},
+        }
+
+    @app.post("/v1beta/models/{model:path}:streamGenerateContent")
+    async def stream_generate_content(model: str):
+        hits["streamGenerateContent"] += 1
+        await _delay()
+        error = _maybe_error()
+        if error is not None:
+            return error
+        chunks = [_gemini_chunk(config.chunk_text) for _ in range(config.chunk_count)]
+        chunks.append(_gemini_chunk("", finish=True))
+        return StreamingResponse(_paced(chunks), media_type="text/event-stream")
+
+    def _creds_status(prefix: str) -> dict:
+        return {
+            f"{prefix}-{i}.json": {
+                "disabled": False,
+                "error_codes": [],
+                "user_email": f"mock{i}@example.com",
+                "last_success": time.time(),
+                "model_cooldowns": {},
+            }
+            for i in range(config.credential_count)
+        }
+
+    @app.get("/creds/status")
+    async def creds_status():
+        hits["creds_status"] += 1
+        return _creds_status("gcli")
+
+    @app.get("/antigravity/creds/status")
+    async def antigravity_creds_status():
+        hits["antigravity_creds_status"] += 1
+        return _creds_status("antigravity")
+
+    @app.get("/v1/models")
+    async def list_models():
+        hits["models"] += 1
+        await _delay()
+        return {"object": "list", "data": [{"id": "mock-gpt", "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/__mock__/stats")
+    async def stats():
+        return {"hits": dict(hits), "config": asdict(config)}
+
+    return app
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    """向命令行解析器添加模拟上游参数（loadgen 复用）"""
+    group = parser.add_argument_group("模拟上游")
+    group.add_argument("--latency-ms", type=float, default=MockConfig.latency_ms, help="响应头前的延迟（毫秒）")
+    group.add_argument("--jitter-ms", type=float, default=MockConfig.jitter_ms, help="延迟抖动（毫秒）")
+    group.add_argument("--error-rate", type=float, default=MockConfig.error_rate, help="错误率 0~1")
+    group.add_argument("--chunk-count", type=int, default=MockConfig.chunk_count, help="流式分块数")
+    group.add_argument("--chunk-interval-ms", type=float, default=MockConfig.chunk_interval_ms, help="分块间隔（毫秒）")
+    group.add_argument("--context-cache-bytes", type=int, default=MockConfig.context_cache_bytes,
+                       help="模拟上下文缓存的前缀字节数，0 表示不模拟")
+    group.add_argument("--context-cache-entries", type=int, default=MockConfig.context_cache_entries,
+                       help="上下文缓存保留的前缀数")
+    group.add_argument("--seed", type=int, default=None, help="随机种子")
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        chunk_count=args.chunk_count,
+        chunk_interval_ms=args.chunk_interval_ms,
+        context_cache_bytes=args.context_cache_bytes,
+        context_cache_entries=args.context_cache_entries,
+        seed=args.seed,
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="模拟 gcli2api / OpenAI 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=17861)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+压测结果统计与对比
+
+对比两次压测结果（例如两个提交）:
+    python -m benchmarks.report benchmarks/results/a.json benchmarks/results/b.json
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+@dataclass
+class Sample:
+    """单次请求的测量结果"""
+    stream: bool
+    status: int
+    latency: float  # 秒，从发出请求到读完响应体
+    ttfb: Optional[float]  # 秒，从发出请求到收到首个响应体字节
+    bytes: int = 0
+    error: Optional[str] = None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """最近秩法分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def _distribution_ms(values: List[float]) -> Dict[str, Optional[float]]:
+    def ms(v):
+        return round(v * 1000, 2) if v is not None else None
+
+    return {
+        "p50": ms(percentile(values, 50)),
+        "p95": ms(percentile(values, 95)),
+        "p99": ms(percentile(values, 99)),
+        "max": ms(max(values)) if values else None,
+        "mean": ms(sum(values) / len(values)) if values else None,
+    }
+
+
+def summarize(samples: List[Sample], elapsed: float) -> dict:
+    """汇总一组样本"""
+    ok = [s for s in samples if s.status == 200 and s.error is None]
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "status_codes": dict(Counter(str(s.status) for s in samples)),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "latency_ms": _distribution_ms([s.latency for s in ok]),
+        "ttfb_ms": _distribution_ms([s.ttfb for s in ok if s.ttfb is not None]),
+        "bytes_received": sum(s.bytes for s in samples),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def build_report(samples: List[Sample], elapsed: float, config: dict,
+                 db_writes: Optional[int] = None) -> dict:
+    """生成完整报告（总体 + 流式/非流式分组）"""
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "config": config,
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": summarize(samples, elapsed),
+        "stream": summarize([s for s in samples if s.stream], elapsed),
+        "non_stream": summarize([s for s in samples if not s.stream], elapsed),
+        "db": {
+            "log_writes": db_writes,
+            "log_writes_per_second": round(db_writes / elapsed, 2) if db_writes is not None and elapsed else None,
+        },
+    }
+    errors = Counter(s.error for s in samples if s.error)
+    if errors:
+        report["error_samples"] = dict(errors.most_common(10))
+    return report
+
+
+def save_report(report: dict, output: Optional[str] = None) -> str:
+    """保存报告，默认写入 benchmarks/results/<commit>-<时间>.json"""
+    if not output:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        os.makedirs(results_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(results_dir, f"{report['meta']['commit'] or 'nocommit'}-{stamp}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return output
+
+
+# 变化超过此百分比才视为性能回退（压测本身有噪声）
+REGRESSION_THRESHOLD_PCT = 10
+
+# 对比时关注的指标：(路径, 越小越好)
+COMPARE_FIELDS = [
+    ("overall.throughput_rps", False),
+    ("overall.errors", True),
+    ("overall.latency_ms.p50", True),
+    ("overall.latency_ms.p95", True),
+    ("overall.latency_ms.p99", True),
+    ("stream.ttfb_ms.p50", True),
+    ("stream.ttfb_ms.p95", True),
+    ("stream.ttfb_ms.p99", True),
+    ("non_stream.latency_ms.p95", True),
+    ("db.log_writes_per_second", False),
+]
+
+
+def _lookup(report: dict, path: str):
+    value = report
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def compare(old: dict, new: dict) -> List[dict]:
+    """逐项对比两份报告，返回 [{field, old, new, change_pct, regression}]"""
+    rows = []
+    for field, lower_is_better in COMPARE_FIELDS:
+        a, b = _lookup(old, field), _lookup(new, field)
+        change = None
+        regression = False
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a:
+            change = round((b - a) / a * 100, 1)
+            worse = change if lower_is_better else -change
+            regression = worse > REGRESSION_THRESHOLD_PCT
+        rows.append({"field": field, "old": a, "new": b, "change_pct": change, "regression": regression})
+    return rows
+
+
+def format_summary(report: dict) -> str:
+    """终端输出用的简要摘要"""
+    overall = report["overall"]
+    lines = [
+        f"请求数: {overall['requests']}  成功: {overall['ok']}  失败: {overall['errors']}  "
+        f"状态码: {overall['status_codes']}",
+        f"吞吐: {overall['throughput_rps']} req/s  耗时: {report['elapsed_seconds']}s",
+    ]
+    for name in ("non_stream", "stream"):
+        part = report[name]
+        if not part["requests"]:
+            continue
+        lat, ttfb = part["latency_ms"], part["ttfb_ms"]
+        lines.append(
+            f"[{name}] 延迟 p50/p95/p99 = {lat['p50']}/{lat['p95']}/{lat['p99']} ms, "
+            f"TTFB p50/p95/p99 = {ttfb['p50']}/{ttfb['p95']}/{ttfb['p99']} ms"
+        )
+    db = report["db"]
+    if db["log_writes"] is not None:
+        lines.append(f"日志写入: {db['log_writes']} 条, {db['log_writes_per_second']} 条/秒")
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("用法: python -m benchmarks.report <旧结果.json> <新结果.json>")
+        sys.exit(2)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        old = json.load(f)
+    with open(sys.argv[2], encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"旧: {old['meta'].get('commit')} ({old['meta'].get('timestamp')})")
+    print(f"新: {new['meta'].get('commit')} ({new['meta'].get('timestamp')})")
+    print(f"{'指标':<30}{'旧':>12}{'新':>12}{'变化':>10}")
+    regressions = 0
+    for row in compare(old, new):
+        change = f"{row['change_pct']:+.1f}%" if row["change_pct"] is not None else "-"
+        mark = "  ⚠️" if row["regression"] else ""
+        regressions += row["regression"]
+        print(f"{row['field']:<30}{str(row['old']):>12}{str(row['new']):>12}{change:>10}{mark}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()